@@ -0,0 +1,10 @@
+"""Offline benchmarks: the service runs against local fakes of Firestore, X and the LLM.
+
+    python -m bench                     # every scenario, each in its own process
+    python -m bench reviews --scale 0.01
+    python -m bench --json base.json    # later: python -m bench --baseline base.json
+
+The store is MemoryStore (or SQLiteStore with --store sqlite) in place of
+Firestore, X is `fakes.FakeXServer`, a local HTTP server with X's rate limit
+headers, and OpenAI is `fakes.FakeAsyncOpenAI` with a configurable latency.
+"""
@@ -0,0 +1,70 @@
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+import bench
+from bench import harness
+from bench.scenarios import SCENARIOS, start_service
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="python -m bench", description=bench.__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('scenarios', nargs='*', metavar='scenario',
+                        help=f"any of {', '.join(SCENARIOS)}; all of them by default")
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help="multiplies every scenario's size and duration, e.g. 0.01 for a quick run")
+    parser.add_argument('--store', choices=['memory', 'sqlite'], default='memory',
+                        help="store standing in for Firestore")
+    parser.add_argument('--llm-latency', type=float, default=0.8, help="seconds per fake LLM call")
+    parser.add_argument('--x-latency', type=float, default=0.0, help="seconds added to every fake X API request")
+    parser.add_argument('--json', help="write the results to this file")
+    parser.add_argument('--baseline', help="results of an earlier run; exit with status 1 on regressions")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed relative regression (default 0.2)")
+    args = parser.parse_args(argv)
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f"unknown scenario {name!r}")
+    return args
+
+
+def run_scenario(args: argparse.Namespace, name: str) -> list[harness.Result]:
+    service = start_service(args.store, args.llm_latency, args.x_latency)
+    try:
+        return SCENARIOS[name](service, scale=args.scale)
+    finally:
+        service.x.stop()
+
+
+def run_isolated(args: argparse.Namespace, name: str) -> list[harness.Result]:
+    """Run one scenario in a fresh interpreter, so threads and memory are its own."""
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'results.json')
+        command = [sys.executable, '-m', 'bench', name, '--scale', str(args.scale), '--store', args.store,
+                   '--llm-latency', str(args.llm_latency), '--x-latency', str(args.x_latency), '--json', path]
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+        return harness.load(path)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    names = args.scenarios or list(SCENARIOS)
+    if len(names) == 1:
+        results = run_scenario(args, names[0])
+    else:
+        results = [result for name in names for result in run_isolated(args, name)]
+    print(harness.report(results))
+    if args.json:
+        harness.save(results, args.json)
+    if args.baseline:
+        found = harness.regressions(results, harness.load(args.baseline), args.tolerance)
+        for regression in found:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        return 1 if found else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,387 @@
+import asyncio
+import hashlib
+import itertools
+import json
+import queue
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib import parse
+
+from xlearn import x_streaming
+
+X_API_HOST = "https://api.twitter.com"
+
+
+class FakeXServer:
+    """Local HTTP stand-in for the X API v2 endpoints the service calls.
+
+    Serves tweet create/get, recent search, filtered stream rules and the filtered
+    stream itself, with X's rate limit headers: every (token, endpoint) pair gets
+    `post_limit` (POST /2/tweets) or `read_limit` requests per `window` seconds and
+    a 429 once they are used up. `throttle_share` of the posts that are within
+    their limits get a 429 anyway, as X sends when it throttles early, with the
+    window reset `throttle_seconds` later. Pages for /import are served under /reader/, so
+    the reader upstream can point here as well (READER_BASE_URL).
+
+    Posted tweets are kept with the time they arrived; `emit()` pushes an event to
+    every connected stream.
+    """
+
+    def __init__(self, post_limit: int = 100, read_limit: int = 450, window: float = 900, latency: float = 0.0,
+                 keep_alive: float = 20.0, page_paragraphs: int = 12, host: str = '127.0.0.1', port: int = 0,
+                 throttle_share: float = 0.0, throttle_seconds: float = 1.0):
+        self.post_limit = post_limit
+        self.read_limit = read_limit
+        self.window = window
+        self.throttle_share = throttle_share
+        self.throttle_seconds = throttle_seconds
+        self.latency = latency
+        self.keep_alive = keep_alive
+        self.page_paragraphs = page_paragraphs
+        self.tweets = {}  # id -> tweet
+        self.posted = []  # (arrived_at, tweet), tweets created through POST /2/tweets
+        self.rules = {}  # id -> rule
+        self.requests = 0
+        self.pages_served = 0
+        self.throttled = 0
+        self._ids = itertools.count(1_800_000_000_000_000_000)
+        self._limits = {}  # (token, endpoint) -> (remaining, reset_at)
+        self._streams = []
+        self._lock = threading.Condition()
+        self._httpd = ThreadingHTTPServer((host, port), _handler_for(self))
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> 'FakeXServer':
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name="fake-x", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        with self._lock:
+            for stream in self._streams:
+                stream.put(None)
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def create_tweet(self, author_id: str, text: str, in_reply_to: str | None = None) -> dict:
+        tweet_id = str(next(self._ids))
+        with self._lock:
+            parent = self.tweets.get(in_reply_to) if in_reply_to else None
+            tweet = {
+                'id': tweet_id,
+                'text': text,
+                'author_id': author_id,
+                'conversation_id': parent['conversation_id'] if parent else (in_reply_to or tweet_id),
+                'edit_history_tweet_ids': [tweet_id],
+            }
+            if in_reply_to:
+                tweet['referenced_tweets'] = [{'type': 'replied_to', 'id': in_reply_to}]
+            self.tweets[tweet_id] = tweet
+        return tweet
+
+    def emit(self, tweet: dict):
+        """Send `tweet` to every connected stream, tagged with the first rule naming its author."""
+        with self._lock:
+            self.tweets[tweet['id']] = tweet
+            rules = [{'id': rule['id'], 'tag': rule.get('tag')} for rule in self.rules.values()
+                     if f"from:{tweet.get('author_id')}" in rule['value'].split(" OR ")]
+            line = json.dumps({'data': tweet, 'matching_rules': rules[:1]}).encode()
+            for stream in self._streams:
+                stream.put(line)
+
+    @staticmethod
+    def is_own_thread(thread: threading.Thread) -> bool:
+        """Whether `thread` serves the fake rather than the service, to leave it out of thread counts."""
+        return thread.name == 'fake-x' or 'process_request_thread' in thread.name
+
+    def next_id(self) -> str:
+        return str(next(self._ids))
+
+    def stream_count(self) -> int:
+        with self._lock:
+            return len(self._streams)
+
+    def wait_for(self, predicate, timeout: float) -> bool:
+        """Wait until predicate(server) holds; it is re-checked whenever a tweet is posted."""
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while not predicate(self):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._lock.wait(min(remaining, 1.0))
+        return True
+
+    def _take(self, token: str, endpoint: str, limit: int) -> tuple[bool, dict]:
+        now = time.time()
+        with self._lock:
+            remaining, reset_at = self._limits.get((token, endpoint), (limit, now + self.window))
+            if reset_at <= now:
+                remaining, reset_at = limit, now + self.window
+            allowed = remaining > 0
+            if allowed and endpoint == 'tweets' and random.random() < self.throttle_share:
+                allowed, remaining, reset_at = False, 0, now + self.throttle_seconds
+            if allowed:
+                remaining -= 1
+            else:
+                self.throttled += 1
+            self._limits[(token, endpoint)] = (remaining, reset_at)
+        return allowed, {
+            'x-rate-limit-limit': str(limit),
+            'x-rate-limit-remaining': str(remaining),
+            'x-rate-limit-reset': str(int(reset_at) + 1),
+        }
+
+    def _post_tweet(self, token: str, body: dict) -> dict:
+        in_reply_to = (body.get('reply') or {}).get('in_reply_to_tweet_id')
+        tweet = self.create_tweet(token.removeprefix('token-'), body['text'], in_reply_to)
+        with self._lock:
+            self.posted.append((time.time(), tweet))
+            self._lock.notify_all()
+        return tweet
+
+    def _search(self, query: str, since_id: str | None = None) -> list[dict]:
+        match = re.search(r"conversation_id:(\d+)", query)
+        with self._lock:
+            tweets = [tweet for tweet in self.tweets.values() if since_id is None or int(tweet['id']) > int(since_id)]
+            if match is None:
+                return tweets[-10:]
+            return [tweet for tweet in tweets if tweet['conversation_id'] == match.group(1)]
+
+    def _change_rules(self, body: dict) -> tuple[int, dict]:
+        with self._lock:
+            if 'add' in body:
+                added = []
+                for rule in body['add']:
+                    rule = {'id': self.next_id(), 'value': rule['value'], 'tag': rule.get('tag')}
+                    self.rules[rule['id']] = rule
+                    added.append(rule)
+                return 201, {'data': added, 'meta': {'summary': {'created': len(added)}}}
+            ids = body.get('delete', {}).get('ids', [])
+            deleted = sum(self.rules.pop(rule_id, None) is not None for rule_id in ids)
+            return 200, {'meta': {'summary': {'deleted': deleted}}}
+
+    def page(self, url: str) -> str:
+        """Markdown for any URL, the same every time, with distinct paragraphs per URL."""
+        seed = hashlib.sha1(url.encode()).hexdigest()[:8]
+        sections = []
+        for i in range(self.page_paragraphs):
+            if i % 4 == 0:
+                sections.append(f"## Section {i // 4 + 1} of {seed}")
+            sentences = [f"Fact {j} of paragraph {i} on page {seed} is that item {i * 7 + j} weighs {j + 3} units."
+                         for j in range(8)]
+            sections.append(" ".join(sentences))
+        return f"# Page {seed}\n\n" + "\n\n".join(sections)
+
+    def _subscribe(self) -> queue.Queue:
+        stream = queue.Queue()
+        with self._lock:
+            self._streams.append(stream)
+        return stream
+
+    def _unsubscribe(self, stream: queue.Queue):
+        with self._lock:
+            if stream in self._streams:
+                self._streams.remove(stream)
+
+
+_TWEET_ID_PATH = re.compile(r"^/2/tweets/(\d+)$")
+
+
+def _handler_for(server: FakeXServer):
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def _reply(self, status: int, body: dict | str, headers: dict | None = None,
+                   content_type: str = 'application/json'):
+            data = (body if isinstance(body, str) else json.dumps(body)).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _body(self) -> dict:
+            length = int(self.headers.get('Content-Length') or 0)
+            return json.loads(self.rfile.read(length)) if length else {}
+
+        def _token(self) -> str:
+            return self.headers.get('Authorization', '').removeprefix('Bearer ')
+
+        def _limited(self, endpoint: str, limit: int) -> dict | None:
+            """Rate limit headers for this request, or None once a 429 has been sent."""
+            allowed, headers = server._take(self._token(), endpoint, limit)
+            if not allowed:
+                self._body()  # read off the connection, which is kept alive for the next request
+                self._reply(429, {'title': 'Too Many Requests', 'status': 429}, headers)
+                return None
+            return headers
+
+        def _handle(self, method: str):
+            with server._lock:
+                server.requests += 1
+            if server.latency:
+                time.sleep(server.latency)
+            url = parse.urlsplit(self.path)
+            path, query = url.path, parse.parse_qs(url.query)
+            if path.startswith('/reader/'):
+                return self._reader(parse.unquote(self.path[len('/reader/'):]))
+            if method == 'POST' and path == '/2/tweets':
+                headers = self._limited('tweets', server.post_limit)
+                if headers is not None:
+                    self._reply(201, {'data': server._post_tweet(self._token(), self._body())}, headers)
+            elif method == 'GET' and path == '/2/tweets/search/recent':
+                headers = self._limited('search', server.read_limit)
+                if headers is not None:
+                    tweets = server._search(query.get('query', [''])[0], query.get('since_id', [None])[0])
+                    # like X, no data at all when nothing matches
+                    body = {'data': tweets} if tweets else {}
+                    self._reply(200, {**body, 'meta': {'result_count': len(tweets)}}, headers)
+            elif path == '/2/tweets/search/stream/rules':
+                if method == 'GET':
+                    with server._lock:
+                        rules = list(server.rules.values())
+                    self._reply(200, {'data': rules, 'meta': {'result_count': len(rules)}})
+                else:
+                    self._reply(*server._change_rules(self._body()))
+            elif method == 'GET' and path == '/2/tweets/search/stream':
+                self._stream()
+            elif method == 'GET' and _TWEET_ID_PATH.match(path):
+                headers = self._limited('lookup', server.read_limit)
+                if headers is not None:
+                    tweet = server.tweets.get(_TWEET_ID_PATH.match(path).group(1))
+                    if tweet is None:
+                        self._reply(404, {'title': 'Not Found Error', 'status': 404}, headers)
+                    else:
+                        self._reply(200, {'data': tweet}, headers)
+            else:
+                self._reply(404, {'title': 'Not Found Error', 'status': 404})
+
+        def _reader(self, url: str):
+            with server._lock:
+                server.pages_served += 1
+            text = server.page(url)
+            etag = '"' + hashlib.sha1(text.encode()).hexdigest()[:16] + '"'
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self._reply(200, text, {'ETag': etag, 'Cache-Control': 'max-age=3600'}, 'text/markdown')
+
+        def _stream(self):
+            stream = server._subscribe()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            try:
+                while True:
+                    try:
+                        line = stream.get(timeout=server.keep_alive)
+                    except queue.Empty:
+                        line = b''  # keep-alive
+                    if line is None:
+                        break
+                    data = line + b"\r\n"
+                    self.wfile.write(f"{len(data):X}\r\n".encode() + data + b"\r\n")
+                    self.wfile.flush()
+                self.wfile.write(b"0\r\n\r\n")
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            finally:
+                server._unsubscribe(stream)
+                self.close_connection = True
+
+        def do_GET(self):
+            self._handle('GET')
+
+        def do_POST(self):
+            self._handle('POST')
+
+    return Handler
+
+
+class _RerouteAdapter(x_streaming.TimeoutHTTPAdapter):
+    """Sends requests for the X API host to `base_url` instead, keeping the path."""
+
+    def __init__(self, base_url: str, **kwargs):
+        self.base_url = base_url.rstrip('/')
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if request.url.startswith(X_API_HOST):
+            request.url = self.base_url + request.url[len(X_API_HOST):]
+        return super().send(request, **kwargs)
+
+
+def route_x_api(base_url: str):
+    """Point every session x_streaming hands out (bearer and per-user clients) at `base_url`."""
+    original = x_streaming.pooled_session
+
+    def mount(session, pool_size=x_streaming.HTTP_POOL_SIZE, timeout=x_streaming.HTTP_TIMEOUT):
+        session.mount(X_API_HOST, _RerouteAdapter(base_url, timeout=timeout, pool_connections=pool_size,
+                                                  pool_maxsize=pool_size))
+        return session
+
+    def pooled_session(pool_size=x_streaming.HTTP_POOL_SIZE, timeout=x_streaming.HTTP_TIMEOUT):
+        return mount(original(pool_size, timeout), pool_size, timeout)
+
+    x_streaming.pooled_session = pooled_session
+    mount(x_streaming.session)
+
+
+class FakeAsyncOpenAI:
+    """The slice of openai.AsyncOpenAI that ai_utils uses, answering after a simulated latency.
+
+    Each call sleeps `latency` seconds, varied by +-`jitter` (a fraction), then
+    answers whichever prompt it was given: flashcards, feedback, an action or a summary.
+    Answers are derived from the prompt, so repeated prompts get the same answer.
+    """
+
+    def __init__(self, latency: float = 0.8, jitter: float = 0.25, correct_rate: float = 0.5):
+        self.latency = latency
+        self.jitter = jitter
+        self.correct_rate = correct_rate
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    async def _create(self, model: str, messages: list[dict], **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.latency * random.uniform(1 - self.jitter, 1 + self.jitter))
+        content = self.respond(messages[-1]['content'])
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+    def respond(self, prompt: str) -> str:
+        rng = random.Random(hashlib.sha1(prompt.encode()).digest())
+        if prompt.startswith('Summarize this Twitter conversation'):
+            return f"The user and the bot talked about {rng.randint(1, 9)} materials."
+        if '"cards"' in prompt:
+            # ids long enough that the importer's near-duplicate check keeps every card
+            ids = [hashlib.sha1(f"{i}{prompt}".encode()).hexdigest()[:16] for i in range(rng.randint(2, 5))]
+            cards = [{'question': f"What is {card_id}?", 'answer': f"It is {card_id[::-1]}"} for card_id in ids]
+            return json.dumps({'cards': cards})
+        if '"correct"' in prompt:
+            correct = rng.random() < self.correct_rate
+            feedback = "Nice, that's right!" if correct else "Not quite, have another look at the answer."
+            return json.dumps({'correct': correct, 'feedback': feedback})
+        if '"action"' in prompt:
+            return json.dumps({'message_to_user': "Counting your materials.", 'action': {'type': 'count_materials'}})
+        return "OK"
@@ -0,0 +1,170 @@
+import json
+import math
+import os
+import resource
+import threading
+import time
+from dataclasses import dataclass, field, asdict
+from typing import Callable
+
+
+def percentile(values: list[float], q: float) -> float:
+    """Nearest-rank percentile; 0.0 for no values."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+
+class Recorder:
+    """Collects the latency of every call made through `wrap`, and its failures."""
+
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float, failed: bool = False):
+        with self._lock:
+            self.latencies.append(seconds)
+            if failed:
+                self.errors += 1
+
+    def wrap(self, func: Callable) -> Callable:
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            except BaseException:
+                self.record(time.perf_counter() - start, failed=True)
+                raise
+            self.record(time.perf_counter() - start)
+            return result
+        return timed
+
+
+def _rss_bytes() -> int:
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:  # no /proc: the peak so far, which macOS reports in bytes and the BSDs in kilobytes
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if peak > 1 << 32 else peak * 1024
+
+
+class ResourceSampler:
+    """Samples thread count and resident memory on a background thread while a scenario runs.
+
+    Threads for which `exclude(thread)` is true, such as those of in-process fakes, are not counted.
+    """
+
+    def __init__(self, interval: float = 0.25, exclude: Callable[[threading.Thread], bool] = lambda thread: False):
+        self.interval = interval
+        self.exclude = exclude
+        self.peak_threads = 0
+        self.peak_rss = 0
+        self.start_rss = 0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        threads = sum(1 for thread in threading.enumerate() if not self.exclude(thread))
+        self.peak_threads = max(self.peak_threads, threads)
+        self.peak_rss = max(self.peak_rss, _rss_bytes())
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self._sample()
+
+    def __enter__(self):
+        self.start_rss = _rss_bytes()
+        self._sample()
+        self._thread = threading.Thread(target=self._run, name="bench-sampler", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stopped.set()
+        self._thread.join()
+        self._sample()
+        return False
+
+
+@dataclass
+class Result:
+    scenario: str
+    target: str
+    count: int
+    errors: int
+    seconds: float
+    throughput: float  # calls per second over the whole run
+    p50_ms: float
+    p99_ms: float
+    max_ms: float
+    peak_threads: int
+    peak_rss_mb: float
+    extra: dict = field(default_factory=dict)
+
+    @classmethod
+    def from_recorder(cls, scenario: str, target: str, recorder: Recorder, seconds: float,
+                      sampler: ResourceSampler, **extra) -> 'Result':
+        latencies = recorder.latencies
+        return cls(
+            scenario=scenario,
+            target=target,
+            count=len(latencies),
+            errors=recorder.errors,
+            seconds=round(seconds, 3),
+            throughput=round(len(latencies) / seconds, 2) if seconds else 0.0,
+            p50_ms=round(percentile(latencies, 50) * 1000, 2),
+            p99_ms=round(percentile(latencies, 99) * 1000, 2),
+            max_ms=round(max(latencies, default=0) * 1000, 2),
+            peak_threads=sampler.peak_threads,
+            peak_rss_mb=round(sampler.peak_rss / 2 ** 20, 1),
+            extra=extra,
+        )
+
+
+def report(results: list[Result]) -> str:
+    header = ("scenario", "target", "count", "errors", "per_sec", "p50_ms", "p99_ms", "max_ms", "threads", "rss_mb")
+    rows = [header] + [
+        (r.scenario, r.target, r.count, r.errors, r.throughput, r.p50_ms, r.p99_ms, r.max_ms, r.peak_threads,
+         r.peak_rss_mb)
+        for r in results
+    ]
+    widths = [max(len(str(row[i])) for row in rows) for i in range(len(header))]
+    lines = ["  ".join(str(value).rjust(width) for value, width in zip(row, widths)) for row in rows]
+    for r in results:
+        if r.extra:
+            lines.append(f"{r.scenario} {r.target}: " + ", ".join(f"{key}={value}" for key, value in r.extra.items()))
+    return "\n".join(lines)
+
+
+def save(results: list[Result], path: str):
+    with open(path, 'w') as f:
+        json.dump([asdict(r) for r in results], f, indent=2)
+
+
+def load(path: str) -> list[Result]:
+    with open(path) as f:
+        return [Result(**data) for data in json.load(f)]
+
+
+def regressions(results: list[Result], baseline: list[Result], tolerance: float = 0.2) -> list[str]:
+    """What got more than `tolerance` worse than the baseline: p99 latency, throughput, errors or memory."""
+    previous = {(r.scenario, r.target): r for r in baseline}
+    found = []
+    for r in results:
+        before = previous.get((r.scenario, r.target))
+        if before is None:
+            continue
+        name = f"{r.scenario} {r.target}"
+        if before.p99_ms and r.p99_ms > before.p99_ms * (1 + tolerance):
+            found.append(f"{name}: p99 {before.p99_ms}ms -> {r.p99_ms}ms")
+        if before.throughput and r.throughput < before.throughput * (1 - tolerance):
+            found.append(f"{name}: throughput {before.throughput}/s -> {r.throughput}/s")
+        if r.errors > before.errors:
+            found.append(f"{name}: errors {before.errors} -> {r.errors}")
+        if before.peak_rss_mb and r.peak_rss_mb > before.peak_rss_mb * (1 + tolerance):
+            found.append(f"{name}: memory {before.peak_rss_mb}MB -> {r.peak_rss_mb}MB")
+    return found
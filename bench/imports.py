@@ -0,0 +1,69 @@
+"""Import-time budget for each entry point: `python -m bench.imports`.
+
+Every entry point is imported in a fresh interpreter, a few times, and the
+fastest run is compared with its budget. Modules that must not be loaded at
+import time (SDKs that build clients, the web framework in the workers) fail
+the check however fast the import is. Exits with status 1 on any failure.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+# entry point -> (budget in seconds, modules it must not load)
+BUDGETS = {
+    'xlearn.main': (2.0, ('firebase_admin', 'openai', 'xai_sdk')),
+    'xlearn.api': (0.5, ('firebase_admin', 'openai', 'xai_sdk', 'fastapi', 'xlearn.service')),
+    'xlearn.stream_worker': (1.0, ('firebase_admin', 'openai', 'xai_sdk', 'fastapi', 'starlette', 'uvicorn')),
+    'xlearn.review_worker': (1.0, ('firebase_admin', 'openai', 'xai_sdk', 'fastapi', 'starlette', 'uvicorn')),
+}
+
+_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+print(json.dumps({{'seconds': time.perf_counter() - start, 'modules': sorted(sys.modules)}}))
+"""
+
+
+def measure(module: str) -> dict:
+    # no credentials and no Firestore: importing must not need either
+    env = {**os.environ, 'XLEARN_STORAGE': os.getenv('XLEARN_STORAGE', 'firestore')}
+    for name in ('OPENAI_API_KEY', 'XAI_API_KEY', 'CLIENT_ID', 'CLIENT_SECRET', 'REDIRECT_URI'):
+        env.pop(name, None)
+    output = subprocess.run([sys.executable, '-c', _PROBE.format(module=module)], env=env, check=True,
+                            capture_output=True, text=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def check(module: str, runs: int = 3, scale: float = 1.0) -> list[str]:
+    budget, forbidden = BUDGETS[module]
+    measurements = [measure(module) for _ in range(runs)]
+    seconds = min(m['seconds'] for m in measurements)
+    loaded = set(measurements[0]['modules'])
+    problems = [f"loads {name}" for name in forbidden if name in loaded]
+    if seconds > budget * scale:
+        problems.append(f"took {seconds:.2f}s, budget {budget * scale:.2f}s")
+    print(f"{module}: {seconds:.2f}s (budget {budget * scale:.2f}s)" + "".join(f"; {p}" for p in problems))
+    return problems
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m bench.imports", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('modules', nargs='*', metavar='module', help=f"any of {', '.join(BUDGETS)}; all by default")
+    parser.add_argument('--runs', type=int, default=3, help="imports per entry point; the fastest counts")
+    parser.add_argument('--scale', type=float, default=1.0, help="multiplies every budget, e.g. for slow CI machines")
+    args = parser.parse_args(argv)
+    for name in args.modules:
+        if name not in BUDGETS:
+            parser.error(f"unknown entry point {name!r}")
+    failed = False
+    for module in args.modules or list(BUDGETS):
+        failed |= bool(check(module, args.runs, args.scale))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,548 @@
+import asyncio
+import importlib
+import math
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from datetime import datetime, timedelta
+from types import ModuleType
+
+import httpx
+import uvicorn
+
+from bench.fakes import FakeAsyncOpenAI, FakeXServer, route_x_api
+from bench.harness import Recorder, ResourceSampler, Result, percentile
+
+
+@dataclass
+class Service:
+    xlearn: ModuleType  # xlearn.service
+    app: object  # the FastAPI app of xlearn.main
+    x: FakeXServer
+    llm: FakeAsyncOpenAI
+
+
+def start_service(store: str = 'memory', llm_latency: float = 0.8, x_latency: float = 0.0) -> Service:
+    """Import the service against local fakes; only once per process, since xlearn reads its config on import.
+
+    Everything runs in this process, the review scheduler included, as with `python -m xlearn.main`.
+    """
+    x = FakeXServer(latency=x_latency).start()
+    os.environ['XLEARN_STORAGE'] = store
+    if store == 'sqlite':
+        os.environ.setdefault('XLEARN_SQLITE_PATH', os.path.join(tempfile.mkdtemp(prefix='xlearn-bench-'), 'bench.db'))
+    os.environ['READER_BASE_URL'] = f"{x.url}/reader/"
+    # everything else can still be tuned from the shell, e.g. REVIEW_WORKERS or LLM_MAX_IN_FLIGHT
+    os.environ.setdefault('OPENAI_API_KEY', 'bench')
+    os.environ.setdefault('BEARER_TOKEN', 'bench')
+    os.environ.setdefault('X_APP_POST_LIMIT', str(10 ** 9))
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    route_x_api(x.url)
+    main = importlib.import_module('xlearn.main')
+    xlearn = main.service
+    xlearn.runs_reviews = True
+    llm = FakeAsyncOpenAI(latency=llm_latency)
+    xlearn.ai_utils.openai_client = llm
+    xlearn.ai_utils.use_xai_sdk = False
+    return Service(xlearn, main.app, x, llm)
+
+
+def seed_users(xlearn: ModuleType, count: int, store=None) -> list[str]:
+    store = store or xlearn.store
+    user_ids = [str(1000 + i) for i in range(count)]
+    with store.batch():
+        for user_id in user_ids:
+            store.set_user(user_id, {'access_token': f"token-{user_id}", 'username': f"bench{user_id}"})
+    return user_ids
+
+
+def seed_materials(xlearn: ModuleType, user_ids: list[str], count: int, start: datetime,
+                   spread: timedelta, store=None) -> dict[tuple[str, str], float]:
+    """`count` materials dealt round-robin to the users, due evenly over `spread` from `start`; returns their due times."""
+    store = store or xlearn.store
+    due = {}
+    per_user = [[] for _ in user_ids]
+    for i in range(count):
+        next_review_time = start + spread * (i / max(1, count))
+        if i % 3 == 2:
+            material = xlearn.QuoteMaterial(type="quote", content=f"Bench quote {i}", next_review_time=next_review_time)
+        else:
+            material = xlearn.QuestionMaterial(type="question", question=f"Bench question {i}?",
+                                               answer=f"answer {i}", next_review_time=next_review_time)
+        per_user[i % len(user_ids)].append(material)
+    for user_id, materials in zip(user_ids, per_user):
+        for offset in range(0, len(materials), 400):
+            chunk = materials[offset:offset + 400]
+            with store.batch():
+                ids = [store.add_material(user_id, asdict(material)) for material in chunk]
+            for material_id, material in zip(ids, chunk):
+                due[(user_id, material_id)] = material.next_review_time.timestamp()
+    return due
+
+
+@contextmanager
+def serving(app):
+    """Run the FastAPI app with uvicorn on a free local port for the duration of the block."""
+    # uvicorn binds the port itself: sockets handed to it skip the setup that keeps replies free of Nagle delays
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(app, host='127.0.0.1', port=port, log_level='warning', lifespan='on'))
+    thread = threading.Thread(target=server.run, name="bench-uvicorn", daemon=True)
+    thread.start()
+    while not server.started:
+        if not thread.is_alive():
+            raise RuntimeError(f"uvicorn could not start on port {port}")
+        time.sleep(0.05)
+    try:
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        server.should_exit = True
+        thread.join(10)
+
+
+def _scaled(value: float, scale: float) -> int:
+    return max(1, math.ceil(value * scale))
+
+
+def reviews(service: Service, scale: float = 1.0, materials: int = 50000, seconds: float = 3600,
+            materials_per_user: int = 100, throttled_share: float = 0.01) -> list[Result]:
+    """`materials` reviews falling due over `seconds`, run by the scheduler and posted through the dispatcher.
+
+    `throttled_share` of the posts get a 429 from X anyway and must still go out once its reset time passes.
+    """
+    xlearn, x = service.xlearn, service.x
+    x.throttle_share = throttled_share
+    materials, seconds = _scaled(materials, scale), max(1.0, seconds * scale)
+    user_ids = seed_users(xlearn, math.ceil(materials / materials_per_user))
+    start = datetime.now(tz=xlearn.timezone) + timedelta(seconds=1)
+    due = seed_materials(xlearn, user_ids, materials, start, timedelta(seconds=seconds))
+
+    recorder = Recorder()
+    xlearn.scheduler.func = recorder.wrap(xlearn.scheduler.func)
+    with ResourceSampler(exclude=FakeXServer.is_own_thread) as sampler:
+        started = time.monotonic()
+        xlearn.review_loader.load()
+        done = x.wait_for(lambda server: len(server.posted) >= materials, timeout=seconds + 60 + seconds * 0.2)
+        elapsed = time.monotonic() - started
+    xlearn.scheduler.stop()
+    xlearn.dispatcher.stop()
+
+    lags = []
+    for user_id in user_ids:
+        for material_id, material in xlearn.store.list_materials(user_id):
+            if material.get('last_posted_at') is not None:
+                lags.append(material['last_posted_at'].timestamp() - due[(user_id, material_id)])
+    return [Result.from_recorder(
+        'reviews', 'handle_review', recorder, elapsed, sampler,
+        completed=done,
+        posted=len(x.posted),
+        post_lag_p50_s=round(percentile(lags, 50), 3),
+        post_lag_p99_s=round(percentile(lags, 99), 3),
+        max_dispatch_lag_s=round(xlearn.scheduler.max_dispatch_lag, 3),
+        throttled=x.throttled,
+        dispatcher_throttled=xlearn.dispatcher.throttled,
+        dropped=xlearn.dispatcher.dropped,
+    )]
+
+
+def stream(service: Service, scale: float = 1.0, per_minute: float = 1000, seconds: float = 60, users: int = 100,
+           exact_share: float = 0.5, redelivered_share: float = 0.1) -> list[Result]:
+    """Replies to posted questions arriving on the filtered stream at `per_minute`, each answered with feedback.
+
+    `exact_share` of the answers match exactly and are graded locally; the rest go to the LLM.
+    `redelivered_share` of them arrive twice, as after a reconnect, and should still be answered once.
+    """
+    xlearn, x = service.xlearn, service.x
+    seconds = max(1.0, seconds * scale)
+    total = _scaled(per_minute * seconds / 60, 1)
+    user_ids = seed_users(xlearn, users)
+    questions = {}  # user_id -> (question tweet id, answer)
+    for i, user_id in enumerate(user_ids):
+        question, answer = f"Bench question {i}?", f"answer {i}"
+        material_id = xlearn.store.add_material(user_id, asdict(xlearn.QuestionMaterial(
+            type="question", question=question, answer=answer,
+            next_review_time=datetime.now(tz=xlearn.timezone) + timedelta(days=1),
+        )))
+        tweet = x.create_tweet(user_id, question)
+        xlearn.reply_index.mark_own(tweet['id'])
+        xlearn.reply_index.add(tweet['id'], xlearn.ReplyRoute(user_id, material_id, question, answer))
+        questions[user_id] = (tweet['id'], answer)
+    xlearn.add_initial_rules()
+
+    recorder = Recorder()
+    xlearn.stream_pipeline.handler = recorder.wrap(xlearn.stream_pipeline.handler)
+    listener = threading.Thread(target=xlearn.start_listening, name="bench-listener", daemon=True)
+    listener.start()
+    if not x.wait_for(lambda server: server.stream_count() > 0, timeout=30):
+        raise RuntimeError("The service never connected to the fake stream")
+
+    sent = {}  # reply tweet id -> time it was put on the stream
+    rng = random.Random(0)
+    with ResourceSampler(exclude=FakeXServer.is_own_thread) as sampler:
+        started = time.monotonic()
+        for i in range(total):
+            delay = started + i * 60 / per_minute - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            user_id = user_ids[i % len(user_ids)]
+            question_id, answer = questions[user_id]
+            text = answer if rng.random() < exact_share else f"I think it is {answer.split()[-1]} or so ({i})"
+            tweet = {
+                'id': x.next_id(),
+                'text': text,
+                'author_id': user_id,
+                'conversation_id': question_id,
+                'referenced_tweets': [{'type': 'replied_to', 'id': question_id}],
+            }
+            sent[tweet['id']] = time.time()
+            x.emit(tweet)
+            if rng.random() < redelivered_share:
+                x.emit(tweet)
+
+        def answered(server) -> list[float]:
+            return [posted_at - sent[tweet['referenced_tweets'][0]['id']] for posted_at, tweet in server.posted
+                    if tweet.get('referenced_tweets') and tweet['referenced_tweets'][0]['id'] in sent]
+
+        done = x.wait_for(lambda server: len(answered(server)) >= total, timeout=120 + seconds * 0.5)
+        elapsed = time.monotonic() - started
+    xlearn.stream_pipeline.stop()
+    reply_latencies = answered(x)
+    answered_ids = [tweet['referenced_tweets'][0]['id'] for _, tweet in x.posted
+                    if tweet.get('referenced_tweets') and tweet['referenced_tweets'][0]['id'] in sent]
+    return [Result.from_recorder(
+        'stream', 'start_listening', recorder, elapsed, sampler,
+        completed=done,
+        events=xlearn.stream_pipeline.received,
+        replies=len(reply_latencies),
+        duplicate_replies=len(answered_ids) - len(set(answered_ids)),
+        reply_p50_ms=round(percentile(reply_latencies, 50) * 1000, 1),
+        reply_p99_ms=round(percentile(reply_latencies, 99) * 1000, 1),
+        blocked_puts=xlearn.stream_pipeline.blocked_puts,
+        llm_calls=service.llm.calls,
+    )]
+
+
+def threads(service: Service, scale: float = 1.0, users: int = 20, turns: int = 40, words: int = 40,
+            others_every: int = 5) -> list[Result]:
+    """Conversations growing turn by turn: each user asks the bot in one thread, again and again.
+
+    Every round the users reply to the bot's last answer, which reaches the stream
+    as X would send it; every `others_every` rounds someone the stream does not
+    follow replies first, and the user answers them instead. Reports the reply
+    latency of the first and last rounds, searches made and the largest context.
+    """
+    from xlearn.importer import estimate_tokens
+
+    xlearn, x = service.xlearn, service.x
+    turns = _scaled(turns, scale)
+    user_ids = seed_users(xlearn, users)
+    xlearn.add_initial_rules()
+
+    recorder = Recorder()
+    searches, contexts, summaries = [], [], []
+    conversations, ai_utils = xlearn.conversations, xlearn.ai_utils
+    fetch, summarize, create_action = conversations.fetch, conversations.summarize, ai_utils.create_action
+
+    def counted_fetch(*args, **kwargs):
+        searches.append(kwargs.get('since_id'))
+        return fetch(*args, **kwargs)
+
+    def counted_summarize(*args):
+        summaries.append(1)
+        return summarize(*args)
+
+    def sized_create_action(context_tweets):
+        contexts.append(estimate_tokens(str(context_tweets)))
+        return create_action(context_tweets)
+
+    conversations.fetch, conversations.summarize = counted_fetch, counted_summarize
+    ai_utils.create_action = sized_create_action
+    listener = threading.Thread(target=xlearn.start_listening, name="bench-listener", daemon=True)
+    listener.start()
+    if not x.wait_for(lambda server: server.stream_count() > 0, timeout=30):
+        raise RuntimeError("The service never connected to the fake stream")
+
+    rng = random.Random(0)
+    last = {user_id: None for user_id in user_ids}  # the tweet each user replies to next
+    round_p50 = []
+    completed = True
+    with ResourceSampler(exclude=FakeXServer.is_own_thread) as sampler:
+        started = time.monotonic()
+        for turn in range(turns):
+            sent = {}  # request tweet id -> time it was put on the stream
+            for user_id in user_ids:
+                if last[user_id] is not None and turn % others_every == others_every - 1:
+                    last[user_id] = x.create_tweet('999', "Interesting thread!", last[user_id])['id']
+                text = " ".join(f"word{rng.randrange(1000)}" for _ in range(words))
+                request = x.create_tweet(user_id, f"@bench{user_id} how many materials? {text}", last[user_id])
+                sent[request['id']] = time.time()
+                x.emit(request)
+
+            def answered(server) -> dict:
+                return {tweet['referenced_tweets'][0]['id']: (posted_at, tweet) for posted_at, tweet in server.posted
+                        if tweet.get('referenced_tweets') and tweet['referenced_tweets'][0]['id'] in sent}
+
+            completed = x.wait_for(lambda server: len(answered(server)) >= len(sent), timeout=60) and completed
+            latencies = []
+            for request_id, (posted_at, reply) in answered(x).items():
+                latencies.append(posted_at - sent[request_id])
+                recorder.record(posted_at - sent[request_id])
+                last[reply['author_id']] = reply['id']
+                x.emit(reply)  # the bot's own reply is from the user's account, so the stream carries it
+            round_p50.append(percentile(latencies, 50))
+        elapsed = time.monotonic() - started
+    xlearn.stream_pipeline.stop()
+    conversations.fetch, conversations.summarize = fetch, summarize
+    ai_utils.create_action = create_action
+    ends = max(1, turns // 5)
+    return [Result.from_recorder(
+        'threads', 'respond_to_tweet', recorder, elapsed, sampler,
+        completed=completed,
+        turns=turns,
+        first_rounds_p50_ms=round(sum(round_p50[:ends]) / ends * 1000, 1),
+        last_rounds_p50_ms=round(sum(round_p50[-ends:]) / ends * 1000, 1),
+        searches=len(searches),
+        backfills=sum(since_id is not None for since_id in searches),
+        summaries=len(summaries),
+        max_context_tokens=max(contexts, default=0),
+        llm_calls=service.llm.calls,
+    )]
+
+
+async def _burst(url: str, requests: list[tuple[str, str, dict]], concurrency: int, recorder: Recorder,
+                 check=lambda response: response.is_success) -> list[httpx.Response]:
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    semaphore = asyncio.Semaphore(concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=600) as client:
+        async def send(method, path, kwargs):
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    response = await client.request(method, path, **kwargs)
+                except httpx.HTTPError:
+                    recorder.record(time.perf_counter() - start, failed=True)
+                    return None
+                recorder.record(time.perf_counter() - start, failed=not check(response))
+                return response
+        return await asyncio.gather(*(send(*request) for request in requests))
+
+
+def imports(service: Service, scale: float = 1.0, requests: int = 500, users: int = 10) -> list[Result]:
+    """A burst of `requests` concurrent POST /import calls for distinct pages."""
+    xlearn = service.xlearn
+    requests = _scaled(requests, scale)
+    user_ids = seed_users(xlearn, users)
+    calls = [('POST', '/import', {'json': {
+        'user_id': user_ids[i % len(user_ids)],
+        'url': f"https://example.com/articles/{i}",
+        'custom_prompt': "Focus on the numbers.",
+    }}) for i in range(requests)]
+
+    recorder = Recorder()
+    with serving(service.app) as url, ResourceSampler(exclude=FakeXServer.is_own_thread) as sampler:
+        started = time.monotonic()
+        responses = asyncio.run(_burst(url, calls, requests, recorder))
+        elapsed = time.monotonic() - started
+    cards = sum(len(response.json()['material_ids']) for response in responses
+                if response is not None and response.status_code == 202)
+    return [Result.from_recorder(
+        'imports', '/import', recorder, elapsed, sampler,
+        cards=cards,
+        llm_calls=service.llm.calls,
+        pages_fetched=service.x.pages_served,
+    )]
+
+
+def materials(service: Service, scale: float = 1.0, users: int = 20, materials_per_user: int = 5000,
+              requests: int = 2000, concurrency: int = 32, limit: int = 100) -> list[Result]:
+    """GET /materials paging through large collections; every fifth call revalidates with If-None-Match."""
+    xlearn = service.xlearn
+    materials_per_user, requests = _scaled(materials_per_user, scale), _scaled(requests, scale)
+    user_ids = seed_users(xlearn, users)
+    seed_materials(xlearn, user_ids, users * materials_per_user, datetime.now(tz=xlearn.timezone), timedelta(days=30))
+
+    recorder = Recorder()
+    not_modified = 0
+
+    async def walk(url: str, worker: int, count: int):
+        nonlocal not_modified
+        limits = httpx.Limits(max_connections=1, max_keepalive_connections=1)
+        async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60) as client:
+            user_id, cursor, params, etag = user_ids[worker % len(user_ids)], None, None, None
+            for i in range(count):
+                headers = {}
+                if (worker + i) % 5 == 4 and etag is not None:  # the previous page again, as a client polling for changes
+                    headers['If-None-Match'] = etag
+                else:
+                    params = {'user_id': user_id, 'limit': limit}
+                    if cursor:
+                        params['cursor'] = cursor
+                start = time.perf_counter()
+                response = await client.get('/materials', params=params, headers=headers)
+                recorder.record(time.perf_counter() - start, failed=response.status_code not in (200, 304))
+                if response.status_code == 304:
+                    not_modified += 1
+                    continue
+                etag = response.headers.get('ETag')
+                cursor = response.headers.get('X-Next-Cursor')
+                if cursor is None:  # start over with another user
+                    user_id = user_ids[(user_ids.index(user_id) + 1) % len(user_ids)]
+
+    async def run(url: str):
+        share, rest = divmod(requests, concurrency)
+        await asyncio.gather(*(walk(url, worker, share + (worker < rest)) for worker in range(concurrency)))
+
+    with serving(service.app) as url, ResourceSampler(exclude=FakeXServer.is_own_thread) as sampler:
+        started = time.monotonic()
+        asyncio.run(run(url))
+        elapsed = time.monotonic() - started
+    return [Result.from_recorder('materials', '/materials', recorder, elapsed, sampler, not_modified=not_modified)]
+
+
+def shards(service: Service, scale: float = 1.0, reviews: int = 3000, replies: int = 1500, seconds: float = 120,
+           workers: int = 3, shard_count: int = 32, lease_seconds: float = 6,
+           materials_per_user: int = 50) -> list[Result]:
+    """`workers` review and `workers` stream worker processes sharing out the users by shard lease, on one SQLite file.
+
+    A third of the way in one worker of each kind is killed, halfway a new one
+    joins and two thirds in another stops cleanly. Every review and every reply
+    should still be posted once; duplicates and misses count as errors.
+    """
+    xlearn, x = service.xlearn, service.x
+    reviews, replies, seconds = _scaled(reviews, scale), _scaled(replies, scale), max(30.0, seconds * scale)
+    path = os.path.join(tempfile.mkdtemp(prefix='xlearn-shards-'), 'shards.db')
+    store = xlearn.storage.SQLiteStore(path)
+    user_ids = seed_users(xlearn, math.ceil(reviews / materials_per_user), store=store)
+    # due from once the workers have shared out the shards
+    start = datetime.now(tz=xlearn.timezone) + timedelta(seconds=lease_seconds * 2)
+    due = seed_materials(xlearn, user_ids, reviews, start, timedelta(seconds=seconds), store=store)
+    due_by_text = {}  # review text without its count -> due time
+    for i, due_at in enumerate(sorted(due.values())):
+        due_by_text[f"Bench quote {i}" if i % 3 == 2 else f"Bench question {i}?"] = due_at
+    questions = {}  # user_id -> question tweet id, answered on the stream
+    routes = xlearn.ReplyIndex(store)
+    for user_id in user_ids:
+        material_id = store.add_material(user_id, asdict(xlearn.QuestionMaterial(
+            type="question", question="Bench stream question?", answer="yes",
+            next_review_time=datetime.now(tz=xlearn.timezone) + timedelta(days=1),
+        )))
+        tweet = x.create_tweet(user_id, "Bench stream question?")
+        routes.add(tweet['id'], xlearn.ReplyRoute(user_id, material_id, "Bench stream question?", "yes"))
+        questions[user_id] = tweet['id']
+
+    env = {
+        **os.environ,
+        'XLEARN_STORAGE': 'sqlite',
+        'XLEARN_SQLITE_PATH': path,
+        'SHARD_COUNT': str(shard_count),
+        'STREAM_REDUNDANT_CONNECTIONS': '1',  # the fake stream takes a connection per worker
+        'SHARD_LEASE_SECONDS': str(lease_seconds),
+        'SHARD_RENEW_SECONDS': str(lease_seconds / 6),
+        'SHARD_LEASE_MARGIN_SECONDS': str(lease_seconds / 3),
+        'REVIEW_REQUEST_POLL_SECONDS': '1',
+        'BENCH_LLM_LATENCY': str(service.llm.latency),
+    }
+    processes = {}
+
+    def spawn(role: str, number: int):
+        processes[(role, number)] = subprocess.Popen(
+            [sys.executable, '-m', 'bench.worker', role, x.url], env={**env, 'WORKER_ID': f"{role}-{number}"},
+        )
+
+    def signal_workers(number: int, signum: int):
+        for role in ('review', 'stream'):
+            processes[(role, number)].send_signal(signum)
+
+    for number in range(workers):
+        spawn('review', number)
+        spawn('stream', number)
+    if not x.wait_for(lambda server: server.stream_count() >= workers, timeout=60):
+        raise RuntimeError("The stream workers never connected to the fake stream")
+
+    events = [
+        (seconds / 3, lambda: signal_workers(0, signal.SIGKILL)),
+        (seconds / 2, lambda: [spawn(role, workers) for role in ('review', 'stream')]),
+        (seconds * 2 / 3, lambda: signal_workers(1, signal.SIGTERM)),
+    ]
+    sent = {}  # reply tweet id -> time it was put on the stream
+
+    def posted(server) -> tuple[dict, dict]:
+        """Times each review (by text) and each reply (by the tweet it answers) was posted."""
+        review_posts, reply_posts = {}, {}
+        for posted_at, tweet in server.posted:
+            in_reply_to = (tweet.get('referenced_tweets') or [{}])[0].get('id')
+            text = tweet['text'].rsplit("\n", 1)[0]
+            if in_reply_to in sent:
+                reply_posts.setdefault(in_reply_to, []).append(posted_at)
+            elif text in due_by_text:
+                review_posts.setdefault(text, []).append(posted_at)
+        return review_posts, reply_posts
+
+    def complete(server) -> bool:
+        review_posts, reply_posts = posted(server)
+        return len(review_posts) >= reviews and len(reply_posts) >= replies
+
+    with ResourceSampler(exclude=FakeXServer.is_own_thread) as sampler:
+        started = time.monotonic()
+        for i in range(replies):
+            while events and time.monotonic() - started >= events[0][0]:
+                events.pop(0)[1]()
+            delay = started + i * seconds / replies - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            user_id = user_ids[i % len(user_ids)]
+            tweet = {
+                'id': x.next_id(),
+                'text': "yes",
+                'author_id': user_id,
+                'conversation_id': questions[user_id],
+                'referenced_tweets': [{'type': 'replied_to', 'id': questions[user_id]}],
+            }
+            sent[tweet['id']] = time.time()
+            x.emit(tweet)
+        for _, event in events:
+            event()
+        done = x.wait_for(complete, timeout=seconds + lease_seconds * 4 + 60)
+        elapsed = time.monotonic() - started
+        time.sleep(lease_seconds)  # for late duplicates
+    for process in processes.values():
+        if process.poll() is None:
+            process.terminate()
+    for process in processes.values():
+        try:
+            process.wait(30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+    results = []
+    started_at = {'reviews': due_by_text, 'replies': sent}
+    for target, posts, expected in zip(('reviews', 'replies'), posted(x), (reviews, replies)):
+        recorder = Recorder()
+        for key, times in posts.items():
+            # from falling due or arriving on the stream to the first post
+            recorder.record(max(0.0, min(times) - started_at[target][key]))
+        duplicates = sum(len(times) - 1 for times in posts.values())
+        missing = expected - len(posts)
+        recorder.errors = duplicates + missing
+        results.append(Result.from_recorder('shards', target, recorder, elapsed, sampler, completed=done,
+                                            duplicates=duplicates, missing=missing, workers=len(processes)))
+    return results
+
+
+SCENARIOS = {
+    'reviews': reviews,
+    'stream': stream,
+    'threads': threads,
+    'imports': imports,
+    'materials': materials,
+    'shards': shards,
+}
@@ -0,0 +1,26 @@
+"""A review or stream worker process wired to a benchmark's fakes: `python -m bench.worker review|stream <x_url>`.
+
+The store and sharding come from the environment the benchmark sets, see scenarios.shards.
+"""
+import os
+import sys
+
+from bench.fakes import FakeAsyncOpenAI, route_x_api
+
+
+def main(argv=None):
+    role, x_url = argv or sys.argv[1:]
+    route_x_api(x_url)
+    from xlearn import ai_utils, review_worker, stream_worker
+    ai_utils.openai_client = FakeAsyncOpenAI(latency=float(os.getenv('BENCH_LLM_LATENCY', 0.8)))
+    ai_utils.use_xai_sdk = False
+    if role == 'review':
+        review_worker.main()
+    elif role == 'stream':
+        stream_worker.main()
+    else:
+        sys.exit(f"unknown role {role!r}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,65 +1,195 @@
 from typing import Tuple
 import json
+import logging
+import os
+import random
+import threading
 
-from dotenv import load_dotenv
-import asyncio
-import openai
 import asyncio
+import importlib.util
 
+from xlearn import metrics
+from xlearn.llm_cache import LLMCache
+from xlearn.grading import LocalGrader
 
-use_xai_sdk = False
-try:
-    import xai_sdk
-    use_xai_sdk = True
-    client = xai_sdk.Client()
-except:
-    print("XAI SDK not found. Using OpenAI API instead.")
-    
+logger = logging.getLogger(__name__)
 
+# the SDK clients are built on first use, so importing this module needs neither
+# the SDKs loaded nor their credentials set
+use_xai_sdk = importlib.util.find_spec('xai_sdk') is not None
+if not use_xai_sdk:
+    logger.info("XAI SDK not found. Using OpenAI API instead.")
+client = None
 
-openai_client = openai.Client()
+OPENAI_MODEL = os.getenv('OPENAI_MODEL', 'gpt-4-turbo')
+MAX_IN_FLIGHT = int(os.getenv('LLM_MAX_IN_FLIGHT', 16))
+LLM_TIMEOUT_SECONDS = float(os.getenv('LLM_TIMEOUT_SECONDS', 60))
+# xAI gets a shorter budget so a stuck sampler falls back to OpenAI quickly
+XAI_TIMEOUT_SECONDS = float(os.getenv('XAI_TIMEOUT_SECONDS', 20))
+LLM_MAX_RETRIES = int(os.getenv('LLM_MAX_RETRIES', 3))
 
-def chat(user_prompt: str) -> str:
+# set on first use; assign a compatible client beforehand to replace it
+openai_client = None
+
+# bump a version whenever its prompt template changes, so cached results are not reused
+FEEDBACK_PROMPT_VERSION = 1
+SUMMARY_PROMPT_VERSION = 1
+# clear-cut replies are graded locally, see grading.LocalGrader
+local_grader = LocalGrader(
+    correct_threshold=float(os.getenv('GRADER_CORRECT_THRESHOLD', 0.9)),
+    incorrect_threshold=float(os.getenv('GRADER_INCORRECT_THRESHOLD', 0.0)),
+    short_answer_tokens=int(os.getenv('GRADER_SHORT_ANSWER_TOKENS', 3)),
+)
+llm_cache = LLMCache(
+    max_entries=int(os.getenv('LLM_CACHE_SIZE', 10000)),
+    path=os.getenv('LLM_CACHE_PATH'),
+    ttl_seconds=float(os.getenv('LLM_CACHE_TTL_SECONDS', 7 * 24 * 3600)),
+    max_disk_entries=int(os.getenv('LLM_CACHE_DISK_SIZE', 100000)),
+)
+
+LLM_LATENCY = metrics.histogram('xlearn_llm_request_seconds', "LLM request latency, per attempt",
+                                ('provider', 'outcome'))
+LLM_FALLBACKS = metrics.counter('xlearn_llm_fallbacks_total', "xAI calls that fell back to OpenAI")
+metrics.counter('xlearn_llm_cache_lookups_total', "LLM memo cache lookups", ('result',), collect=lambda: {
+    ('memory_hit',): llm_cache.memory_hits, ('disk_hit',): llm_cache.disk_hits, ('miss',): llm_cache.misses,
+})
+metrics.counter('xlearn_local_grades_total', "Replies graded by the local grader", ('verdict',), collect=lambda: {
+    ('correct',): local_grader.graded_correct, ('incorrect',): local_grader.graded_incorrect,
+    ('deferred',): local_grader.deferred,
+})
+
+# Every LLM coroutine runs on one background event loop. The semaphore and the
+# async HTTP clients are bound to it, so async callers on other loops (FastAPI)
+# and sync callers on worker threads share the same in-flight limit.
+_loop = None
+_loop_lock = threading.Lock()
+_semaphore = None
+
+
+def _get_loop() -> asyncio.AbstractEventLoop:
+    global _loop, _semaphore
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="llm-loop", daemon=True).start()
+            _semaphore = asyncio.run_coroutine_threadsafe(_create_semaphore(), loop).result()
+            _loop = loop
+    return _loop
+
+
+async def _create_semaphore():
+    return asyncio.Semaphore(MAX_IN_FLIGHT)
+
+
+async def _on_llm_loop(coro):
+    loop = _get_loop()
+    if asyncio.get_running_loop() is loop:
+        return await coro
+    return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, loop))
+
+
+def _run_sync(coro):
+    return asyncio.run_coroutine_threadsafe(coro, _get_loop()).result()
+
+
+def _openai_client():
+    global openai_client
+    if openai_client is None:
+        import openai
+        # retries are done here, with jitter, so they count against the in-flight limit
+        openai_client = openai.AsyncOpenAI(max_retries=0)
+    return openai_client
+
+
+def _xai_client():
+    global client, use_xai_sdk
+    if client is None:
+        try:
+            import xai_sdk
+            client = xai_sdk.Client()
+        except Exception:
+            use_xai_sdk = False
+            logger.warning("Could not create the xAI client, using the OpenAI API instead", exc_info=True)
+            raise
+    return client
+
+
+def _is_retryable(e: Exception) -> bool:
+    import openai
+    if isinstance(e, (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+    return isinstance(e, openai.APIStatusError) and e.status_code >= 500
+
+
+async def _openai_complete(user_prompt: str, json_mode: bool = False, temperature: float | None = None) -> str:
+    kwargs = {}
+    if json_mode:
+        kwargs['response_format'] = {"type": "json_object"}
+    if temperature is not None:
+        kwargs['temperature'] = temperature
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        try:
+            async with _semaphore:
+                with metrics.timed(LLM_LATENCY, provider='openai'):
+                    response = await _openai_client().chat.completions.create(
+                        model=OPENAI_MODEL,
+                        messages=[
+                            {"role": "user", "content": user_prompt},
+                        ],
+                        timeout=LLM_TIMEOUT_SECONDS,
+                        **kwargs,
+                    )
+            return response.choices[0].message.content
+        except Exception as e:
+            if attempt == LLM_MAX_RETRIES or not _is_retryable(e):
+                raise
+            # full jitter keeps retries from a burst of 429s from lining up again
+            await asyncio.sleep(random.uniform(0, min(30, 2 ** attempt)))
+
+
+async def _xai_sample(prompt: str, ai_starter: str = "") -> str:
+    sampler = _xai_client().sampler
+    full_prompt = PROMPT.replace("HUMAN_PROMPT", prompt).replace("AI_STARTER", ai_starter)
+    answer = ""
+    async with _semaphore:
+        with metrics.timed(LLM_LATENCY, provider='xai'):
+            async for token in sampler.sample(prompt=full_prompt, max_len=1024, stop_tokens=["<|separator|>"], temperature=0.5, nucleus_p=0.95):
+                answer += token.token_str
+    return answer
+
+
+async def _achat(user_prompt: str) -> str:
     if use_xai_sdk:
         try:
-            conversation = client.chat.create_conversation()
-            response = conversation.add_response_no_stream(user_prompt)
-            response = response.message
+            return await asyncio.wait_for(_xai_sample(user_prompt), XAI_TIMEOUT_SECONDS)
         except Exception as e:
-            print(e)
-            response = openai_client.chat.completions.create(
-                model="gpt-4-turbo",
-                temperature=0,
-                messages=[
-                    {"role": "user", "content": user_prompt},
-                ],
-            )
-            response = response.choices[0].message.content
-    else:
-        response = openai_client.chat.completions.create(
-            model="gpt-4-turbo",
-            messages=[
-                {"role": "user", "content": user_prompt},
-            ],
-        )
-        response = response.choices[0].message.content
-    return response
+            LLM_FALLBACKS.inc()
+            logger.warning("xAI request failed, falling back to OpenAI", extra={'error': repr(e)})
+            return await _openai_complete(user_prompt, temperature=0)
+    return await _openai_complete(user_prompt)
 
 
-def chat_json(user_prompt: str) -> str:
+def _model_name() -> str:
+    return 'xai' if use_xai_sdk else OPENAI_MODEL
 
-    response = openai_client.chat.completions.create(
-        model="gpt-4-turbo",
-        messages=[
-            {"role": "user", "content": user_prompt},
-        ],
-        response_format={"type": "json_object"}
-    )
-    response = response.choices[0].message.content
-    json_response = json.loads(response)
-    return json_response
 
-def creat_feedback(question, correct_answer, user_answer)-> Tuple[bool, str]:
+async def achat(user_prompt: str) -> str:
+    return await _on_llm_loop(_achat(user_prompt))
+
+
+async def achat_json(user_prompt: str) -> dict:
+    response = await _on_llm_loop(_openai_complete(user_prompt, json_mode=True))
+    return json.loads(response)
+
+
+def chat(user_prompt: str) -> str:
+    return _run_sync(_achat(user_prompt))
+
+
+def chat_json(user_prompt: str) -> dict:
+    return _run_sync(achat_json(user_prompt))
+
+async def acreat_feedback(question, correct_answer, user_answer)-> Tuple[bool, str]:
     PROMPT = """Give a friendly and encouragin and concise feedback to the user's answer in under two sentences.
 The question is: QUESTION, and the correct answer is: CORRECT_ANSWER.
 The user's answer was: USER_ANSWER.
@@ -70,12 +200,32 @@ Your response must be json format of the following format.
 }
 Start your answer from immediately {, do not write ```json or anything else."""
 
+    local = local_grader.grade(question, correct_answer, user_answer)
+    if local is not None:
+        return local
+
+    cache_key = llm_cache.make_key('feedback', FEEDBACK_PROMPT_VERSION, _model_name(), question, correct_answer, user_answer)
+    cached = await llm_cache.aget(cache_key)
+    if cached is not None:
+        return cached["correct"], cached["feedback"]
+
     prompt = PROMPT.replace("QUESTION", question).replace("CORRECT_ANSWER", correct_answer).replace("USER_ANSWER", user_answer)
-    response = chat(prompt)
+    response = await achat(prompt)
     response = json.loads(response)
+    await llm_cache.aset(cache_key, {"correct": response["correct"], "feedback": response["feedback"]})
     return response["correct"], response["feedback"]
 
 
+def creat_feedback(question, correct_answer, user_answer)-> Tuple[bool, str]:
+    return _run_sync(acreat_feedback(question, correct_answer, user_answer))
+
+def creat_feedbacks(answers: list[tuple[str, str, str]]) -> list[Tuple[bool, str]]:
+    """creat_feedback for several (question, correct_answer, user_answer) at once, graded concurrently."""
+    async def grade_all():
+        return await asyncio.gather(*(acreat_feedback(*answer) for answer in answers))
+    return _run_sync(grade_all())
+
+
 PROMPT = """\
 This is a conversation between a human user and a highly intelligent AI. The AI's name is Grok and it makes every effort to truthfully answer a user's questions. It always responds politely but is not shy to use its vast knowledge in order to solve even the most difficult problems. The conversation begins.
 
@@ -83,42 +233,42 @@ Human: HUMAN_PROMPT<|separator|>
 
 AI: AI_STARTER
 """
-def create_import(response_data, user_prompt):
-    prompt = f"""Your tasks is to generate two  {response_data}. make a question answer pair in pure JSON format with no '''json''', take into account of this request {user_prompt}"""
-    processed_output = chat(prompt)
-    json_response = json.loads(processed_output)
-    return json_response
+
+CARDS_PROMPT_VERSION = 1
+
+async def acreate_cards(document_chunk: str, user_prompt: str, max_cards: int = 5) -> list[dict]:
+    cache_key = llm_cache.make_key('cards', CARDS_PROMPT_VERSION, OPENAI_MODEL, document_chunk, user_prompt, str(max_cards))
+    cached = await llm_cache.aget(cache_key)
+    if cached is not None:
+        return cached
+
+    prompt = f"""Create flashcards from the following part of a web page. Make at most {max_cards} question answer pairs about its most important facts, and none if it has nothing worth learning (navigation, ads, references).
+Take into account this request from the user: {user_prompt}
+
+PAGE:
+{document_chunk}
+
+Your response must be json of the following format.
+{{
+    "cards": [{{"question": str, "answer": str}}]
+}}"""
+    response = await achat_json(prompt)
+    cards = [
+        {"question": card["question"], "answer": card["answer"]}
+        for card in response.get("cards", [])[:max_cards]
+        if card.get("question") and card.get("answer")
+    ]
+    await llm_cache.aset(cache_key, cards)
+    return cards
 
 def run_prompt(prompt, ai_starter):
-    async def main_async(prompt, ai_starter):
-        # Assuming 'sampler' is an instance of a class with an async method 'sample'.
-        # Replace 'FakeSampler()' with your actual sampler instance.
-        client = xai_sdk.Client()
-        sampler = client.sampler
-        
-
-    
-        full_prompt = prompt.replace("HUMAN_PROMPT", prompt).replace("AI_STARTER", ai_starter)
-        answer = ""
-        async for token in sampler.sample(prompt=full_prompt, max_len=1024, stop_tokens=[""], temperature=0.5, nucleus_p=0.95):
-            answer += token.token_str
-        return answer
-
-    # Run the asynchronous function in the current event loop.
-    loop = asyncio.get_event_loop()
-    if loop.is_running():
-        # If the loop is already running, we create a new loop for this task.
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-    answer = loop.run_until_complete(main_async(prompt, ai_starter))
-    loop.close()
-    
-    return answer
+    return _run_sync(_xai_sample(prompt, ai_starter))
 
-def create_action(context_tweets: dict) -> dict:
+async def acreate_action(context_tweets: dict) -> dict:
     prompt = """You are a personal ChatBot operating on twitter. User adds materials they want to learn on our database(Ex. foreign language vocabularies, insipiring quotes).
 You use spaced repetition algorithm to periodically post tweets about these knowledge, and some of the tweets can take a form of a question. You recieved a request from one of the user.
 The request is recieved in the form of a reply to a tweet. The request might be related to the content of the replied tweet or a general request.
+In a long conversation, the earlier tweets are given as a summary first.
 Your job now is to take appropriate actions based on the request. The request is as follows:
 
 REFERENCE_TWEET_CONTENT
@@ -144,9 +294,34 @@ Actions
 }
 """
     prompt = prompt.replace("REFERENCE_TWEET_CONTENT", str(context_tweets))
-    print(prompt)
-    response = chat_json(prompt)
+    logger.debug("Action prompt", extra={'prompt': prompt})
+    response = await achat_json(prompt)
     return response
 
+
+def create_action(context_tweets: dict) -> dict:
+    return _run_sync(acreate_action(context_tweets))
+
+async def asummarize_conversation(summary: str | None, turns: list[dict], max_words: int = 150) -> str:
+    """Fold `turns` ([{'author', 'text'}], oldest first) into the running `summary` of a conversation."""
+    cache_key = llm_cache.make_key('summary', SUMMARY_PROMPT_VERSION, _model_name(), summary or '', str(turns),
+                                   str(max_words))
+    cached = await llm_cache.aget(cache_key)
+    if cached is not None:
+        return cached
+
+    prompt = f"""Summarize this Twitter conversation between a user and a study bot in at most {max_words} words.
+Keep what a later request could refer to: materials, questions and answers, and what the user asked for.
+Summary of the conversation so far: {summary or "(none)"}
+Newer tweets: {turns}
+Reply with the summary only."""
+    response = (await achat(prompt)).strip()
+    await llm_cache.aset(cache_key, response)
+    return response
+
+
+def summarize_conversation(summary: str | None, turns: list[dict], max_words: int = 150) -> str:
+    return _run_sync(asummarize_conversation(summary, turns, max_words))
+
 if __name__ == '__main__':
     print(creat_feedback("What's 1 + 1", "2", "I don't know"))
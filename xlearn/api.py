@@ -0,0 +1,15 @@
+"""The HTTP API on its own: `python -m xlearn.api`, the same as `uvicorn xlearn.main:app`.
+
+Reviews it schedules are handed to the review worker, see xlearn.service.
+"""
+import os
+
+import uvicorn
+
+
+def main():
+    uvicorn.run("xlearn.main:app", host=os.getenv('HOST', '0.0.0.0'), port=int(os.getenv('PORT', 8000)))
+
+
+if __name__ == "__main__":
+    main()
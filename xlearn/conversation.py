@@ -0,0 +1,157 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Callable
+
+from xlearn import metrics
+from xlearn.importer import estimate_tokens
+from xlearn.storage import Store
+
+logger = logging.getLogger(__name__)
+
+CONTEXTS = metrics.counter('xlearn_conversation_contexts_total', "Conversation contexts built for actions",
+                           ('source',))
+SEARCHES = metrics.counter('xlearn_conversation_searches_total', "Conversation searches made to build a context",
+                           ('reason',))
+SUMMARIES = metrics.counter('xlearn_conversation_summaries_total', "Older turns folded into a conversation summary",
+                            ('outcome',))
+
+
+def _tweet_id(tweet: dict) -> int:
+    # ids are numeric strings; later tweets have larger ids
+    return int(tweet['id'])
+
+
+def _turns(user_id: str, tweets: list[dict]) -> list[dict]:
+    # as create_action expects: 'bot' for the user's account, which the bot posts as, 'user' for anyone else
+    return [{'author': 'bot' if tweet['author_id'] == user_id else 'user', 'text': tweet['text']} for tweet in tweets]
+
+
+class ConversationCache:
+    """Keeps the context of the conversations the bot acts in, so a new request does not search the whole thread.
+
+    The first request in a conversation fetches it once with
+    `fetch(user_id, conversation_id, since_id=None)`. From then on, tweets
+    seen on the stream are appended by `observe(tweet)`, and a request only
+    searches again, from the newest tweet known, when the tweet it replies to
+    is missing, e.g. a reply by someone the stream does not follow.
+    Conversations are kept in memory and written to the store (kind
+    `conversations`) when used, for the next worker after a shard moves.
+
+    Once the tweets of a conversation pass `token_budget` tokens, the oldest
+    are folded into a rolling summary with `summarize(summary, turns)` until
+    they fit in half of it, so the summary is redone every few turns rather
+    than on each. Conversations not used for `idle_seconds` are dropped, from
+    memory as well as from the store. A user's events are handled one at a
+    time, so a conversation is never built by two callers at once.
+    """
+
+    KIND = 'conversations'
+
+    def __init__(self, store: Store, fetch: Callable[..., list[dict]], summarize: Callable[[str | None, list[dict]], str],
+                 token_budget: int = 2000, idle_seconds: float = 3600, max_size: int = 10000, purge_every: int = 1000):
+        self.store = store
+        self.fetch = fetch
+        self.summarize = summarize
+        self.token_budget = token_budget
+        self.idle_seconds = idle_seconds
+        self.max_size = max_size
+        self.purge_every = purge_every
+        # conversation_id -> (conversation, monotonic time used), least recently used first; a conversation is
+        # {'user_id', 'summary', 'summarized_id': newest tweet it covers, 'tweets': [{'id', 'author_id', 'text'}]}
+        self._conversations = OrderedDict()
+        self._lock = threading.Lock()
+        self._saved = 0
+
+    def observe(self, tweet: dict):
+        """Append a tweet from the stream to its conversation, when that one is in memory."""
+        conversation_id = tweet.get('conversation_id')
+        with self._lock:
+            entry = self._conversations.get(conversation_id)
+            if entry is not None:
+                self._add(entry[0], [tweet])
+
+    def context(self, user_id: str, tweet: dict, replied_to: str | None = None) -> tuple[str | None, list[dict]]:
+        """The summary of the older turns, if any, and the newer ones up to `tweet` as [{'author', 'text'}]."""
+        conversation_id = tweet['conversation_id']
+        conversation = self._get(conversation_id)
+        if conversation is None:
+            SEARCHES.inc(reason='new')
+            conversation = {'user_id': user_id, 'summary': None, 'summarized_id': None, 'tweets': []}
+            self._add(conversation, self.fetch(user_id, conversation_id))
+        elif replied_to is not None and not self._has(conversation, replied_to):
+            SEARCHES.inc(reason='gap')
+            since_id = conversation['tweets'][-1]['id'] if conversation['tweets'] else None
+            self._add(conversation, self.fetch(user_id, conversation_id, since_id=since_id))
+        self._add(conversation, [tweet])
+        self._fit(conversation)
+        self._save(conversation_id, conversation)
+        return conversation['summary'], _turns(user_id, conversation['tweets'])
+
+    def _get(self, conversation_id: str) -> dict | None:
+        now = time.monotonic()
+        with self._lock:
+            self._evict(now)
+            entry = self._conversations.get(conversation_id)
+        if entry is not None:
+            CONTEXTS.inc(source='memory')
+            return entry[0]
+        record = self.store.get_record(self.KIND, conversation_id)
+        CONTEXTS.inc(source='new' if record is None else 'store')
+        return record
+
+    def _has(self, conversation: dict, tweet_id: str) -> bool:
+        # a tweet already folded into the summary needs no search either
+        summarized_id = conversation['summarized_id']
+        return (summarized_id is not None and int(tweet_id) <= int(summarized_id)) or any(
+            turn['id'] == str(tweet_id) for turn in conversation['tweets'])
+
+    def _add(self, conversation: dict, tweets: list[dict]):
+        tweets_by_id = {turn['id']: turn for turn in conversation['tweets']}
+        for tweet in tweets:
+            # a backfill also returns the turns the summary covers
+            if not self._has(conversation, tweet['id']):
+                tweets_by_id[str(tweet['id'])] = {'id': str(tweet['id']), 'author_id': str(tweet['author_id']),
+                                                  'text': tweet['text']}
+        conversation['tweets'] = sorted(tweets_by_id.values(), key=_tweet_id)
+
+    def _tokens(self, conversation: dict) -> int:
+        return (estimate_tokens(conversation['summary'] or '')
+                + sum(estimate_tokens(turn['text']) for turn in conversation['tweets']))
+
+    def _fit(self, conversation: dict):
+        if self._tokens(conversation) <= self.token_budget:
+            return
+        tweets = conversation['tweets']
+        folded = []
+        while len(tweets) > 1 and self._tokens(conversation) > self.token_budget // 2:
+            folded.append(tweets.pop(0))
+        if not folded:
+            return
+        conversation['summarized_id'] = folded[-1]['id']
+        try:
+            conversation['summary'] = self.summarize(conversation['summary'], _turns(conversation['user_id'], folded))
+            SUMMARIES.inc(outcome='summarized')
+        except Exception:
+            # the folded turns are lost from the context, but the action can still be taken
+            logger.warning("Failed to summarize conversation turns", exc_info=True)
+            SUMMARIES.inc(outcome='dropped')
+
+    def _save(self, conversation_id: str, conversation: dict):
+        now = datetime.now(timezone.utc)
+        self.store.put_record(self.KIND, conversation_id, conversation, now + timedelta(seconds=self.idle_seconds))
+        with self._lock:
+            self._conversations[conversation_id] = (conversation, time.monotonic())
+            self._conversations.move_to_end(conversation_id)
+            while len(self._conversations) > self.max_size:
+                self._conversations.popitem(last=False)
+        self._saved += 1
+        if self._saved % self.purge_every == 0:
+            self.store.purge_expired_records(self.KIND, now)
+
+    def _evict(self, now: float):
+        # least recently used first, so idle conversations are at the front
+        while self._conversations and next(iter(self._conversations.values()))[1] <= now - self.idle_seconds:
+            self._conversations.popitem(last=False)
@@ -0,0 +1,96 @@
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Callable
+
+from xlearn import metrics
+from xlearn.storage import Store
+
+DUPLICATES = metrics.counter('xlearn_duplicates_dropped_total', "Events dropped as already handled",
+                             ('kind', 'tier'))
+
+
+class Deduplicator:
+    """Lets each event through once, so a duplicate is dropped before it costs any API or LLM call.
+
+    `claim(key)` is true for the first caller only. Claims are records in the
+    store (kind `kind`) taken with `Store.swap_record`, so two processes that
+    get the same event cannot both handle it, and `done(key)` keeps them for
+    `ttl_hours`. Keys seen lately are also kept in memory for `window_seconds`
+    (at most `max_size` of them), which answers redeliveries after a reconnect
+    without a store read.
+
+    A claim that was never done is taken over once its owner is gone, e.g. a
+    worker that died mid-event, so the work is redone rather than lost: when
+    `alive(owner)` is false, or when it is this worker's own id but not one of
+    the claims in memory, i.e. left by an earlier run. By default no other
+    owner counts as alive. `release(key)` gives a claim up when handling
+    failed, so a retry can go through.
+    """
+
+    def __init__(self, store: Store, kind: str, owner: str, ttl_hours: float = 24, window_seconds: float = 3600,
+                 max_size: int = 100000, purge_every: int = 1000, alive: Callable[[str], bool] | None = None):
+        self.store = store
+        self.kind = kind
+        self.owner = owner
+        self.ttl = timedelta(hours=ttl_hours)
+        self.window_seconds = window_seconds
+        self.max_size = max_size
+        self.purge_every = purge_every
+        self.alive = alive or (lambda owner: False)
+        self._recent = OrderedDict()  # key -> monotonic time it was seen, oldest first
+        self._lock = threading.Lock()
+        self._done = 0
+
+    def claim(self, key: str) -> bool:
+        key = str(key)
+        if self._seen(key):
+            DUPLICATES.inc(kind=self.kind, tier='memory')
+            return False
+        mine = {'owner': self.owner, 'done': False}
+        expires_at = datetime.now(timezone.utc) + self.ttl
+        claimed = self.store.swap_record(self.kind, key, None, mine, expires_at)
+        if not claimed:
+            record = self.store.get_record(self.kind, key)
+            if record is None or self._abandoned(record):
+                claimed = self.store.swap_record(self.kind, key, record, mine, expires_at)
+        if claimed:
+            self._remember(key)
+        else:
+            DUPLICATES.inc(kind=self.kind, tier='store')
+        return claimed
+
+    def done(self, key: str):
+        now = datetime.now(timezone.utc)
+        self.store.put_record(self.kind, str(key), {'owner': self.owner, 'done': True}, now + self.ttl)
+        self._remember(str(key))
+        self._done += 1
+        if self._done % self.purge_every == 0:
+            self.store.purge_expired_records(self.kind, now)
+
+    def release(self, key: str):
+        with self._lock:
+            self._recent.pop(str(key), None)
+        self.store.delete_record(self.kind, str(key))
+
+    def _abandoned(self, record: dict) -> bool:
+        if record['done']:
+            return False
+        # our own claims of this run are in memory, so one found in the store is from an earlier run
+        return record['owner'] == self.owner or not self.alive(record['owner'])
+
+    def _seen(self, key: str) -> bool:
+        with self._lock:
+            seen_at = self._recent.get(key)
+            return seen_at is not None and seen_at > time.monotonic() - self.window_seconds
+
+    def _remember(self, key: str):
+        now = time.monotonic()
+        with self._lock:
+            self._recent[key] = now
+            self._recent.move_to_end(key)
+            # oldest first, so the window is kept by trimming the front
+            while self._recent and (len(self._recent) > self.max_size
+                                    or next(iter(self._recent.values())) <= now - self.window_seconds):
+                self._recent.popitem(last=False)
@@ -0,0 +1,33 @@
+import re
+
+# "1. answer", "2) answer" or "3: answer", on separate lines or inline
+_NUMBERED = re.compile(r"(?:^|\s)(\d{1,3})[.):]\s+(.*?)(?=\s+\d{1,3}[.):]\s|\Z)", re.S)
+
+MAX_TWEET_LENGTH = 270  # X weighs some characters double, keep a margin
+
+
+def pack_lines(lines: list[str], header: str = "", max_length: int = MAX_TWEET_LENGTH) -> list[str]:
+    """Greedily pack lines into tweet-sized texts, `header` first; lines that never fit are cut."""
+    texts = []
+    current = header
+    for line in lines:
+        line = line[:max_length]
+        if current and len(current) + 1 + len(line) > max_length:
+            texts.append(current)
+            current = line
+        else:
+            current = f"{current}\n{line}" if current else line
+    if current:
+        texts.append(current)
+    return texts
+
+
+def digest_parts(items: list[dict], max_length: int = MAX_TWEET_LENGTH) -> list[str]:
+    """Texts of the thread for numbered digest items ({"number", "text"})."""
+    cards = "1 card" if len(items) == 1 else f"{len(items)} cards"
+    header = f"Review digest ({cards}). Reply with numbered answers, e.g. \"1. ...\""
+    return pack_lines([f"{item['number']}. {item['text']}" for item in items], header, max_length)
+
+
+def parse_numbered_answers(text: str) -> dict[int, str]:
+    return {int(number): answer.strip() for number, answer in _NUMBERED.findall(text) if answer.strip()}
@@ -0,0 +1,336 @@
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, asdict
+from typing import Callable
+
+import requests
+import tweepy
+
+from xlearn.storage import Store
+
+logger = logging.getLogger(__name__)
+
+REPLY = 0
+REVIEW = 1
+
+
+class TokenBucket:
+    """`limit` tokens refilled evenly over `window` seconds.
+
+    X's rate limit headers can drain it early or block it until their reset time.
+    """
+
+    def __init__(self, limit: int, window: float):
+        self.capacity = limit
+        self.rate = limit / window
+        self.tokens = float(limit)
+        self.updated = time.time()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.blocked_until and now >= self.blocked_until:
+            # X's window has reset, so its whole quota is back
+            self.tokens = self.capacity
+            self.blocked_until = 0.0
+
+    def delay(self, now: float) -> float:
+        """Seconds until a token is available."""
+        self._refill(now)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def observe(self, remaining: int, reset_at: float | None):
+        self.tokens = min(self.tokens, remaining)
+        if remaining <= 0 and reset_at is not None:
+            self.blocked_until = max(self.blocked_until, reset_at)
+
+
+@dataclass
+class PostJob:
+    key: str
+    user_id: str
+    text: str
+    kind: str
+    priority: int = REVIEW
+    in_reply_to: str | None = None
+    context: dict = field(default_factory=dict)
+    attempts: int = 0
+
+
+class TweetDispatcher:
+    """Posts every outbound tweet within X's per-user and per-app limits.
+
+    Jobs are persisted as store records until they are posted, so throttled or
+    failing posts are delayed rather than lost, and `recover()` re-queues them
+    after a restart. Ready replies go out before ready reviews. A 429 never uses
+    up a job's attempts; server and network errors are retried with jittered
+    backoff up to `max_attempts`, other client errors drop the job.
+
+    What happens after a post is decided by the handler registered for the job's
+    kind, called as handler(job, tweet_id) from a worker thread; a dropped job
+    is passed to its kind's on_drop(job, error) instead.
+
+    Jobs for which `accept(job)` is false when their turn comes are left in the
+    store for the worker that owns their user, see sharding.ShardLeases.
+
+    A 401 calls `invalidate(user_id)` and posts once more with a fresh client,
+    since another process may have stored a new token after the client was
+    built; a second 401 drops the job.
+    """
+
+    KIND = 'outbox'
+    THROTTLED_RETRY_SECONDS = 60  # for a 429 without a reset header
+
+    def __init__(self, store: Store, client_for: Callable[[str], tweepy.Client], max_workers: int = 4,
+                 user_limit: int = 100, user_window: float = 900, app_limit: int = 10000,
+                 app_window: float = 86400, max_attempts: int = 8,
+                 invalidate: Callable[[str], None] | None = None):
+        self.store = store
+        self.client_for = client_for
+        self.invalidate = invalidate
+        self.max_workers = max_workers
+        self.user_limit = user_limit
+        self.user_window = user_window
+        self.max_attempts = max_attempts
+        self._app_bucket = TokenBucket(app_limit, app_window)
+        self._user_buckets = {}
+        self._handlers = {}
+        self._drop_handlers = {}
+        self.accept = lambda job: True
+        self._jobs = {}  # key -> job, queued or posting
+        self._posting = set()
+        self._ready = []  # (priority, seq, key)
+        self._delayed = []  # (not_before, seq, key)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._slots = threading.BoundedSemaphore(max_workers)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tweet-dispatch")
+        self._thread = None
+        self._stopped = False
+        self.posted = 0
+        self.throttled = 0
+        self.retried = 0
+        self.dropped = 0
+
+    def register(self, kind: str, handler: Callable[[PostJob, str], None],
+                 on_drop: Callable[[PostJob, Exception], None] | None = None):
+        self._handlers[kind] = handler
+        if on_drop is not None:
+            self._drop_handlers[kind] = on_drop
+
+    def submit(self, user_id: str, text: str, kind: str, priority: int = REVIEW, in_reply_to: str | None = None,
+               context: dict | None = None, key: str | None = None) -> str:
+        """Queue a post and return its key; a key that is already queued is left as it is."""
+        job = PostJob(key or f"{kind}_{time.time_ns()}_{random.getrandbits(32):08x}", user_id, text, kind,
+                      priority, in_reply_to, context or {})
+        with self._cond:
+            if job.key in self._jobs:
+                return job.key
+            self._jobs[job.key] = job
+        self.store.put_record(self.KIND, job.key, asdict(job))
+        self._enqueue(job, 0.0)
+        return job.key
+
+    def recover(self, kinds: tuple[str, ...] | None = None, accept: Callable[[PostJob], bool] | None = None) -> int:
+        """Queue every post persisted by an earlier run, or only those of `kinds` that `accept` picks."""
+        count = 0
+        for key, data in self.store.list_records(self.KIND):
+            if kinds is not None and data['kind'] not in kinds:
+                continue
+            job = PostJob(**data)
+            if accept is not None and not accept(job):
+                continue
+            with self._cond:
+                if key in self._jobs:
+                    continue
+                self._jobs[key] = job
+            self._enqueue(job, 0.0)
+            count += 1
+        return count
+
+    def release(self, predicate: Callable[[PostJob], bool], timeout: float = 30) -> int:
+        """Forget the queued jobs `predicate` picks, keeping their records, and wait for those being posted."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            keys = [key for key, job in self._jobs.items() if key not in self._posting and predicate(job)]
+            for key in keys:
+                del self._jobs[key]
+            while any(predicate(self._jobs[key]) for key in self._posting if key in self._jobs):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+        return len(keys)
+
+    def is_queued(self, key: str) -> bool:
+        return key in self._jobs
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._jobs)
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue_depth,
+            "posted": self.posted,
+            "throttled": self.throttled,
+            "retried": self.retried,
+            "dropped": self.dropped,
+            "app_tokens": self._app_bucket.tokens,
+        }
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self._executor.shutdown(wait=False)
+
+    def _enqueue(self, job: PostJob, not_before: float):
+        with self._cond:
+            if not_before > time.time():
+                heapq.heappush(self._delayed, (not_before, next(self._seq), job.key))
+            else:
+                heapq.heappush(self._ready, (job.priority, next(self._seq), job.key))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="tweet-dispatcher", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def _user_bucket(self, user_id: str) -> TokenBucket:
+        bucket = self._user_buckets.get(user_id)
+        if bucket is None:
+            bucket = self._user_buckets[user_id] = TokenBucket(self.user_limit, self.user_window)
+        return bucket
+
+    def _next_ready(self, now: float) -> PostJob | None:
+        while self._delayed and self._delayed[0][0] <= now:
+            _, seq, key = heapq.heappop(self._delayed)
+            if key in self._jobs:  # else released
+                heapq.heappush(self._ready, (self._jobs[key].priority, seq, key))
+        while self._ready:
+            _, seq, key = heapq.heappop(self._ready)
+            job = self._jobs.get(key)
+            if job is None:
+                continue
+            delay = max(self._app_bucket.delay(now), self._user_bucket(job.user_id).delay(now))
+            if delay > 0:
+                heapq.heappush(self._delayed, (now + delay, seq, key))
+                continue
+            self._app_bucket.take(now)
+            self._user_bucket(job.user_id).take(now)
+            self._posting.add(key)
+            return job
+        return None
+
+    def _run(self):
+        while True:
+            self._slots.acquire()
+            with self._cond:
+                while True:
+                    if self._stopped:
+                        self._slots.release()
+                        return
+                    job = self._next_ready(time.time())
+                    if job is not None:
+                        break
+                    self._cond.wait(self._delayed[0][0] - time.time() if self._delayed else None)
+            try:
+                self._executor.submit(self._post, job)
+            except RuntimeError:  # executor shut down (stop() or interpreter exit)
+                self._slots.release()
+                return
+
+    def _observe(self, user_id: str, headers):
+        user_bucket = self._user_bucket(user_id)
+        for prefix, bucket in (('x-rate-limit', user_bucket), ('x-user-limit-24hour', user_bucket),
+                               ('x-app-limit-24hour', self._app_bucket)):
+            remaining = headers.get(f'{prefix}-remaining')
+            if remaining is None:
+                continue
+            reset_at = headers.get(f'{prefix}-reset')
+            with self._cond:
+                bucket.observe(int(remaining), float(reset_at) if reset_at else None)
+
+    def _post(self, job: PostJob):
+        try:
+            if not self.accept(job):
+                with self._cond:
+                    self._jobs.pop(job.key, None)
+                return
+            payload = {'text': job.text}
+            if job.in_reply_to:
+                payload['reply'] = {'in_reply_to_tweet_id': job.in_reply_to}
+            try:
+                response = self.client_for(job.user_id).request('POST', '/2/tweets', json=payload)
+            except tweepy.Unauthorized:
+                if self.invalidate is None:
+                    raise
+                self.invalidate(job.user_id)
+                response = self.client_for(job.user_id).request('POST', '/2/tweets', json=payload)
+            self._observe(job.user_id, response.headers)
+            tweet_id = response.json()['data']['id']
+        except tweepy.TooManyRequests as e:
+            self.throttled += 1
+            self._observe(job.user_id, e.response.headers)
+            with self._cond:
+                blocked_until = max(self._app_bucket.blocked_until, self._user_bucket(job.user_id).blocked_until)
+            now = time.time()
+            self._enqueue(job, blocked_until if blocked_until > now else now + self.THROTTLED_RETRY_SECONDS)
+        except (tweepy.TwitterServerError, requests.RequestException) as e:
+            job.attempts += 1
+            if job.attempts >= self.max_attempts:
+                self._drop(job, e)
+            else:
+                self.retried += 1
+                self.store.put_record(self.KIND, job.key, asdict(job))
+                self._enqueue(job, time.time() + self._backoff(job.attempts))
+        except Exception as e:  # other 4xx, unknown user: retrying would not help
+            self._drop(job, e)
+        else:
+            self.posted += 1
+            self._finish(job)
+            handler = self._handlers.get(job.kind)
+            if handler is not None:
+                try:
+                    handler(job, tweet_id)
+                except Exception:
+                    logger.exception("Handler for posted tweet failed",
+                                     extra={'kind': job.kind, 'key': job.key, 'tweet_id': tweet_id})
+        finally:
+            with self._cond:
+                self._posting.discard(job.key)
+                self._cond.notify_all()
+            self._slots.release()
+
+    @staticmethod
+    def _backoff(attempt: int) -> float:
+        return random.uniform(0, min(900, 2 ** attempt))
+
+    def _drop(self, job: PostJob, error: Exception):
+        self.dropped += 1
+        logger.error("Dropping post", extra={'kind': job.kind, 'key': job.key, 'user_id': job.user_id,
+                                             'attempts': job.attempts, 'error': repr(error)})
+        self._finish(job)
+        on_drop = self._drop_handlers.get(job.kind)
+        if on_drop is not None:
+            try:
+                on_drop(job, error)
+            except Exception:
+                logger.exception("Drop handler failed", extra={'kind': job.kind, 'key': job.key})
+
+    def _finish(self, job: PostJob):
+        self.store.delete_record(self.KIND, job.key)
+        with self._cond:
+            self._jobs.pop(job.key, None)
@@ -0,0 +1,159 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+from urllib import parse
+
+import httpx
+
+# tracking parameters that never change the page content
+_IGNORED_PARAMS = {'fbclid', 'gclid', 'mc_cid', 'mc_eid', 'ref_src'}
+_DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+Upstream = Callable[[str, dict], Awaitable[httpx.Response]]
+
+
+class FetchError(Exception):
+    def __init__(self, url: str, status_code: int | None, reason: str | None = None):
+        super().__init__(f"Fetching {url} failed with " + (reason or f"HTTP {status_code}"))
+        self.url = url
+        self.status_code = status_code  # None when no response came back
+
+
+def normalize_url(url: str) -> str:
+    """Cache key for a URL: the same for every spelling of the same page, and never fetched itself."""
+    url = url.strip()
+    if '://' not in url:
+        url = f"https://{url}"  # "example.com/foo" would otherwise parse as a path without a host
+    parts = parse.urlsplit(url)
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').lower()
+    if parts.port and parts.port != _DEFAULT_PORTS.get(scheme):
+        host = f"{host}:{parts.port}"
+    query = sorted(
+        (key, value) for key, value in parse.parse_qsl(parts.query, keep_blank_values=True)
+        if not key.startswith('utm_') and key not in _IGNORED_PARAMS
+    )
+    return parse.urlunsplit((scheme, host, parts.path or '/', parse.urlencode(query), ''))
+
+
+def reader_upstream(http_client: httpx.AsyncClient, base_url: str | None = None) -> Upstream:
+    """Upstream that converts pages to markdown through the r.jina.ai reader (or READER_BASE_URL)."""
+    base_url = base_url or os.getenv('READER_BASE_URL', 'https://r.jina.ai/')
+
+    async def fetch(url: str, headers: dict) -> httpx.Response:
+        return await http_client.get(base_url + url, headers=headers)
+
+    return fetch
+
+
+@dataclass
+class _Entry:
+    text: str
+    etag: str | None
+    last_modified: str | None
+    expires_at: float
+
+
+class ContentFetcher:
+    """Cache of fetched pages keyed by normalized URL; the URL fetched is the one asked for.
+
+    Fresh entries are served from memory; stale ones are revalidated with
+    If-None-Match/If-Modified-Since. Concurrent fetches of the same URL share a
+    single upstream request. The cache is bounded by total size with LRU
+    eviction, and pages larger than `max_entry_bytes` are never cached.
+    """
+
+    def __init__(self, upstream: Upstream, ttl_seconds: float = 3600, max_bytes: int = 64 * 1024 * 1024,
+                 max_entry_bytes: int = 4 * 1024 * 1024):
+        self.upstream = upstream
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.size = 0
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._entries = OrderedDict()
+        self._in_flight = {}
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "hits": self.hits,
+            "revalidated": self.revalidated,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+        }
+
+    async def fetch(self, url: str) -> str:
+        key = normalize_url(url)
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires_at > time.monotonic():
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry.text
+
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None:
+            self.coalesced += 1
+            return await asyncio.shield(in_flight)
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            text = await self._fetch_upstream(key, url.strip(), entry)
+            future.set_result(text)
+            return text
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # mark retrieved when nobody else was waiting
+            raise
+        finally:
+            del self._in_flight[key]
+
+    async def _fetch_upstream(self, key: str, url: str, entry: _Entry | None) -> str:
+        headers = {}
+        if entry is not None:
+            if entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                headers['If-Modified-Since'] = entry.last_modified
+        try:
+            response = await self.upstream(url, headers)
+        except httpx.HTTPError as e:
+            raise FetchError(url, None, type(e).__name__) from e
+
+        if response.status_code == 304 and entry is not None:
+            self.revalidated += 1
+            entry.expires_at = time.monotonic() + self.ttl_seconds
+            self._entries.move_to_end(key)
+            return entry.text
+        if response.status_code != 200:
+            raise FetchError(url, response.status_code)
+
+        self.misses += 1
+        text = response.text
+        self._store(key, _Entry(
+            text=text,
+            etag=response.headers.get('etag'),
+            last_modified=response.headers.get('last-modified'),
+            expires_at=time.monotonic() + self.ttl_seconds,
+        ))
+        return text
+
+    def _store(self, key: str, entry: _Entry):
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old.text)
+        if len(entry.text) > self.max_entry_bytes:
+            return
+        self._entries[key] = entry
+        self.size += len(entry.text)
+        while self.size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= len(evicted.text)
@@ -0,0 +1,127 @@
+import re
+import threading
+import unicodedata
+from typing import Tuple
+
+# replies on X start with the handles being replied to
+_LEADING_MENTIONS = re.compile(r"^(\s*@\w+)+")
+_URLS = re.compile(r"https?://\S+")
+_NUMBER = re.compile(r"^-?\d+(\.\d+)?$")
+# punctuation that is part of a number: a leading minus sign and a decimal point
+_NUMBER_MARKS = re.compile(r"(?<![\w.])-(?=\d)|(?<=\d)\.(?=\d)")
+_DIGITS = re.compile(r"-?\d+(?:\.\d+)?")
+
+DONT_KNOW = {
+    "", "?", "idk", "i dont know", "i do not know", "dont know", "no idea", "not sure", "pass", "skip",
+    "わからない", "分からない",
+}
+
+CORRECT_FEEDBACK = "Correct! The answer is: {answer}"
+INCORRECT_FEEDBACK = "Not quite. The answer is: {answer}"
+
+
+def normalize_answer(text: str) -> str:
+    """Fold width, case and accents, drop mentions, links and punctuation outside numbers, collapse whitespace."""
+    text = _URLS.sub(" ", _LEADING_MENTIONS.sub("", text)).replace("'", "").replace("\u2019", "")
+    text = unicodedata.normalize("NFKD", unicodedata.normalize("NFKC", text)).replace("\u2212", "-")
+    text = "".join(c for c in text if not unicodedata.combining(c)).casefold()
+    kept = {match.start() for match in _NUMBER_MARKS.finditer(text)}
+    text = "".join(" " if unicodedata.category(c)[0] in "PS" and i not in kept else c for i, c in enumerate(text))
+    return " ".join(text.split())
+
+
+def edit_similarity(a: str, b: str) -> float:
+    """1 - Levenshtein distance / length of the longer string."""
+    if a == b:
+        return 1.0
+    if not a or not b:
+        return 0.0
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        previous = current
+    return 1 - previous[-1] / max(len(a), len(b))
+
+
+def token_set_similarity(a: str, b: str) -> float:
+    tokens_a, tokens_b = set(a.split()), set(b.split())
+    if not tokens_a or not tokens_b:
+        return 0.0
+    return len(tokens_a & tokens_b) / len(tokens_a | tokens_b)
+
+
+def _scripts(text: str) -> set:
+    # first word of the Unicode name is the script for letters: LATIN, CJK, HIRAGANA, ...
+    return {unicodedata.name(c, "?").split()[0] for c in text if c.isalpha()}
+
+
+class LocalGrader:
+    """Grades clear-cut replies without the LLM.
+
+    Returns (correct, feedback) when the reply is blank, an explicit "don't
+    know", an exact match, a near-exact match of a short answer with as many
+    words and the same numbers, or a different number. With
+    incorrect_threshold > 0, short answers in the same script that share almost
+    nothing with the expected one are also marked wrong; that is off by default
+    because synonyms and translations look the same. Anything else returns None
+    and should go to the LLM.
+    """
+
+    def __init__(self, correct_threshold: float = 0.9, incorrect_threshold: float = 0.0,
+                 short_answer_tokens: int = 3):
+        self.correct_threshold = correct_threshold
+        self.incorrect_threshold = incorrect_threshold
+        self.short_answer_tokens = short_answer_tokens
+        self.graded_correct = 0
+        self.graded_incorrect = 0
+        self.deferred = 0
+        self._lock = threading.Lock()
+
+    @property
+    def llm_calls_avoided(self) -> int:
+        return self.graded_correct + self.graded_incorrect
+
+    def stats(self) -> dict:
+        return {
+            "graded_correct": self.graded_correct,
+            "graded_incorrect": self.graded_incorrect,
+            "deferred": self.deferred,
+            "llm_calls_avoided": self.llm_calls_avoided,
+        }
+
+    def grade(self, question: str, correct_answer: str, user_answer: str) -> Tuple[bool, str] | None:
+        verdict = self._verdict(normalize_answer(correct_answer), normalize_answer(user_answer))
+        with self._lock:
+            if verdict is None:
+                self.deferred += 1
+                return None
+            if verdict:
+                self.graded_correct += 1
+            else:
+                self.graded_incorrect += 1
+        template = CORRECT_FEEDBACK if verdict else INCORRECT_FEEDBACK
+        return verdict, template.format(answer=correct_answer)[:280]
+
+    def _verdict(self, expected: str, given: str) -> bool | None:
+        if given in DONT_KNOW:
+            return False
+        if not expected:
+            return None
+        if given == expected:
+            return True
+        if _NUMBER.match(expected) and _NUMBER.match(given):
+            return float(expected) == float(given)
+        similarity = edit_similarity(expected, given)
+        short = max(len(expected.split()), len(given.split())) <= self.short_answer_tokens
+        # a typo in a short answer is fine, but in a longer one a single changed or added word ("east" for
+        # "west", "not") can reverse its meaning, and in a number ("1919" for "1918") it is wrong: the LLM decides
+        if (short and similarity >= self.correct_threshold and len(expected.split()) == len(given.split())
+                and _DIGITS.findall(expected) == _DIGITS.findall(given)):
+            return True
+        # numbers can be spelled out ("2" vs "two"), so only mismatched words count as confidently wrong
+        spelled = any(c.isdigit() for c in expected + given)
+        if short and not spelled and _scripts(expected) == _scripts(given) and max(similarity, token_set_similarity(expected, given)) < self.incorrect_threshold:
+            return False
+        return None
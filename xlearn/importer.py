@@ -0,0 +1,165 @@
+import asyncio
+import re
+from typing import AsyncIterator
+
+from xlearn import ai_utils
+from xlearn.grading import normalize_answer, edit_similarity
+
+_HEADING = re.compile(r"^#{1,6}\s")
+_SENTENCE_END = re.compile(r"(?<=[.!?。！？])\s+")
+
+
+def estimate_tokens(text: str) -> int:
+    # roughly four characters per token for English; good enough for budgeting
+    return len(text) // 4 + 1
+
+
+def _split_long(paragraph: str, token_budget: int) -> list[str]:
+    pieces = []
+    current = ""
+    for sentence in _SENTENCE_END.split(paragraph):
+        while estimate_tokens(sentence) > token_budget:
+            cut = token_budget * 4
+            pieces.append(sentence[:cut])
+            sentence = sentence[cut:]
+        if current and estimate_tokens(current + " " + sentence) > token_budget:
+            pieces.append(current)
+            current = ""
+        current = f"{current} {sentence}".strip()
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+def split_document(text: str, token_budget: int = 1500) -> list[str]:
+    """Split markdown into chunks of at most `token_budget` tokens.
+
+    Sections start at headings and are packed paragraph by paragraph; each chunk
+    repeats its section heading so the model knows what it is reading.
+    """
+    sections = []
+    heading, paragraphs, paragraph = "", [], []
+    for line in text.splitlines():
+        if _HEADING.match(line) or not line.strip():
+            if paragraph:
+                paragraphs.append("\n".join(paragraph))
+                paragraph = []
+            if _HEADING.match(line):
+                if paragraphs:
+                    sections.append((heading, paragraphs))
+                heading, paragraphs = line.strip(), []
+        else:
+            paragraph.append(line)
+    if paragraph:
+        paragraphs.append("\n".join(paragraph))
+    if paragraphs:
+        sections.append((heading, paragraphs))
+
+    chunks = []
+    for heading, paragraphs in sections:
+        budget = max(1, token_budget - estimate_tokens(heading))
+        current = []
+        for paragraph in paragraphs:
+            for piece in _split_long(paragraph, budget) if estimate_tokens(paragraph) > budget else [paragraph]:
+                if current and estimate_tokens("\n\n".join(current + [piece])) > budget:
+                    chunks.append("\n\n".join(filter(None, [heading] + current)))
+                    current = []
+                current.append(piece)
+        if current:
+            chunks.append("\n\n".join(filter(None, [heading] + current)))
+    return chunks
+
+
+def _trigrams(text: str) -> set[str]:
+    padded = f"\0{text}\0"
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class DuplicateIndex:
+    """Finds cards whose question is a near-duplicate (edit similarity >= `threshold`) of one added before.
+
+    Exact repeats are a set lookup. Otherwise only questions sharing enough
+    trigrams are compared: an edit changes at most three of them, so a question
+    within the edit distance the threshold allows keeps all but 3 * distance of
+    the new one's trigrams.
+    """
+
+    def __init__(self, threshold: float = 0.9):
+        self.threshold = threshold
+        self._questions = []
+        self._exact = set()
+        self._by_trigram = {}  # trigram -> indexes into _questions
+
+    def is_duplicate(self, card: dict) -> bool:
+        question = normalize_answer(card["question"])
+        if question in self._exact:
+            return True
+        grams = _trigrams(question)
+        # a match can be at most len / threshold long, which bounds the edit distance
+        distance = int((1 - self.threshold) * len(question) / self.threshold)
+        needed = len(grams) - 3 * distance
+        shared = {}
+        for gram in grams:
+            for index in self._by_trigram.get(gram, ()):
+                shared[index] = shared.get(index, 0) + 1
+        candidates = range(len(self._questions)) if needed <= 0 else (
+            index for index, count in shared.items() if count >= needed)
+        return any(abs(len(self._questions[index]) - len(question)) <= distance
+                   and edit_similarity(question, self._questions[index]) >= self.threshold for index in candidates)
+
+    def add(self, card: dict):
+        question = normalize_answer(card["question"])
+        if question in self._exact:
+            return
+        self._exact.add(question)
+        for gram in _trigrams(question):
+            self._by_trigram.setdefault(gram, []).append(len(self._questions))
+        self._questions.append(question)
+
+    def fresh(self, cards: list[dict]) -> list[dict]:
+        """The cards that are not near-duplicates of earlier ones, which are added to the index."""
+        kept = []
+        for card in cards:
+            if not self.is_duplicate(card):
+                self.add(card)
+                kept.append(card)
+        return kept
+
+
+async def generate_cards(text: str, user_prompt: str, token_budget: int = 1500, concurrency: int = 4,
+                         max_cards_per_chunk: int = 5, duplicate_threshold: float = 0.9) -> AsyncIterator[dict]:
+    """Generate cards for every chunk of `text` concurrently, yielding events as chunks finish.
+
+    Events are {"event": "start", "chunks": n}, then per chunk either
+    {"event": "chunk", "chunk": i, "cards": [...], "duplicates": k} with
+    near-duplicates of earlier cards removed, or {"event": "chunk_failed", ...}.
+    """
+    # the stream and review workers import this module for estimate_tokens and must not load starlette
+    from starlette.concurrency import run_in_threadpool
+
+    chunks = split_document(text, token_budget)
+    yield {"event": "start", "chunks": len(chunks)}
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(index: int, chunk: str):
+        async with semaphore:
+            try:
+                return index, await ai_utils.acreate_cards(chunk, user_prompt, max_cards_per_chunk), None
+            except Exception as e:
+                return index, [], str(e)
+
+    seen = DuplicateIndex(duplicate_threshold)
+    tasks = [asyncio.create_task(run(i, chunk)) for i, chunk in enumerate(chunks)]
+    try:
+        for task in asyncio.as_completed(tasks):
+            index, cards, error = await task
+            if error is not None:
+                yield {"event": "chunk_failed", "chunk": index, "error": error}
+                continue
+            # comparing questions is CPU-bound, so it must not hold up the event loop
+            fresh = await run_in_threadpool(seen.fresh, cards)
+            yield {"event": "chunk", "chunk": index, "cards": fresh, "duplicates": len(cards) - len(fresh)}
+    finally:
+        for task in tasks:
+            task.cancel()
@@ -0,0 +1,143 @@
+import asyncio
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+
+def normalize_input(text: str) -> str:
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", str(text))).strip().casefold()
+
+
+class LLMCache:
+    """Memo cache for LLM results: an in-memory LRU in front of an optional SQLite file.
+
+    Keys hash the prompt template version, the model and the normalized inputs,
+    so changing a template or model never serves stale results. Entries expire
+    after `ttl_seconds`; the disk tier is trimmed to `max_disk_entries` by last access.
+    Async callers use `aget` and `aset`, which keep SQLite off the event loop.
+    """
+
+    def __init__(self, max_entries: int = 10000, path: str | None = None, ttl_seconds: float = 7 * 24 * 3600,
+                 max_disk_entries: int = 100000):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_disk_entries = max_disk_entries
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (value, expires_at)
+        self._lock = threading.Lock()  # the in-memory tier only; disk reads and writes hold _disk_lock
+        self._disk_lock = threading.Lock()
+        self._conn = None
+        self._writes = 0
+        if path:
+            self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache ("
+                " key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_accessed ON llm_cache (accessed_at)")
+
+    @staticmethod
+    def make_key(template: str, version: int, model: str, *inputs: str) -> str:
+        payload = json.dumps([template, version, model, [normalize_input(i) for i in inputs]])
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key: str):
+        now = time.time()
+        value = self._get_memory(key, now)
+        return value if value is not None else self._get_disk(key, now)
+
+    async def aget(self, key: str):
+        """get, with the disk tier read in a worker thread rather than on the event loop."""
+        now = time.time()
+        value = self._get_memory(key, now)
+        if value is not None or self._conn is None:
+            return value if value is not None else self._get_disk(key, now)
+        return await asyncio.to_thread(self._get_disk, key, now)
+
+    def set(self, key: str, value):
+        now = time.time()
+        self._set_memory(key, value, now)
+        self._set_disk(key, value, now)
+
+    async def aset(self, key: str, value):
+        """set, with the disk tier written in a worker thread rather than on the event loop."""
+        now = time.time()
+        self._set_memory(key, value, now)
+        if self._conn is not None:
+            await asyncio.to_thread(self._set_disk, key, value, now)
+
+    def stats(self) -> dict:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "size": len(self._entries),
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+        }
+
+    def _get_memory(self, key: str, now: float):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= now:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            self.memory_hits += 1
+            return entry[0]
+
+    def _get_disk(self, key: str, now: float):
+        row = None
+        if self._conn is not None:
+            with self._disk_lock:
+                row = self._conn.execute("SELECT value, expires_at FROM llm_cache WHERE key = ? AND expires_at > ?",
+                                         (key, now)).fetchone()
+                if row is not None:
+                    self._conn.execute("UPDATE llm_cache SET accessed_at = ? WHERE key = ?", (now, key))
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            value = json.loads(row[0])
+            self._remember(key, value, row[1])
+            self.disk_hits += 1
+            return value
+
+    def _set_memory(self, key: str, value, now: float):
+        with self._lock:
+            self._remember(key, value, now + self.ttl_seconds)
+
+    def _set_disk(self, key: str, value, now: float):
+        if self._conn is None:
+            return
+        with self._disk_lock:
+            self._conn.execute("INSERT OR REPLACE INTO llm_cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                               (key, json.dumps(value), now + self.ttl_seconds, now))
+            self._writes += 1
+            if self._writes % 1000 == 0:
+                self._evict(now)
+
+    def _remember(self, key: str, value, expires_at: float):
+        self._entries[key] = (value, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _evict(self, now: float):
+        self._conn.execute("DELETE FROM llm_cache WHERE expires_at <= ?", (now,))
+        overflow = self._conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0] - self.max_disk_entries
+        if overflow > 0:
+            self._conn.execute(
+                "DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache ORDER BY accessed_at LIMIT ?)",
+                (overflow,),
+            )
@@ -1,89 +1,37 @@
-from dotenv import load_dotenv
-load_dotenv()
-from typing import Literal, Callable
-from dataclasses import dataclass, asdict
+from contextlib import asynccontextmanager
+from dataclasses import asdict
+from datetime import datetime, timedelta
+import base64
+import functools
+import hashlib
 import json
+import logging
+import os
+import time
 
-from fastapi import FastAPI, Request, Form, HTTPException
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi import FastAPI, Query, Request, Response, HTTPException
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from fastapi.templating import Jinja2Templates
-from fastapi.staticfiles import StaticFiles
 from starlette.middleware.cors import CORSMiddleware
-
-import os
-from urllib import parse
 import tweepy
-from dotenv import load_dotenv
-import oauth2 as oauth  # Ensure this library is compatible with async or use httpx
-import firebase_admin
-from firebase_admin import credentials, firestore
-import requests
-import openai
-import threading
-from datetime import datetime, timedelta
-import time
-import pytz
 from pydantic import BaseModel
 import httpx
-import json
 
+from xlearn import metrics
 from xlearn import x_streaming
-from xlearn import ai_utils
-
-
-timezone = pytz.timezone('US/Eastern')
-bearer_token = os.environ.get("BEARER_TOKEN")
-
-
-# check if there is firebase_admin.json file in the root directory
-if os.path.isfile("firebase_admin.json"):
-    cred = credentials.Certificate("firebase_admin.json")
-    firebase_admin.initialize_app(cred)
-else:
-    firebase_admin.initialize_app(
-        credential=credentials.Certificate({ 
-            "type": "service_account", \
-            "project_id": os.environ.get('FIREBASE_PROJECT_ID'), \
-            "private_key_id": os.environ.get('PRIVATE_KEY_ID'), \
-            "private_key": os.environ.get('FIREBASE_PRIVATE_KEY').replace('\\n', '\n'), \
-            "client_email": os.environ.get('FIREBASE_CLIENT_EMAIL'), \
-            "client_id": os.environ.get('CLIENT_ID_FIREBASE'), \
-            "auth_uri": os.environ.get('AUTH_URI'), \
-            "token_uri": os.environ.get('TOKEN_URI'), \
-            "auth_provider_x509_cert_url": os.environ.get('AUTH_PROVIDER_X509_CERT_URL'), \
-            "client_x509_cert_url": os.environ.get('CLIENT_X509_CERT_URL'), \
-        }), 
-    )
+from xlearn import importer
+from xlearn import spaced_repetition
+from xlearn import service
+from xlearn.fetcher import ContentFetcher, FetchError, reader_upstream
+from xlearn.service import (
+    timezone, QuoteMaterial, QuestionMaterial, store, user_cache, scheduler, dispatcher, algorithms, algorithm_for,
+    review_key, user_rule, schedule_review,
+)
 
 
-@dataclass
-class QuoteMaterial:
-    type: Literal["quote"]
-    content: str
-    next_review_time: datetime
-    review_interval_hours: int = 3
-    source: str = None
-    num_reviews: int = 0
-    
-@dataclass
-class QuestionMaterial:
-    type: Literal["question"]
-    question: str
-    answer: str
-    next_review_time: datetime
-    review_interval_hours: int = 3
-    display_answer_as_reply: bool = False
-    source: str = None
-    num_reviews: int = 0
-
-# dataclass for imports
-def create_material_from_dict(material_dict: dict):
-    if material_dict['type'] == 'quote':
-        return QuoteMaterial(**material_dict)
-    elif material_dict['type'] == 'question':
-        return QuestionMaterial(**material_dict)
-    else:
-        raise ValueError("Invalid material type")
+logger = logging.getLogger(__name__)
 
 class QuoteInput(BaseModel):
     user_id: str
@@ -101,20 +49,62 @@ class ImportInput(BaseModel):
     user_id: str
     url: str
     custom_prompt: str
+    stream: bool = False
 
-db = firestore.client()
+class DigestInput(BaseModel):
+    user_id: str
+    window_minutes: float = 0
 
-load_dotenv()  # Load environment variables
+class ReplanInput(BaseModel):
+    user_id: str
+    algorithm: str = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # one pooled client for every outbound call made from request handlers
+    app.state.http_client = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=int(os.getenv('HTTP_MAX_CONNECTIONS', 100)),
+            max_keepalive_connections=int(os.getenv('HTTP_MAX_KEEPALIVE_CONNECTIONS', 20)),
+        ),
+        timeout=httpx.Timeout(float(os.getenv('HTTP_TIMEOUT_SECONDS', 60)), connect=10),
+    )
+    app.state.fetcher = ContentFetcher(
+        reader_upstream(app.state.http_client),
+        ttl_seconds=float(os.getenv('FETCH_CACHE_TTL_SECONDS', 3600)),
+        max_bytes=int(os.getenv('FETCH_CACHE_BYTES', 64 * 1024 * 1024)),
+    )
+    service.caches['fetch'] = app.state.fetcher
+    yield
+    await app.state.http_client.aclose()
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Next-Cursor"],
 )
 
+HTTP_LATENCY = metrics.histogram('xlearn_http_request_seconds', "Latency of API requests",
+                                 ('route', 'method', 'status'))
+
+@app.middleware("http")
+async def time_requests(request: Request, call_next):
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # the route template, not the raw path, so ids do not explode the label set
+        route = request.scope.get('route')
+        HTTP_LATENCY.observe(time.perf_counter() - start, route=getattr(route, 'path', 'unmatched'),
+                             method=request.method, status=status)
+
 
 templates = Jinja2Templates(directory="xlearn/templates")
 #app.mount("/static", StaticFiles(directory="xlearn/static"), name="static")
@@ -126,58 +116,10 @@ oauth2_user_handler = tweepy.OAuth2UserHandler(
     scope=["tweet.read", "users.read", "list.read", "tweet.write"],
     client_secret=os.getenv('CLIENT_SECRET'))
 
-authorize_url = oauth2_user_handler.get_authorization_url()
-state = parse.parse_qs(parse.urlparse(authorize_url).query)['state'][0]
-
-bearer_token = os.getenv('BEARER_TOKEN')
-
-def handle_review(material_id: str, user_id: str):
-    access_token = db.collection('users').document(user_id).get().to_dict()['access_token']
-    material  = db.collection('users').document(user_id).collection('materials').document(material_id).get().to_dict()
-    material = create_material_from_dict(material)
-    tweet_id = post_on_twitter(material, access_token)
-    
-    if isinstance(material, QuestionMaterial):
-        #listen_and_reply_to_replies(tweet_id, access_token, material)
-        # use threading to make it parallel
-        listen_thread = threading.Thread(target=listen_for_replies, args=(tweet_id, access_token, material, material_id, user_id))
-        listen_thread.start()
-    
-    
-    next_review_time = datetime.now(tz=timezone) + timedelta(hours=material.review_interval_hours)
-    db.collection('users').document(user_id).collection('materials').document(material_id).update(
-        {
-            'next_review_time': next_review_time,
-            'review_interval_hours': material.review_interval_hours * 2, # simple spaced repetition algorithm 
-        }
-    )
-    run_at_specific_time(handle_review, next_review_time, material_id=material_id, user_id=user_id)
-    
-
-def post_on_twitter(material: QuoteMaterial | QuestionMaterial, access_token: str):
-    print(access_token)
-    client = tweepy.Client(access_token)
-    if isinstance(material, QuoteMaterial):
-        content = f"{material.content}\n({material.num_reviews} reviews)"
-        response = client.create_tweet(text=content, user_auth=False)
-        
-    elif isinstance(material, QuestionMaterial):
-        # if material.display_answer_as_reply:
-        #     content = f"{material.question}"
-        #     response = client.create_tweet(text=content, user_auth=False)
-        #     tweet_id = response.data['id']
-        #     time.sleep(0.1)
-        #     content = f"{material.answer}"
-        #     response = client.create_tweet(text=content, user_auth=False, in_reply_to_tweet_id=tweet_id)
-        #     tweet_id = response.data['id']
-        #     client.hide_reply(tweet_id, user_auth=False)
-        # else:
-        #     content = f"{material.question}"
-        #     client.create_tweet(text=content, user_auth=False)
-        content = f"{material.question}\n({material.num_reviews} reviews)"
-        response = client.create_tweet(text=content, user_auth=False)
-    
-    return response.data['id']
+@functools.cache
+def authorize_url() -> str:
+    # built on first use: it needs CLIENT_ID and REDIRECT_URI, which only the API requires
+    return oauth2_user_handler.get_authorization_url()
 
 @app.get("/")
 async def hello(request: Request):
@@ -186,12 +128,12 @@ async def hello(request: Request):
 
 @app.get("/start", response_class=HTMLResponse)
 async def start(request: Request):
-    return templates.TemplateResponse("start.html", {"request": request, "authorize_url": authorize_url})
+    return templates.TemplateResponse("start.html", {"request": request, "authorize_url": authorize_url()})
 
 @app.get("/authorize")
 async def authorize(request: Request):
     # redirect to the authorize_url
-    return RedirectResponse(url=authorize_url)
+    return RedirectResponse(url=authorize_url())
 
 @app.get("/callback")
 async def callback(request: Request, state: str = None, code: str = None, error: str = None):
@@ -207,20 +149,24 @@ async def callback(request: Request, state: str = None, code: str = None, error:
     client = tweepy.Client(access_token)
     user = client.get_me(user_auth=False, user_fields=['public_metrics'], tweet_fields=['author_id'])
     id = user.data['id']
-    if not db.collection('users').document(str(id)).get().exists:
-        db.collection('users').document(str(id)).set(
+    if store.get_user(str(id)) is None:
+        store.set_user(
+            str(id),
             {
                 'name': user.data['name'],
                 'username': user.data['username'],
                 'access_token': access_token,
             }
         )
+        x_streaming.set_rules([user_rule(str(id))])
     else:
-        db.collection('users').document(str(id)).update(
+        store.update_user(
+            str(id),
             {
                 'access_token': access_token,
             }
         )
+    user_cache.invalidate(str(id))
     
     # post tweet 
     #client.create_tweet(text="Hello World!", user_auth=False)
@@ -233,38 +179,231 @@ async def callback(request: Request, state: str = None, code: str = None, error:
     return RedirectResponse(f"https://x-dev-challenge.vercel.app/console?user_id={id}")
     #return templates.TemplateResponse("callback-success.html", {"request": request, "name": name, "user_name": user_name, "friends_count": friends_count, "tweet_count": tweet_count, "followers_count": followers_count})
 
-@app.get("/materials")
-def get_materials(user_id: str):
-    print(user_id)
-    materials = db.collection('users').document(user_id).collection('materials').stream()
-    user_info = db.collection('users').document(user_id).get().to_dict()
-    print(user_info)
-    print(materials)
-    materials = [material.to_dict() for material in materials]
-    
-    return materials
+@app.get("/scheduler/stats")
+def get_scheduler_stats():
+    return scheduler.stats()
 
-@app.post("/import")
-async def process_data(import_input: ImportInput):
-    
-    async with httpx.AsyncClient() as client:
-        response = await client.get('https://r.jina.ai/'+import_input.url)
-        print(response.text)
-    processed_dict = ai_utils.create_import(response.text, import_input.custom_prompt)
-    question = processed_dict['question']
-    answer = processed_dict['answer']
-    question_material = QuestionMaterial(
-        type="question",
-        question=question,
-        answer=answer,
-        next_review_time=datetime.now(tz=timezone),
+@app.get("/dispatcher/stats")
+def get_dispatcher_stats():
+    return dispatcher.stats()
+
+@app.get("/metrics")
+def get_metrics():
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+MATERIALS_PAGE_SIZE = 100
+MAX_MATERIALS_PAGE_SIZE = 1000
+MAX_FORECAST_HOURS = 366 * 24
+MAX_FORECAST_BUCKETS = 1000
+
+def encode_cursor(material_id: str, material: dict) -> str:
+    position = [material['next_review_time'].timestamp(), material_id]
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> tuple[float, str]:
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except ValueError:
+        position = None
+    # as encode_cursor writes it: [timestamp, material_id]
+    if not (isinstance(position, list) and len(position) == 2 and isinstance(position[0], (int, float))
+            and not isinstance(position[0], bool) and isinstance(position[1], str)):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return float(position[0]), position[1]
+
+def materials_query(user_id: str, limit: int, cursor: str | None, fields: str | None, type: str | None,
+                    due_before: datetime | None, source: str | None) -> dict:
+    if due_before is not None and due_before.tzinfo is None:
+        due_before = timezone.localize(due_before)
+    return dict(
+        user_id=user_id,
+        limit=limit,
+        after=decode_cursor(cursor) if cursor else None,
+        fields=[name.strip() for name in fields.split(",") if name.strip()] if fields else None,
+        type=type,
+        due_before=due_before,
+        source=source,
     )
-    material_id = db.collection('users').document(import_input.user_id).collection('materials').add(asdict(question_material))[1].id
-    handle_review(material_id, import_input.user_id)
+
+@app.get("/materials")
+def get_materials(request: Request, response: Response, user_id: str, limit: int = MATERIALS_PAGE_SIZE,
+                  cursor: str = None, fields: str = None, type: str = None, due_before: datetime = None,
+                  source: str = None):
+    """One page of materials ordered by next review time; the next page's cursor is in X-Next-Cursor."""
+    limit = max(1, min(limit, MAX_MATERIALS_PAGE_SIZE))
+    # read the version before the page so a concurrent write can only make the ETag older, never newer
+    version = store.materials_version(user_id)
+    params = sorted(request.query_params.multi_items())
+    etag = f'W/"{version}-{hashlib.sha1(json.dumps(params).encode()).hexdigest()[:16]}"'
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers={"ETag": etag})
+
+    page = store.query_materials(**materials_query(user_id, limit, cursor, fields, type, due_before, source))
+    response.headers["ETag"] = etag
+    if len(page) == limit:
+        response.headers["X-Next-Cursor"] = encode_cursor(*page[-1])
+    return [{"id": material_id, **material} for material_id, material in page]
+
+@app.post("/digest")
+def set_digest(digest_input: DigestInput):
+    """Post reviews falling due within window_minutes of each other as one thread; 0 turns it off."""
+    if store.get_user(digest_input.user_id) is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    store.update_user(digest_input.user_id, {'digest_window_minutes': digest_input.window_minutes})
+    user_cache.invalidate(digest_input.user_id)
+    return {"user_id": digest_input.user_id, "window_minutes": digest_input.window_minutes}
+
+@app.post("/schedule/replan")
+def replan_schedule(replan_input: ReplanInput):
+    """Switch the user's scheduling algorithm (optional) and re-plan all their materials in one pass."""
+    user_id = replan_input.user_id
+    if replan_input.algorithm is not None and replan_input.algorithm not in algorithms:
+        raise HTTPException(status_code=400, detail=f"Unknown algorithm, use one of {sorted(algorithms)}")
+    if store.get_user(user_id) is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    if replan_input.algorithm is not None:
+        store.update_user(user_id, {'scheduling_algorithm': replan_input.algorithm})
+        user_cache.invalidate(user_id)
+    algorithm = algorithm_for(user_id)
+    updates = spaced_repetition.replan_user(store, algorithm, user_id, timezone)
+    for material_id, fields in updates.items():
+        schedule_review(user_id, material_id, fields['next_review_time'])
+    return {"algorithm": algorithm.name, "updated": len(updates)}
+
+@app.get("/materials/forecast")
+def get_material_forecast(user_id: str, hours: float = Query(24, gt=0, le=MAX_FORECAST_HOURS),
+                          bucket_hours: float = Query(1, gt=0)):
+    """Materials falling due per bucket_hours slot of the next `hours`; overdue ones count in the first slot."""
+    if hours / bucket_hours > MAX_FORECAST_BUCKETS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_FORECAST_BUCKETS} buckets, use larger bucket_hours")
+    now = datetime.now(tz=timezone)
+    query = materials_query(user_id, MAX_MATERIALS_PAGE_SIZE, None, "next_review_time", None,
+                            now + timedelta(hours=hours), None)
+    due = []
+    while True:
+        page = store.query_materials(**query)
+        due.extend(material['next_review_time'].timestamp() for _, material in page)
+        if len(page) < query['limit']:
+            break
+        last_id, last = page[-1]
+        query['after'] = (last['next_review_time'].timestamp(), last_id)
+    counts = spaced_repetition.forecast(due, now.timestamp(), hours, bucket_hours)
+    return {"bucket_hours": bucket_hours, "counts": counts.tolist()}
+
+@app.get("/materials/stats")
+def get_material_stats(user_id: str):
+    """Counters kept on the user document: total, by_type, reviewed, lapsed, due_now and version."""
+    return store.material_stats(user_id, datetime.now(tz=timezone))
+
+@app.get("/materials/export")
+def export_materials(user_id: str, fields: str = None, type: str = None, due_before: datetime = None,
+                     source: str = None):
+    """Every matching material as one JSON array, streamed page by page."""
+    query = materials_query(user_id, MAX_MATERIALS_PAGE_SIZE, None, fields, type, due_before, source)
+
+    def generate():
+        yield "["
+        first = True
+        while True:
+            page = store.query_materials(**query)
+            for material_id, material in page:
+                yield ("" if first else ",") + json.dumps(jsonable_encoder({"id": material_id, **material}))
+                first = False
+            if len(page) < query['limit']:
+                break
+            last_id, last = page[-1]
+            query['after'] = (last['next_review_time'].timestamp(), last_id)
+        yield "]"
+
+    return StreamingResponse(generate(), media_type="application/json")
+
+@app.get("/materials/{material_id}/status")
+def get_material_status(material_id: str, user_id: str):
+    material = store.get_material(user_id, material_id)
+    if material is None:
+        raise HTTPException(status_code=404, detail="Material not found")
+    state = scheduler.state(user_id, material_id)
+    if material.get('last_tweet_id'):
+        status = 'posted'
+    elif state == 'running' or dispatcher.is_queued(review_key(user_id, material_id)):
+        status = 'posting'
+    elif state == 'failed':
+        status = 'failed'
+    else:
+        status = 'queued'
+    return {
+        "material_id": material_id,
+        "status": status,
+        "tweet_id": material.get('last_tweet_id'),
+        "error": scheduler.last_error(user_id, material_id) if status == 'failed' else None,
+    }
+
+def add_imported_cards(user_id: str, cards: list[dict], source: str, first_review_time: datetime,
+                       stagger: timedelta) -> list[str]:
+    materials = [
+        QuestionMaterial(
+            type="question",
+            question=card['question'],
+            answer=card['answer'],
+            source=source,
+            next_review_time=first_review_time + stagger * i,
+        )
+        for i, card in enumerate(cards)
+    ]
+    with store.batch():
+        material_ids = [store.add_material(user_id, asdict(material)) for material in materials]
+    for material_id, material in zip(material_ids, materials):
+        schedule_review(user_id, material_id, material.next_review_time)
+    return material_ids
+
+async def import_events(import_input: ImportInput, page: str):
+    first_review_time = datetime.now(tz=timezone)
+    # first reviews are spread out so a long import does not post every card at once
+    stagger = timedelta(minutes=float(os.getenv('IMPORT_STAGGER_MINUTES', 60)))
+    imported = 0
+    async for event in importer.generate_cards(
+        page,
+        import_input.custom_prompt,
+        token_budget=int(os.getenv('IMPORT_CHUNK_TOKENS', 1500)),
+        concurrency=int(os.getenv('IMPORT_CONCURRENCY', 4)),
+        max_cards_per_chunk=int(os.getenv('IMPORT_CARDS_PER_CHUNK', 5)),
+    ):
+        if event['event'] != 'chunk':
+            yield event
+            continue
+        cards = event['cards']
+        start = first_review_time + stagger * imported
+        material_ids = await run_in_threadpool(
+            add_imported_cards, import_input.user_id, cards, import_input.url, start, stagger
+        )
+        imported += len(material_ids)
+        for material_id, card in zip(material_ids, cards):
+            yield {"event": "card", "chunk": event['chunk'], "material_id": material_id, **card}
+        if event['duplicates']:
+            yield {"event": "duplicates", "chunk": event['chunk'], "count": event['duplicates']}
+    yield {"event": "done", "cards": imported}
+
+@app.post("/import", status_code=202)
+async def process_data(import_input: ImportInput, request: Request):
+    
+    try:
+        page = await request.app.state.fetcher.fetch(import_input.url)
+    except FetchError as e:
+        raise HTTPException(status_code=502, detail=str(e))
+    events = import_events(import_input, page)
+    if import_input.stream:
+        # one JSON object per line, sent as soon as each chunk's cards are saved
+        async def ndjson():
+            async for event in events:
+                yield json.dumps(event) + "\n"
+        return StreamingResponse(ndjson(), status_code=202, media_type="application/x-ndjson")
+    material_ids = [event['material_id'] async for event in events if event['event'] == 'card']
+    # first reviews are posted by the scheduler's workers, see GET /materials/{material_id}/status
+    return {"material_id": material_ids[0] if material_ids else None, "material_ids": material_ids}
     
     
 
-@app.post("/question")
+@app.post("/question", status_code=202)
 def post_question(question_input: QuestionInput):
     question_material = QuestionMaterial(
         type="question",
@@ -273,11 +412,11 @@ def post_question(question_input: QuestionInput):
         display_answer_as_reply=question_input.display_answer_as_reply,
         next_review_time=datetime.now(tz=timezone),
     )
-    document = db.collection('users').document(question_input.user_id).collection('materials').add(asdict(question_material))[1]
-    material_id = document.id
-    handle_review(material_id, question_input.user_id)
+    material_id = store.add_material(question_input.user_id, asdict(question_material))
+    schedule_review(question_input.user_id, material_id, question_material.next_review_time)
+    return {"material_id": material_id}
 
-@app.post("/quote")
+@app.post("/quote", status_code=202)
 def post_quote(quote_input: QuoteInput):
     quoate_material = QuoteMaterial(
         type="quote",
@@ -285,124 +424,15 @@ def post_quote(quote_input: QuoteInput):
         source=quote_input.source,
         next_review_time=datetime.now(tz=timezone),
     )
-    document = db.collection('users').document(quote_input.user_id).collection('materials').add(asdict(quoate_material))[1]
-    material_id = document.id
-    handle_review(material_id, quote_input.user_id)
-    
-def run_at_specific_time(func: Callable, target_time: datetime, **kwargs):
-    now = datetime.now(tz=timezone)
-    if target_time < now:
-        target_time += timedelta(seconds=1)  # Schedule for next second
-    delay = (target_time - now).total_seconds()
-    threading.Timer(delay, func, kwargs=kwargs).start()
-
-def listen_for_replies(tweet_id: str, access_token: str, material: QuestionMaterial, material_id: str, user_id: str):
-    rules =  [{
-            "value": f"in_reply_to_tweet_id:{tweet_id}",
-            "tag": f"replies_for_{user_id}"
-        }] 
-    
-    x_streaming.set_rules(
-        rules
-    )
-    
-   
-def start_listening():
-    response = requests.get(
-        "https://api.twitter.com/2/tweets/search/stream", auth=x_streaming.bearer_oauth, stream=True, data={'tweet.fields': 'author_id'}
-    )
-    
-    for response_line in response.iter_lines():
-        json_response = json.loads(response_line)
-        tweet_id = json_response['data']['edit_history_tweet_ids'][0]
-        
-        if 'mentions' in json_response['data']['tag']:
-            user_id = json_response['data']['tag'].split('_')[-1]
-            access_token = db.collection('users').document(user_id).get().to_dict()['access_token']
-            client = tweepy.Client(access_token)
-            tweet_content = client.get_tweet(tweet_id, tweet_fields=['text', 'conversation_id'])
-            # search all the tweets by conversation_id
-            conversation_id = tweet_content.data['conversation_id']
-            tweets = client.search_recent_tweets(query=f"conversation_id:{conversation_id}", tweet_fields=['text', 'author_id'])
-            context_tweets = []
-            for tweet in tweets.data:
-                if tweet['author_id'] == user_id:
-                    context_tweets.append({'author': 'bot', 'text': tweet['text']})
-                else:
-                    context_tweets.append({'author': 'user', 'text': tweet['text']})
-            action_dict = ai_utils.create_action(context_tweets)
-            
-            print(action_dict)
-            if action_dict["action"]['type'] == 'add_material':
-                question = action_dict["action"]['question']
-                answer = action_dict["action"]['answer']
-                question_material = QuestionMaterial(
-                    type="question",
-                    question=question,
-                    answer=answer,
-                    next_review_time=datetime.now(tz=timezone),
-                )
-                document = db.collection('users').document(user_id).collection('materials').add(asdict(question_material))[1]
-                material_id = document.id
-                handle_review(material_id, user_id)
-                tweet_content = f"Question successfully added. \nQuestion: {question}\nAnswer: {answer}"[:270]
-                client.create_tweet(text=tweet_content, user_auth=False, in_reply_to_tweet_id=tweet_id)
-            elif action_dict["action"]['type'] == 'count_materials':
-                materials = db.collection('users').document(user_id).collection('materials').stream()
-                count = 0
-                for material in materials:
-                    count += 1
-                tweet_content = f"{action_dict['message_to_user']}\nYou have {count} study materials so far."
-                client.create_tweet(text=tweet_content, user_auth=False, in_reply_to_tweet_id=tweet_id)
-            
-            elif action_dict["action"]['type'] == 'delete_material':
-                raise NotImplementedError("Delete material action is not implemented yet")
-        
-        elif 'replies' in json_response['data']['tag']:
-            user_id = json_response['data']['tag'].split('_')[-1]
-            access_token = db.collection('users').document(user_id).get().to_dict()['access_token']
-            bot_handle = db.collection('users').document(user_id).get().to_dict()['username']
-            client = tweepy.Client(access_token)
-            tweet_content = client.get_tweet(tweet_id, tweet_fields=['text', 'conversation_id'])
-            # search all the tweets by conversation_id
-            if f'@{bot_handle}' in tweet_content.data['text']:
-                continue
-            user_answer = tweet_content.data['text']
-            correct, feedback = ai_utils.creat_feedback(material.question, material.answer, user_answer)
-            client.create_tweet(text=feedback, user_auth=False, in_reply_to_tweet_id=tweet_id)
-            time.sleep(0.1)
-            if not correct:
-                db.collection('users').document(user_id).collection('materials').document(material_id).update(
-                    {
-                        'next_review_time': datetime.now(tz=timezone),
-                        'review_interval_hours': 3,
-                        'num_reviews': firestore.Increment(1),
-                    }
-                )
-                handle_review(material_id, user_id)
-            
-            
-def add_initial_rules():
-    users = db.collection('users').stream()
-    for user in users:
-        user_id = user.id
-        rules =  [{
-            "value": f"from:{user_id}",
-            "tag": f"mentions_for_{user_id}"
-        }]
-        x_streaming.set_rules(
-            rules
-        ) 
+    material_id = store.add_material(quote_input.user_id, asdict(quoate_material))
+    schedule_review(quote_input.user_id, material_id, quoate_material.next_review_time)
+    return {"material_id": material_id}
 
 if __name__ == "__main__":
+    # the stream and the reviews in one process; see xlearn.api and the workers to run them apart
+    service.start_reviews()
+    service.counter_reconciler.start()
     try:
-        x_streaming.delete_all_rules(x_streaming.get_rules())
-    except Exception as e:
-        print(e)
-        pass
-    add_initial_rules()
-    try:
-        start_listening()
-    except Exception as e:
-        print(e)
-        pass
+        service.start_stream()
+    except Exception:
+        logger.exception("Stream listener stopped")
@@ -0,0 +1,56 @@
+import logging
+import threading
+
+from xlearn.storage import Store
+
+logger = logging.getLogger(__name__)
+
+
+class CounterReconciler:
+    """Periodically recounts every user's materials and repairs drifted counters.
+
+    Counters are maintained on every write, so this only matters after partial
+    failures, manual edits or for users created before counters existed. The
+    first pass runs as soon as the thread starts.
+    """
+
+    def __init__(self, store: Store, interval_hours: float = 24):
+        self.store = store
+        self.interval_hours = interval_hours
+        self.checked = 0
+        self.repaired = 0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def run_once(self) -> int:
+        repaired = 0
+        for user_id in self.store.list_user_ids():
+            if self._stopped.is_set():
+                break
+            try:
+                corrections = self.store.reconcile_counters(user_id)
+            except Exception:
+                logger.exception("Failed to reconcile counters", extra={'user_id': user_id})
+                continue
+            self.checked += 1
+            if corrections:
+                logger.warning("Repaired drifted counters", extra={'user_id': user_id, 'corrections': corrections})
+                repaired += 1
+        self.repaired += repaired
+        return repaired
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="counter-reconciler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception("Failed to reconcile counters")
+            if self._stopped.wait(self.interval_hours * 3600):
+                return
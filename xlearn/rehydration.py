@@ -0,0 +1,97 @@
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Callable
+
+from xlearn.scheduler import ReviewScheduler
+from xlearn.storage import Store
+
+logger = logging.getLogger(__name__)
+
+
+class ReviewWindowLoader:
+    """Loads pending reviews from the store into the scheduler, a time window at a time.
+
+    On startup every material due before now + window is loaded (overdue ones
+    included), then a background thread keeps extending the horizon. Each
+    top-up also loads again the overdue materials the scheduler no longer
+    holds, e.g. after a post was dropped, so no review is lost until a restart.
+    Only the window is ever held in memory, so restart cost does not grow with the corpus.
+    Only users for which `accept(user_id)` is true are loaded, when it is set.
+    """
+
+    def __init__(self, store: Store, scheduler: ReviewScheduler, window_hours: float = 6, page_size: int = 500,
+                 refresh_minutes: float = 15):
+        self.store = store
+        self.scheduler = scheduler
+        self.window = timedelta(hours=window_hours)
+        self.page_size = page_size
+        self.refresh_interval = timedelta(minutes=refresh_minutes)
+        self.horizon = None
+        self.loaded = 0
+        self.accept = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def covers(self, when: datetime) -> bool:
+        """Whether a review at `when` should go straight into the scheduler.
+
+        Reviews past the horizon stay in the database and are picked up by a later top-up.
+        """
+        horizon = self.horizon
+        return horizon is None or when <= horizon
+
+    def load(self):
+        horizon = datetime.now().astimezone() + self.window
+        with self._lock:
+            self.horizon = horizon
+        return self._load_range(None, horizon)
+
+    def top_up(self):
+        now = datetime.now().astimezone()
+        new_horizon = now + self.window
+        with self._lock:
+            old_horizon, self.horizon = self.horizon, new_horizon
+        # the horizon is advanced before querying, so a review written in between is
+        # either seen by covers() or by the query below
+        loaded = self._load_range(old_horizon, new_horizon)
+        return loaded + self._load_range(None, now, missing_only=True)
+
+    def reload(self, accept: Callable[[str], bool]) -> int:
+        """Load the current window again for the users `accept` picks, e.g. shards just taken over."""
+        horizon = self.horizon
+        if horizon is None:
+            return 0
+        return self._load_range(None, horizon, accept)
+
+    def start(self):
+        if self.horizon is None:
+            self.load()
+        self._thread = threading.Thread(target=self._run, name="review-window-loader", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.wait(self.refresh_interval.total_seconds()):
+            try:
+                self.top_up()
+            except Exception:
+                logger.exception("Failed to top up review window")
+
+    def _load_range(self, start: datetime | None, end: datetime, accept: Callable[[str], bool] | None = None,
+                    missing_only: bool = False) -> int:
+        accept = accept or self.accept
+        count = 0
+        for user_id, material_id, next_review_time in self.store.iter_due_materials(end, start, self.page_size):
+            if accept is not None and not accept(user_id):
+                continue
+            if missing_only and (self.scheduler.pending(user_id, material_id) is not None
+                                 or self.scheduler.state(user_id, material_id) == 'running'):
+                continue
+            self.scheduler.schedule(user_id, material_id, next_review_time)
+            count += 1
+        self.loaded += count
+        return count
@@ -0,0 +1,105 @@
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, asdict
+from datetime import datetime, timedelta, timezone
+
+from xlearn.storage import Store
+
+
+@dataclass
+class ReplyRoute:
+    user_id: str
+    material_id: str | None
+    question: str | None
+    answer: str | None
+    # digest tweets ask several questions: [{"number", "material_id", "question", "answer"}]
+    items: list[dict] | None = None
+
+
+class ReplyIndex:
+    """Maps posted question tweet ids to the material they ask about.
+
+    Routes are persisted in the store (kind `reply_routes`) with an expiry and
+    fronted by an in-memory LRU, so routing a reply is one dict lookup in the
+    common case. Replies we post ourselves are remembered in memory so the
+    stream does not route the bot's own feedback back to it. With `share_own`,
+    they are also written to the store (kind `own_tweets`), for when the tweets
+    are posted by a different process than the one reading the stream.
+    """
+
+    KIND = 'reply_routes'
+    OWN_KIND = 'own_tweets'
+
+    def __init__(self, store: Store, ttl_hours: float = 24 * 7, max_size: int = 100000,
+                 purge_every: int = 1000, share_own: bool = False):
+        self.store = store
+        self.ttl = timedelta(hours=ttl_hours)
+        self.max_size = max_size
+        self.purge_every = purge_every
+        self.share_own = share_own
+        self._routes = OrderedDict()  # tweet_id -> (ReplyRoute, expires_at)
+        self._own_tweets = OrderedDict()
+        self._lock = threading.Lock()
+        self._added = 0
+        self._marked = 0
+
+    def add(self, tweet_id: str, route: ReplyRoute):
+        expires_at = datetime.now(timezone.utc) + self.ttl
+        self.store.put_record(self.KIND, str(tweet_id), asdict(route), expires_at)
+        self._remember(str(tweet_id), route, expires_at)
+        self._added += 1
+        if self._added % self.purge_every == 0:
+            self.store.purge_expired_records(self.KIND, datetime.now(timezone.utc))
+
+    def lookup(self, *tweet_ids: str | None) -> ReplyRoute | None:
+        """Route for the first of `tweet_ids` (e.g. in_reply_to, then conversation_id) that is indexed."""
+        now = datetime.now(timezone.utc)
+        for tweet_id in tweet_ids:
+            if tweet_id is None:
+                continue
+            tweet_id = str(tweet_id)
+            with self._lock:
+                entry = self._routes.get(tweet_id)
+                if entry is not None:
+                    if entry[1] > now:
+                        self._routes.move_to_end(tweet_id)
+                        return entry[0]
+                    del self._routes[tweet_id]
+                    continue
+            record = self.store.get_record(self.KIND, tweet_id)
+            if record is not None:
+                route = ReplyRoute(**record)
+                self._remember(tweet_id, route, now + self.ttl)
+                return route
+        return None
+
+    def mark_own(self, tweet_id: str):
+        self._remember_own(str(tweet_id))
+        if self.share_own:
+            now = datetime.now(timezone.utc)
+            self.store.put_record(self.OWN_KIND, str(tweet_id), {}, now + self.ttl)
+            self._marked += 1
+            if self._marked % self.purge_every == 0:
+                self.store.purge_expired_records(self.OWN_KIND, now)
+
+    def is_own(self, tweet_id: str) -> bool:
+        with self._lock:
+            if str(tweet_id) in self._own_tweets:
+                return True
+        if self.share_own and self.store.get_record(self.OWN_KIND, str(tweet_id)) is not None:
+            self._remember_own(str(tweet_id))
+            return True
+        return False
+
+    def _remember_own(self, tweet_id: str):
+        with self._lock:
+            self._own_tweets[tweet_id] = True
+            while len(self._own_tweets) > self.max_size:
+                self._own_tweets.popitem(last=False)
+
+    def _remember(self, tweet_id: str, route: ReplyRoute, expires_at: datetime):
+        with self._lock:
+            self._routes[tweet_id] = (route, expires_at)
+            self._routes.move_to_end(tweet_id)
+            while len(self._routes) > self.max_size:
+                self._routes.popitem(last=False)
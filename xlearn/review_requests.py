@@ -0,0 +1,70 @@
+import logging
+import random
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Callable
+
+from xlearn.storage import Store
+
+logger = logging.getLogger(__name__)
+
+
+class ReviewRequests:
+    """Tells the process running the review scheduler that a material's review time changed.
+
+    The API and the stream worker have no scheduler of their own when the entry
+    points run as separate processes. They write a store record (kind
+    `review_requests`) per changed material, and the review worker drains them
+    every `poll_seconds`. Requests carry no time: the material itself is read
+    when the request is applied, so late or reordered requests cannot schedule
+    a stale review.
+    """
+
+    KIND = 'review_requests'
+
+    def __init__(self, store: Store, poll_seconds: float = 5, ttl_hours: float = 24):
+        self.store = store
+        self.poll_seconds = poll_seconds
+        self.ttl = timedelta(hours=ttl_hours)
+        self.applied = 0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def add(self, user_id: str, material_id: str):
+        key = f"{time.time_ns()}_{random.getrandbits(32):08x}"
+        self.store.put_record(self.KIND, key, {'user_id': user_id, 'material_id': material_id},
+                              datetime.now(timezone.utc) + self.ttl)
+
+    def drain(self, apply: Callable[[str, str], bool]) -> int:
+        """Call apply(user_id, material_id) once per material with waiting requests.
+
+        Requests are deleted once applied; those for which apply returns false,
+        such as users of another worker's shard, are left for someone else.
+        """
+        requests = {}
+        for key, request in self.store.list_records(self.KIND):
+            requests.setdefault((request['user_id'], request['material_id']), []).append(key)
+        applied = 0
+        for (user_id, material_id), keys in requests.items():
+            if not apply(user_id, material_id):
+                continue
+            for key in keys:
+                self.store.delete_record(self.KIND, key)
+            applied += 1
+        self.applied += applied
+        return applied
+
+    def start(self, apply: Callable[[str, str], bool]):
+        self._thread = threading.Thread(target=self._run, args=(apply,), name="review-requests", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self, apply):
+        while not self._stopped.wait(self.poll_seconds):
+            try:
+                self.drain(apply)
+            except Exception:
+                logger.exception("Failed to apply review requests")
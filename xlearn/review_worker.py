@@ -0,0 +1,35 @@
+"""Posts due reviews and digests: `python -m xlearn.review_worker`.
+
+The only process that runs the review scheduler while the API and the stream
+worker run apart, unless SHARD_COUNT splits the users between several review
+workers. Set METRICS_PORT to serve /metrics.
+"""
+import logging
+import os
+import signal
+import threading
+
+from xlearn import metrics
+from xlearn import service
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    if os.getenv('METRICS_PORT'):
+        metrics.serve(int(os.getenv('METRICS_PORT')))
+    # the stream worker skips the tweets recorded here instead of treating them as requests
+    service.reply_index.share_own = True
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+    service.start_reviews()
+    service.counter_reconciler.start()
+    try:
+        stopped.wait()
+    except KeyboardInterrupt:
+        pass
+    service.stop_reviews()
+
+
+if __name__ == "__main__":
+    main()
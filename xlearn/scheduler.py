@@ -0,0 +1,222 @@
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable
+
+from xlearn import metrics
+
+logger = logging.getLogger(__name__)
+
+DISPATCH_LAG = metrics.histogram(
+    'xlearn_review_dispatch_lag_seconds', "How much later than planned (next_review_time) reviews start",
+    buckets=(0.01, 0.1, 0.5, 1, 5, 15, 60, 300, 900, 3600),
+)
+REVIEW_LATENCY = metrics.histogram('xlearn_review_seconds', "Time spent handling one due review", ('outcome',))
+
+
+class ReviewScheduler:
+    """Min-heap of pending reviews keyed by (user_id, material_id).
+
+    One dispatcher thread waits for the earliest entry and hands due reviews to a
+    bounded worker pool, so the thread count stays flat however many materials
+    are scheduled. Scheduling a key that is already pending replaces it.
+
+    A review that raises is retried after a jittered backoff, doubling from
+    `retry_seconds` up to `max_retry_seconds`, unless it was scheduled again
+    meanwhile; its key reads as 'failed' until a run succeeds. After
+    `max_failures` failed runs in a row it is given up until scheduled again.
+    """
+
+    def __init__(self, func: Callable, max_workers: int = 8, retry_seconds: float = 5,
+                 max_retry_seconds: float = 900, max_failures: int = 10):
+        self.func = func
+        self.max_workers = max_workers
+        self.retry_seconds = retry_seconds
+        self.max_retry_seconds = max_retry_seconds
+        self.max_failures = max_failures
+        self._heap = []  # (run_at, seq, key); entries not in _entries are stale
+        self._entries = {}  # key -> (run_at, seq)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._slots = threading.BoundedSemaphore(max_workers)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="review")
+        self._thread = None
+        self._stopped = False
+        self._running = set()
+        self._errors = OrderedDict()  # key -> (last error, failed runs in a row), bounded
+        self.dispatched = 0
+        self.failed = 0
+        self.retried = 0
+        self.given_up = 0
+        self.last_dispatch_lag = 0.0
+        self.max_dispatch_lag = 0.0
+
+    def schedule(self, user_id: str, material_id: str, run_at: datetime):
+        key = (user_id, material_id)
+        run_at_ts = run_at.timestamp()
+        with self._cond:
+            seq = next(self._seq)
+            self._entries[key] = (run_at_ts, seq)
+            heapq.heappush(self._heap, (run_at_ts, seq, key))
+            self._maybe_compact()
+            self._start()
+            self._cond.notify()
+
+    reschedule = schedule
+
+    def cancel(self, user_id: str, material_id: str) -> bool:
+        with self._cond:
+            removed = self._entries.pop((user_id, material_id), None) is not None
+            self._maybe_compact()
+            return removed
+
+    def drop(self, predicate: Callable[[str, str], bool]) -> int:
+        """Cancel every pending review for which predicate(user_id, material_id) is true."""
+        with self._cond:
+            keys = [key for key in self._entries if predicate(*key)]
+            for key in keys:
+                del self._entries[key]
+            self._maybe_compact()
+            return len(keys)
+
+    def pending(self, user_id: str, material_id: str) -> datetime | None:
+        entry = self._entries.get((user_id, material_id))
+        return datetime.fromtimestamp(entry[0]).astimezone() if entry else None
+
+    def state(self, user_id: str, material_id: str) -> str | None:
+        """'pending', 'running' or 'failed' for keys this scheduler knows about, else None."""
+        key = (user_id, material_id)
+        with self._cond:
+            if key in self._running:
+                return 'running'
+            if key in self._errors:
+                return 'failed'
+            if key in self._entries:
+                return 'pending'
+        return None
+
+    def last_error(self, user_id: str, material_id: str) -> str | None:
+        entry = self._errors.get((user_id, material_id))
+        return entry[0] if entry else None
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._entries)
+
+    @property
+    def dispatch_lag(self) -> float:
+        """Seconds between the planned and actual start of the oldest due entry."""
+        with self._cond:
+            self._drop_stale_head()
+            if self._heap:
+                return max(0.0, time.time() - self._heap[0][0], self.last_dispatch_lag)
+            return self.last_dispatch_lag
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue_depth,
+            "dispatched": self.dispatched,
+            "failed": self.failed,
+            "retried": self.retried,
+            "given_up": self.given_up,
+            "dispatch_lag_seconds": self.dispatch_lag,
+            "max_dispatch_lag_seconds": self.max_dispatch_lag,
+            "max_workers": self.max_workers,
+        }
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self._executor.shutdown(wait=False)
+
+    def backoff(self, failures: int) -> float:
+        """Jittered seconds to wait after `failures` failures in a row."""
+        return random.uniform(0.5, 1) * min(self.max_retry_seconds, self.retry_seconds * 2 ** (failures - 1))
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="review-scheduler", daemon=True)
+            self._thread.start()
+
+    def _drop_stale_head(self):
+        while self._heap:
+            run_at_ts, seq, key = self._heap[0]
+            if self._entries.get(key) == (run_at_ts, seq):
+                return
+            heapq.heappop(self._heap)
+
+    def _maybe_compact(self):
+        # cancelled and replaced entries are removed lazily; rebuild once they dominate
+        if len(self._heap) > 64 and len(self._heap) > 2 * len(self._entries):
+            self._heap = [(run_at_ts, seq, key) for key, (run_at_ts, seq) in self._entries.items()]
+            heapq.heapify(self._heap)
+
+    def _run(self):
+        while True:
+            # wait for a free worker first so that due entries stay cancellable in the heap
+            self._slots.acquire()
+            with self._cond:
+                while True:
+                    if self._stopped:
+                        self._slots.release()
+                        return
+                    self._drop_stale_head()
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    delay = self._heap[0][0] - time.time()
+                    if delay <= 0:
+                        break
+                    self._cond.wait(delay)
+                run_at_ts, _, key = heapq.heappop(self._heap)
+                del self._entries[key]
+                self._running.add(key)
+                lag = max(0.0, time.time() - run_at_ts)
+                self.last_dispatch_lag = lag
+                self.max_dispatch_lag = max(self.max_dispatch_lag, lag)
+                DISPATCH_LAG.observe(lag)
+                self.dispatched += 1
+            try:
+                self._executor.submit(self._execute, key)
+            except RuntimeError:  # executor shut down (stop() or interpreter exit)
+                self._slots.release()
+                return
+
+    def _execute(self, key):
+        user_id, material_id = key
+        try:
+            with metrics.timed(REVIEW_LATENCY):
+                self.func(user_id=user_id, material_id=material_id)
+            with self._cond:
+                self._errors.pop(key, None)
+        except Exception as e:
+            self.failed += 1
+            with self._cond:
+                failures = self._errors.pop(key, (None, 0))[1] + 1
+                self._errors[key] = (str(e), failures)
+                while len(self._errors) > 10000:
+                    self._errors.popitem(last=False)
+                # a review scheduled while this one ran supersedes the retry
+                retry = key not in self._entries
+            delay = self.backoff(failures)
+            if retry and failures >= self.max_failures:
+                self.given_up += 1
+                logger.exception("Review failed too often, giving up",
+                                 extra={'user_id': user_id, 'material_id': material_id, 'failures': failures})
+                return
+            logger.exception("Review failed", extra={'user_id': user_id, 'material_id': material_id,
+                                                     'failures': failures, 'retry_in': round(delay, 1) if retry else None})
+            if retry:
+                self.retried += 1
+                self.schedule(user_id, material_id, datetime.fromtimestamp(time.time() + delay).astimezone())
+        finally:
+            with self._cond:
+                self._running.discard(key)
+            self._slots.release()
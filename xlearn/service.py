@@ -0,0 +1,691 @@
+"""The service shared by every entry point: the store, the review scheduler, the
+tweet dispatcher and the stream handlers.
+
+Nothing here starts a thread, opens a connection or builds an SDK client at
+import time. Each entry point starts only the parts it runs:
+
+    xlearn.api             the HTTP API (`uvicorn xlearn.main:app` works too)
+    xlearn.stream_worker   reads the filtered stream and answers replies
+    xlearn.review_worker   posts due reviews and digests
+    xlearn.main            the stream and the reviews in one process, as before
+
+Whichever process changes a review time calls `schedule_review`; outside the
+review worker the change is handed to it through the store, see ReviewRequests.
+With SHARD_COUNT set, several stream and review workers can run side by side,
+each handling the users of the shards it holds a lease on, see ShardLeases.
+"""
+from dataclasses import dataclass, asdict, fields
+from datetime import datetime, timedelta
+from typing import Literal
+import logging
+import os
+
+import pytz
+import tweepy
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from xlearn import log
+log.configure()
+from xlearn import metrics
+from xlearn import x_streaming
+from xlearn import ai_utils
+from xlearn import storage
+from xlearn import digest
+from xlearn import spaced_repetition
+from xlearn.spaced_repetition import AGAIN, GOOD
+from xlearn.user_cache import UserCache
+from xlearn.stream_pipeline import StreamPipeline
+from xlearn.reply_index import ReplyIndex, ReplyRoute
+from xlearn.scheduler import ReviewScheduler
+from xlearn.rehydration import ReviewWindowLoader
+from xlearn.review_requests import ReviewRequests
+from xlearn.sharding import ShardLeases, StreamShards, new_worker_id
+from xlearn.dedup import Deduplicator
+from xlearn.conversation import ConversationCache
+from xlearn.reconciliation import CounterReconciler
+from xlearn.dispatcher import TweetDispatcher, PostJob, REPLY, REVIEW
+
+
+logger = logging.getLogger(__name__)
+
+timezone = pytz.timezone('US/Eastern')
+
+@dataclass
+class QuoteMaterial:
+    type: Literal["quote"]
+    content: str
+    next_review_time: datetime
+    review_interval_hours: int = 3
+    source: str = None
+    num_reviews: int = 0
+    
+@dataclass
+class QuestionMaterial:
+    type: Literal["question"]
+    question: str
+    answer: str
+    next_review_time: datetime
+    review_interval_hours: int = 3
+    display_answer_as_reply: bool = False
+    source: str = None
+    num_reviews: int = 0
+
+# dataclass for imports
+def create_material_from_dict(material_dict: dict):
+    if material_dict['type'] == 'quote':
+        material_class = QuoteMaterial
+    elif material_dict['type'] == 'question':
+        material_class = QuestionMaterial
+    else:
+        raise ValueError("Invalid material type")
+    # stored documents also carry bookkeeping fields such as last_tweet_id
+    names = {field.name for field in fields(material_class)}
+    return material_class(**{key: value for key, value in material_dict.items() if key in names})
+
+store = storage.get_store()
+user_cache = UserCache(
+    store,
+    ttl_seconds=float(os.getenv('USER_CACHE_TTL_SECONDS', 600)),
+    max_size=int(os.getenv('USER_CACHE_SIZE', 10000)),
+    client_factory=x_streaming.create_client,
+)
+reply_index = ReplyIndex(store, ttl_hours=float(os.getenv('REPLY_ROUTE_TTL_HOURS', 24 * 7)))
+
+def review_key(user_id: str, material_id: str) -> str:
+    return f"review_{user_id}_{material_id}"
+
+def handle_review(material_id: str, user_id: str):
+    if review_shards is not None and not review_shards.owns(user_id):
+        return  # the shard moved to another worker, which loads the review itself
+    window_minutes = user_cache.get(user_id).digest_window_minutes
+    if window_minutes is None:
+        window_minutes = DIGEST_WINDOW_MINUTES
+    if window_minutes > 0:
+        handle_digest(user_id, material_id, timedelta(minutes=window_minutes))
+        return
+    material_dict = store.get_material(user_id, material_id)
+    if material_dict is None:
+        return  # deleted since it was scheduled
+    material = create_material_from_dict(material_dict)
+    # one post per due time, however often the review fires or whichever worker it fires on
+    due_key = review_due_key(user_id, material_id, material_dict['next_review_time'])
+    if not seen_reviews.claim(due_key):
+        return
+    try:
+        # the material is updated once the dispatcher has actually posted, see on_review_posted
+        dispatcher.submit(
+            user_id,
+            review_text(material),
+            kind='review',
+            priority=REVIEW,
+            context={'material_id': material_id, 'due_key': due_key},
+            key=review_key(user_id, material_id),
+        )
+    except Exception:
+        seen_reviews.release(due_key)
+        raise
+
+def review_due_key(user_id: str, material_id: str, next_review_time: datetime) -> str:
+    return f"{user_id}_{material_id}_{round(next_review_time.timestamp() * 1000)}"
+
+def on_review_posted(job: PostJob, tweet_id: str):
+    user_id, material_id = job.user_id, job.context['material_id']
+    if 'due_key' in job.context:  # else queued before due keys
+        seen_reviews.done(job.context['due_key'])
+    reply_index.mark_own(tweet_id)
+    material_dict = store.get_material(user_id, material_id)
+    if material_dict is None:
+        return  # deleted while the post was queued
+    material = create_material_from_dict(material_dict)
+    
+    if isinstance(material, QuestionMaterial):
+        # replies are routed back to this material by tweet id, see handle_stream_event
+        reply_index.add(tweet_id, ReplyRoute(user_id, material_id, material.question, material.answer))
+    
+    
+    now = datetime.now(tz=timezone)
+    updates = spaced_repetition.review_updates(algorithm_for(user_id), [(material_id, material_dict)], GOOD, now)
+    next_review_time = updates[material_id]['next_review_time']
+    store.update_material(
+        user_id,
+        material_id,
+        {
+            **updates[material_id],
+            'last_tweet_id': tweet_id,
+            'last_posted_at': now,
+            **({'post_failures': 0} if material_dict.get('post_failures') else {}),
+        }
+    )
+    schedule_review(user_id, material_id, next_review_time)
+
+def on_review_dropped(job: PostJob, error: Exception):
+    """Try a review whose post was given up again later, backing off while its posts keep failing."""
+    user_id, material_id = job.user_id, job.context['material_id']
+    if 'due_key' in job.context:
+        seen_reviews.release(job.context['due_key'])
+    material_dict = store.get_material(user_id, material_id)
+    if material_dict is None:
+        return
+    failures = material_dict.get('post_failures', 0) + 1
+    store.update_material(user_id, material_id, {'post_failures': failures})
+    schedule_review(user_id, material_id, datetime.now(tz=timezone) + timedelta(seconds=scheduler.backoff(failures)))
+    
+
+def review_text(material: QuoteMaterial | QuestionMaterial) -> str:
+    if isinstance(material, QuoteMaterial):
+        content = f"{material.content}\n({material.num_reviews} reviews)"
+        
+    elif isinstance(material, QuestionMaterial):
+        # if material.display_answer_as_reply:
+        #     content = f"{material.question}"
+        #     response = client.create_tweet(text=content, user_auth=False)
+        #     tweet_id = response.data['id']
+        #     time.sleep(0.1)
+        #     content = f"{material.answer}"
+        #     response = client.create_tweet(text=content, user_auth=False, in_reply_to_tweet_id=tweet_id)
+        #     tweet_id = response.data['id']
+        #     client.hide_reply(tweet_id, user_auth=False)
+        # else:
+        #     content = f"{material.question}"
+        #     client.create_tweet(text=content, user_auth=False)
+        content = f"{material.question}\n({material.num_reviews} reviews)"
+    
+    return content
+
+SCHEDULING_ALGORITHM = os.getenv('SCHEDULING_ALGORITHM', 'doubling')
+algorithm_params = {'fsrs': {'desired_retention': float(os.getenv('FSRS_DESIRED_RETENTION', 0.9))}}
+algorithms = {
+    name: spaced_repetition.get_algorithm(name, **algorithm_params.get(name, {}))
+    for name in spaced_repetition.ALGORITHMS
+}
+
+def algorithm_for(user_id: str) -> spaced_repetition.Algorithm:
+    return algorithms[user_cache.get(user_id).scheduling_algorithm or SCHEDULING_ALGORITHM]
+
+def lapse(user_id: str, material_ids: list[str]):
+    """Reschedule materials answered wrongly, all in one commit."""
+    materials = [(material_id, store.get_material(user_id, material_id)) for material_id in material_ids]
+    materials = [(material_id, material) for material_id, material in materials if material is not None]
+    if not materials:
+        return
+    updates = spaced_repetition.review_updates(algorithm_for(user_id), materials, AGAIN, datetime.now(tz=timezone))
+    with store.batch():
+        for material_id, update in updates.items():
+            store.update_material(user_id, material_id, {
+                **update,
+                'num_reviews': storage.Increment(1),
+                'lapses': storage.Increment(1),
+            })
+    for material_id, update in updates.items():
+        # replaces the pending entry instead of posting a duplicate review
+        schedule_review(user_id, material_id, update['next_review_time'])
+
+DIGEST_WINDOW_MINUTES = float(os.getenv('DIGEST_WINDOW_MINUTES', 0))
+DIGEST_MAX_ITEMS = int(os.getenv('DIGEST_MAX_ITEMS', 20))
+
+def digest_key(user_id: str) -> str:
+    return f"digest_{user_id}"
+
+def handle_digest(user_id: str, material_id: str, window: timedelta):
+    now = datetime.now(tz=timezone)
+    if dispatcher.is_queued(digest_key(user_id)):
+        # cards of the queued digest still look due until it is posted, so try again later
+        scheduler.schedule(user_id, material_id, now + window)
+        return
+    due = store.query_materials(user_id, limit=DIGEST_MAX_ITEMS, due_before=now + window)
+    if material_id not in {due_id for due_id, _ in due}:
+        material_dict = store.get_material(user_id, material_id)
+        if material_dict is not None:  # else deleted since it was scheduled
+            due = [(material_id, material_dict)] + due[:DIGEST_MAX_ITEMS - 1]
+    if not due:
+        return
+    items = []
+    for number, (due_id, material_dict) in enumerate(due, 1):
+        if due_id != material_id:
+            scheduler.cancel(user_id, due_id)
+        material = create_material_from_dict(material_dict)
+        is_question = isinstance(material, QuestionMaterial)
+        items.append({
+            'number': number,
+            'material_id': due_id,
+            'text': material.question if is_question else material.content,
+            'answer': material.answer if is_question else None,
+            'state': {key: material_dict[key] for key in spaced_repetition.STATE_FIELDS if key in material_dict},
+        })
+    parts = digest.digest_parts(items)
+    dispatcher.submit(
+        user_id,
+        parts[0],
+        kind='digest',
+        priority=REVIEW,
+        context={'items': items, 'parts': parts, 'part': 0},
+        key=digest_key(user_id),
+    )
+
+def on_digest_posted(job: PostJob, tweet_id: str):
+    user_id, context = job.user_id, job.context
+    items, part = context['items'], context['part']
+    reply_index.mark_own(tweet_id)
+    questions = [
+        {'number': item['number'], 'material_id': item['material_id'], 'question': item['text'], 'answer': item['answer']}
+        for item in items if item['answer'] is not None
+    ]
+    if questions:
+        # numbers run across the whole thread, so a reply anywhere in it can answer any card
+        reply_index.add(tweet_id, ReplyRoute(user_id, None, None, None, items=questions))
+    root_id = context.get('root_id', tweet_id)
+    if part == 0:
+        # every card of the thread is rescheduled in one commit as soon as the thread starts
+        posted_at = datetime.now(tz=timezone)
+        updates = spaced_repetition.review_updates(
+            algorithm_for(user_id), [(item['material_id'], item['state']) for item in items], GOOD, posted_at
+        )
+        for update in updates.values():
+            update.update({'last_tweet_id': root_id, 'last_posted_at': posted_at})
+        try:
+            with store.batch():
+                for material_id, update in updates.items():
+                    store.update_material(user_id, material_id, update)
+        except Exception as e:
+            # a card deleted while the digest was queued fails the whole commit
+            logger.warning("Batched digest update failed, updating cards one by one",
+                           extra={'user_id': user_id, 'error': repr(e)})
+            for material_id, update in list(updates.items()):
+                try:
+                    store.update_material(user_id, material_id, update)
+                except Exception:
+                    del updates[material_id]
+        for material_id, update in updates.items():
+            schedule_review(user_id, material_id, update['next_review_time'])
+    if part + 1 < len(context['parts']):
+        dispatcher.submit(
+            user_id,
+            context['parts'][part + 1],
+            kind='digest',
+            priority=REVIEW,
+            in_reply_to=tweet_id,
+            context={**context, 'part': part + 1, 'root_id': root_id},
+            key=f"{digest_key(user_id)}_{root_id}_{part + 1}",
+        )
+
+def handle_digest_reply(user_id: str, tweet_id: str, route: ReplyRoute, text: str):
+    items = {item['number']: item for item in route.items}
+    answers = digest.parse_numbered_answers(text)
+    if not answers and len(items) == 1:
+        answers = {next(iter(items)): text}
+    answered = [(items[number], answer) for number, answer in sorted(answers.items()) if number in items]
+    if not answered:
+        send_reply(user_id, 'Reply with numbered answers, e.g. "1. ...", to get feedback.', tweet_id)
+        return
+    results = ai_utils.creat_feedbacks([(item['question'], item['answer'], answer) for item, answer in answered])
+    lines = [f"{item['number']}. {feedback}" for (item, _), (_, feedback) in zip(answered, results)]
+    for text in digest.pack_lines(lines):
+        send_reply(user_id, text, tweet_id)
+    lapse(user_id, [item['material_id'] for (item, _), (correct, _) in zip(answered, results) if not correct])
+
+def send_reply(user_id: str, text: str, in_reply_to: str):
+    dispatcher.submit(user_id, text, kind='reply', priority=REPLY, in_reply_to=in_reply_to)
+
+def on_reply_posted(job: PostJob, tweet_id: str):
+    reply_index.mark_own(tweet_id)
+
+scheduler = ReviewScheduler(
+    handle_review,
+    max_workers=int(os.getenv('REVIEW_WORKERS', 8)),
+    retry_seconds=float(os.getenv('REVIEW_RETRY_SECONDS', 5)),
+    max_retry_seconds=float(os.getenv('REVIEW_RETRY_MAX_SECONDS', 900)),
+    max_failures=int(os.getenv('REVIEW_RETRY_MAX_FAILURES', 10)),
+)
+review_loader = ReviewWindowLoader(
+    store,
+    scheduler,
+    window_hours=float(os.getenv('REVIEW_WINDOW_HOURS', 6)),
+    page_size=int(os.getenv('REVIEW_PAGE_SIZE', 500)),
+    refresh_minutes=float(os.getenv('REVIEW_REFRESH_MINUTES', 15)),
+)
+dispatcher = TweetDispatcher(
+    store,
+    client_for=lambda user_id: user_cache.get(user_id).client,
+    max_workers=int(os.getenv('TWEET_DISPATCH_WORKERS', 4)),
+    user_limit=int(os.getenv('X_USER_POST_LIMIT', 100)),
+    user_window=float(os.getenv('X_USER_POST_WINDOW_SECONDS', 900)),
+    app_limit=int(os.getenv('X_APP_POST_LIMIT', 10000)),
+    app_window=float(os.getenv('X_APP_POST_WINDOW_SECONDS', 86400)),
+    # the API process stores renewed tokens, so the workers' cached clients can be stale
+    invalidate=user_cache.invalidate,
+)
+dispatcher.register('review', on_review_posted, on_drop=on_review_dropped)
+dispatcher.register('reply', on_reply_posted)
+dispatcher.register('digest', on_digest_posted)
+counter_reconciler = CounterReconciler(store, interval_hours=float(os.getenv('COUNTER_RECONCILE_HOURS', 24)))
+
+review_requests = ReviewRequests(store, poll_seconds=float(os.getenv('REVIEW_REQUEST_POLL_SECONDS', 5)))
+runs_reviews = False  # set by start_reviews
+
+# users are split between workers only when SHARD_COUNT is set; every worker of a group must use the same count
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', 0))
+# every stream worker opens its own filtered stream, which X allows only with redundant connections (enterprise)
+STREAM_REDUNDANT_CONNECTIONS = bool(int(os.getenv('STREAM_REDUNDANT_CONNECTIONS', 0)))
+REVIEW_KINDS = ('review', 'digest')
+review_shards = None  # set by start_reviews when sharded
+stream_shards = None  # set by start_stream when sharded
+stream_events = None  # the StreamShards picking this worker's events, along with stream_shards
+WORKER_ID = os.getenv('WORKER_ID') or new_worker_id()
+
+def deduplicator(kind: str, group: str) -> Deduplicator:
+    def alive(owner: str) -> bool:
+        # without sharding a single process handles each group's events, so other claimants are gone
+        leases = review_shards if group == 'reviews' else stream_shards
+        return leases is not None and owner in leases.workers
+    return Deduplicator(
+        store,
+        kind,
+        WORKER_ID,
+        ttl_hours=float(os.getenv('DEDUP_TTL_HOURS', 24)),
+        window_seconds=float(os.getenv('DEDUP_WINDOW_SECONDS', 3600)),
+        max_size=int(os.getenv('DEDUP_MEMORY_SIZE', 100000)),
+        alive=alive,
+    )
+
+seen_tweets = deduplicator('seen_tweets', 'stream')
+seen_reviews = deduplicator('seen_reviews', 'reviews')
+
+def shard_leases(group: str, shards: int = SHARD_COUNT) -> ShardLeases | None:
+    if shards <= 0:
+        return None
+    return ShardLeases(
+        store,
+        group,
+        shards=shards,
+        lease_seconds=float(os.getenv('SHARD_LEASE_SECONDS', 30)),
+        renew_seconds=float(os.getenv('SHARD_RENEW_SECONDS', 10)),
+        margin_seconds=float(os.getenv('SHARD_LEASE_MARGIN_SECONDS', 5)),
+        worker_id=WORKER_ID,
+    )
+
+def owns_job(job: PostJob) -> bool:
+    shards = stream_shards if job.kind == 'reply' else review_shards
+    return shards is None or shards.owns(job.user_id)
+
+dispatcher.accept = owns_job
+
+def schedule_review(user_id: str, material_id: str, run_at: datetime):
+    """Put a review on the scheduler, or tell the process that runs it.
+
+    Reviews past the loaded window are left to the loader's next top-up.
+    """
+    if not runs_reviews or (review_shards is not None and not review_shards.owns(user_id)):
+        review_requests.add(user_id, material_id)
+    elif review_loader.covers(run_at):
+        scheduler.schedule(user_id, material_id, run_at)
+    else:
+        scheduler.cancel(user_id, material_id)
+
+def apply_review_request(user_id: str, material_id: str) -> bool:
+    if review_shards is not None and not review_shards.owns(user_id):
+        return False  # left for the worker holding the user's shard
+    material = store.get_material(user_id, material_id)
+    if material is None:
+        scheduler.cancel(user_id, material_id)
+    else:
+        schedule_review(user_id, material_id, material['next_review_time'])
+    return True
+
+def reviews_acquired(shards: set[int], released_at: dict[int, float]):
+    def picks(user_id: str) -> bool:
+        return review_shards.shard_of(user_id) in shards
+    loaded = review_loader.reload(picks)
+    posts = dispatcher.recover(kinds=REVIEW_KINDS, accept=lambda job: picks(job.user_id))
+    logger.info("Took over review shards", extra={'shards': sorted(shards), 'reviews': loaded, 'posts': posts})
+
+def reviews_released(shards: set[int]):
+    def picks(user_id: str) -> bool:
+        return review_shards.shard_of(user_id) in shards
+    scheduler.drop(lambda user_id, material_id: picks(user_id))
+    dispatcher.release(lambda job: job.kind in REVIEW_KINDS and picks(job.user_id))
+
+def start_reviews():
+    """Run the review scheduler in this process, with the posts left over by an earlier run."""
+    global runs_reviews, review_shards
+    runs_reviews = True
+    review_shards = shard_leases('reviews')
+    if review_shards is None:
+        review_loader.start()
+        logger.info("Rehydrated pending reviews", extra={'count': review_loader.loaded})
+        logger.info("Recovered queued posts", extra={'count': dispatcher.recover(kinds=REVIEW_KINDS)})
+    else:
+        # nothing is held yet, so the first load only sets the horizon; each shard is loaded as it is taken
+        review_loader.accept = review_shards.owns
+        review_shards.on_acquired = reviews_acquired
+        review_shards.on_released = reviews_released
+        review_loader.start()
+        review_shards.start()
+    review_requests.start(apply_review_request)
+
+def stop_reviews():
+    """Stop loading reviews and hand this worker's shards over."""
+    review_requests.stop()
+    review_loader.stop()
+    if review_shards is not None:
+        review_shards.stop()
+
+metrics.gauge('xlearn_queue_depth', "Items waiting in each in-process queue", ('queue',), collect=lambda: {
+    ('reviews',): scheduler.queue_depth,
+    ('stream',): stream_pipeline.queue_depth,
+    ('outbox',): dispatcher.queue_depth,
+})
+metrics.gauge('xlearn_review_dispatch_lag_current_seconds', "How late the most overdue pending review is",
+              collect=lambda: scheduler.dispatch_lag)
+metrics.counter('xlearn_reviews_total', "Due reviews run by the scheduler", ('outcome',), collect=lambda: {
+    ('dispatched',): scheduler.dispatched,
+    ('failed',): scheduler.failed,
+    ('retried',): scheduler.retried,
+    ('given_up',): scheduler.given_up,
+})
+metrics.counter('xlearn_stream_events_total', "Stream messages by what became of them", ('outcome',),
+                collect=lambda: {
+                    ('received',): stream_pipeline.received,
+                    ('keep_alive',): stream_pipeline.keep_alives,
+                    ('malformed',): stream_pipeline.malformed,
+                    ('handled',): stream_pipeline.handled,
+                    ('failed',): stream_pipeline.failed,
+                })
+metrics.counter('xlearn_stream_reconnects_total', "Stream reconnections", collect=lambda: stream_pipeline.reconnects)
+metrics.counter('xlearn_posts_total', "Tweets posted through the dispatcher by outcome", ('outcome',),
+                collect=lambda: {
+                    ('posted',): dispatcher.posted,
+                    ('throttled',): dispatcher.throttled,
+                    ('retried',): dispatcher.retried,
+                    ('dropped',): dispatcher.dropped,
+                })
+
+metrics.gauge('xlearn_shards_held', "Shards this worker holds a lease on", ('group',), collect=lambda: {
+    (group,): len(leases.held()) for group, leases in (('reviews', review_shards), ('stream', stream_shards))
+    if leases is not None
+})
+
+# the API adds its page fetcher when it starts
+caches = {'user': user_cache}
+
+def cache_lookups() -> dict:
+    values = {}
+    for name, cache in caches.items():
+        values[(name, 'hit')] = cache.hits
+        values[(name, 'miss')] = cache.misses
+    return values
+
+metrics.counter('xlearn_cache_lookups_total', "Cache lookups by cache and result", ('cache', 'result'),
+                collect=cache_lookups)
+
+def user_rule(user_id: str) -> dict:
+    # a single rule per user; replies are told apart from requests by reply_index
+    return {
+        "value": f"from:{user_id}",
+        "tag": f"user_{user_id}"
+    }
+
+def stream_event_user_id(json_response: dict) -> str:
+    if 'author_id' in json_response['data']:
+        return json_response['data']['author_id']
+    return json_response['matching_rules'][0]['tag'].split('_')[-1]
+
+def replied_to_id(tweet: dict) -> str | None:
+    for referenced_tweet in tweet.get('referenced_tweets', []):
+        if referenced_tweet['type'] == 'replied_to':
+            return referenced_tweet['id']
+    return None
+
+def search_conversation(user_id: str, conversation_id: str, since_id: str | None = None) -> list[dict]:
+    def search():
+        return user_cache.get(user_id).client.search_recent_tweets(
+            query=f"conversation_id:{conversation_id}", since_id=since_id, tweet_fields=['text', 'author_id'])
+    try:
+        tweets = search()
+    except tweepy.Unauthorized:
+        user_cache.invalidate(user_id)  # the token may have been renewed by the API process
+        tweets = search()
+    # no matches come back without data
+    return [{'id': tweet['id'], 'author_id': tweet['author_id'], 'text': tweet['text']} for tweet in tweets.data or []]
+
+conversations = ConversationCache(
+    store,
+    fetch=search_conversation,
+    summarize=ai_utils.summarize_conversation,
+    token_budget=int(os.getenv('CONVERSATION_TOKEN_BUDGET', 2000)),
+    idle_seconds=float(os.getenv('CONVERSATION_IDLE_SECONDS', 3600)),
+    max_size=int(os.getenv('CONVERSATION_CACHE_SIZE', 10000)),
+)
+
+def handle_stream_event(json_response: dict):
+    """Respond to a stream event once, however often the stream or a shard replay delivers it."""
+    tweet_id = json_response['data']['id']
+    # our own replies are part of the conversations too
+    conversations.observe(json_response['data'])
+    if reply_index.is_own(tweet_id) or not seen_tweets.claim(tweet_id):
+        return
+    try:
+        respond_to_tweet(json_response)
+    except Exception:
+        seen_tweets.release(tweet_id)
+        raise
+    seen_tweets.done(tweet_id)
+
+def respond_to_tweet(json_response: dict):
+    tweet = json_response['data']
+    tweet_id = tweet['id']
+    user_id = stream_event_user_id(json_response)
+    conversation_id = tweet.get('conversation_id')
+    route = reply_index.lookup(replied_to_id(tweet), conversation_id)
+    if route is not None and conversation_id == tweet_id:
+        return  # the posted question itself
+    user = user_cache.get(user_id)
+    
+    if route is None or f'@{user.username}' in tweet['text']:
+        summary, context_tweets = conversations.context(user_id, tweet, replied_to_id(tweet))
+        if summary is not None:
+            context_tweets = [{'author': 'summary', 'text': summary}] + context_tweets
+        action_dict = ai_utils.create_action(context_tweets)
+        logger.info("Action requested", extra={'user_id': user_id, 'tweet_id': tweet_id, 'action': action_dict})
+        if action_dict["action"]['type'] == 'add_material':
+            question = action_dict["action"]['question']
+            answer = action_dict["action"]['answer']
+            question_material = QuestionMaterial(
+                type="question",
+                question=question,
+                answer=answer,
+                next_review_time=datetime.now(tz=timezone),
+            )
+            material_id = store.add_material(user_id, asdict(question_material))
+            schedule_review(user_id, material_id, question_material.next_review_time)
+            tweet_content = f"Question successfully added. \nQuestion: {question}\nAnswer: {answer}"[:270]
+            send_reply(user_id, tweet_content, tweet_id)
+        elif action_dict["action"]['type'] == 'count_materials':
+            count = store.material_stats(user_id, datetime.now(tz=timezone))['total']
+            tweet_content = f"{action_dict['message_to_user']}\nYou have {count} study materials so far."
+            send_reply(user_id, tweet_content, tweet_id)
+        
+        elif action_dict["action"]['type'] == 'delete_material':
+            raise NotImplementedError("Delete material action is not implemented yet")
+        
+    elif route.items:
+        handle_digest_reply(user_id, tweet_id, route, tweet['text'])
+    else:
+        user_answer = tweet['text']
+        correct, feedback = ai_utils.creat_feedback(route.question, route.answer, user_answer)
+        send_reply(user_id, feedback, tweet_id)
+        if not correct:
+            lapse(user_id, [route.material_id])
+
+
+stream_pipeline = StreamPipeline(
+    handle_stream_event,
+    key=stream_event_user_id,
+    num_workers=int(os.getenv('STREAM_WORKERS', 4)),
+    queue_size=int(os.getenv('STREAM_QUEUE_SIZE', 1000)),
+)
+
+def start_listening():
+    stream_pipeline.run()
+            
+def add_initial_rules():
+    # X user ids grow over time, so numeric order keeps earlier packed rules unchanged when users join
+    user_ids = sorted(store.list_user_ids(), key=lambda user_id: (len(user_id), user_id))
+    rules = x_streaming.pack_rules([user_rule(user_id)["value"] for user_id in user_ids], tag_prefix="users")
+    logger.info("Synced stream rules", extra={'result': x_streaming.sync_rules(rules)})
+
+def replies_acquired(shards: set[int], released_at: dict[int, float]):
+    posts = dispatcher.recover(kinds=('reply',), accept=lambda job: stream_shards.shard_of(job.user_id) in shards)
+    logger.info("Took over stream shards", extra={'shards': sorted(shards), 'posts': posts})
+
+def replies_released(shards: set[int]):
+    # events accepted so far are handled here; the next owner replays those arriving from now on
+    if not stream_pipeline.drain():
+        logger.warning("Stream handlers did not catch up before handing shards over", extra={'shards': sorted(shards)})
+    dispatcher.release(lambda job: job.kind == 'reply' and stream_shards.shard_of(job.user_id) in shards)
+
+def start_stream():
+    """Sync the stream rules, finish replies of an earlier run and read the stream until it stops.
+
+    When sharded, every stream worker reads the whole stream and handles the
+    events of its own users only. That takes X's redundant connections, so
+    unless STREAM_REDUNDANT_CONNECTIONS is set the stream has a single shard
+    and a worker started while another one holds it refuses to run.
+    """
+    global stream_shards, stream_events
+    single = SHARD_COUNT > 0 and not STREAM_REDUNDANT_CONNECTIONS
+    if single and any(worker_id != WORKER_ID for worker_id, _ in store.list_records('stream_workers')):
+        raise RuntimeError("Another stream worker is running; set STREAM_REDUNDANT_CONNECTIONS=1 to run several")
+    stream_shards = shard_leases('stream', 1 if single else SHARD_COUNT)
+    if stream_shards is None:
+        add_initial_rules()
+        logger.info("Recovered queued replies", extra={'count': dispatcher.recover(kinds=('reply',))})
+    else:
+        # a dead worker renewed its leases last at most lease + renew seconds before its shards are recovered
+        replay_seconds = stream_shards.lease_seconds + 2 * stream_shards.renew_seconds
+        stream_events = StreamShards(stream_shards, key=stream_event_user_id, submit=stream_pipeline.submit,
+                                     replay_seconds=float(os.getenv('STREAM_REPLAY_SECONDS', replay_seconds)))
+        stream_pipeline.accept = stream_events.accept
+
+        def acquired(shards: set[int], released_at: dict[int, float]):
+            replies_acquired(shards, released_at)
+            stream_events.on_acquired(shards, released_at)
+
+        stream_shards.on_acquired = acquired
+        stream_shards.on_released = replies_released
+        stream_shards.start()
+        if single and not stream_shards.holds(0):
+            # started alongside another worker, which got the stream
+            stream_shards.stop()
+            raise RuntimeError("Another stream worker is running; set STREAM_REDUNDANT_CONNECTIONS=1 to run several")
+        # the rules belong to the whole app, so one worker syncs them
+        if stream_shards.holds(0):
+            add_initial_rules()
+    start_listening()
+
+def stop_stream():
+    # the shards go first, so events read after they are handed over are left to their next owner
+    if stream_shards is not None:
+        stream_shards.stop(released_at=stream_events.read_at)
+    stream_pipeline.stop()
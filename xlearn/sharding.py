@@ -0,0 +1,225 @@
+import hashlib
+import logging
+import os
+import random
+import socket
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from typing import Callable
+
+from xlearn import metrics
+from xlearn.storage import Store
+
+logger = logging.getLogger(__name__)
+
+LEASE_CHANGES = metrics.counter('xlearn_shard_lease_changes_total', "Shard leases taken or given up",
+                                ('group', 'change'))
+
+
+def _hash(value: str) -> int:
+    # not hash(): it is salted per process, and every worker must agree
+    return int.from_bytes(hashlib.sha1(value.encode()).digest()[:8], 'big')
+
+
+def shard_of(user_id: str, shards: int) -> int:
+    return _hash(str(user_id)) % shards
+
+
+def new_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}-{random.getrandbits(32):08x}"
+
+
+def owner_of(shard: int, workers: list[str]) -> str | None:
+    """Rendezvous hashing: a worker joining or leaving only moves the shards it wins or held."""
+    return max(workers, key=lambda worker: _hash(f"{worker}:{shard}"), default=None)
+
+
+class ShardLeases:
+    """Splits users between the live workers of a group by consistent hashing, with leases in the store.
+
+    Users hash to one of `shards` shards. Every `renew_seconds` a worker refreshes
+    its membership record (kind `<group>_workers`), works out which shards it
+    should own among the live members, and takes, renews or gives up the
+    matching lease records (kind `<group>_leases`) with `Store.swap_record`, so
+    at most one worker holds a shard at a time. A worker that dies stops
+    renewing and its shards move once its records expire after
+    `lease_seconds`; one that stops cleanly hands them over at once.
+
+    `owns(user_id)` is only true while the lease is held with `margin_seconds`
+    to spare, so a worker whose renewals stall stops working on a shard before
+    anyone else can take it. `on_released(shards)` is called before shards are
+    given up and should finish or stop all work on them; the lease then
+    records when that work stopped being accepted. `on_acquired(shards,
+    released_at)` is called with newly held shards and those times, which are
+    missing for shards recovered from an expired lease.
+    """
+
+    def __init__(self, store: Store, group: str, shards: int = 64, lease_seconds: float = 30,
+                 renew_seconds: float = 10, margin_seconds: float = 5, worker_id: str | None = None):
+        self.store = store
+        self.group = group
+        self.shards = shards
+        self.lease_seconds = lease_seconds
+        self.renew_seconds = renew_seconds
+        self.margin_seconds = margin_seconds
+        self.worker_id = worker_id or new_worker_id()
+        self.on_acquired = lambda shards, released_at: None
+        self.on_released = lambda shards: None
+        self.workers = []
+        self._held = {}  # shard -> monotonic time until which it may be worked on
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def _workers_kind(self) -> str:
+        return f"{self.group}_workers"
+
+    @property
+    def _leases_kind(self) -> str:
+        return f"{self.group}_leases"
+
+    def shard_of(self, user_id: str) -> int:
+        return shard_of(user_id, self.shards)
+
+    def holds(self, shard: int) -> bool:
+        with self._lock:
+            return self._held.get(shard, 0) > time.monotonic()
+
+    def owns(self, user_id: str) -> bool:
+        return self.holds(self.shard_of(user_id))
+
+    def held(self) -> list[int]:
+        now = time.monotonic()
+        with self._lock:
+            return sorted(shard for shard, until in self._held.items() if until > now)
+
+    def start(self):
+        """Join the group and take a first share of the shards before returning."""
+        self.rebalance()
+        self._thread = threading.Thread(target=self._run, name=f"{self.group}-shard-leases", daemon=True)
+        self._thread.start()
+
+    def stop(self, released_at: float | None = None):
+        """Leave the group, handing every held shard over as of `released_at` (now by default)."""
+        self._stopped.set()
+        with self._lock:
+            shards = set(self._held)
+        self._release(shards, released_at)
+        self.store.delete_record(self._workers_kind, self.worker_id)
+
+    def _run(self):
+        while not self._stopped.wait(self.renew_seconds):
+            try:
+                self.rebalance()
+            except Exception:
+                logger.exception("Failed to renew shard leases", extra={'group': self.group})
+
+    def rebalance(self):
+        started = time.monotonic()
+        expires_at = datetime.now(timezone.utc) + timedelta(seconds=self.lease_seconds)
+        self.store.put_record(self._workers_kind, self.worker_id, {'worker_id': self.worker_id}, expires_at)
+        self.workers = sorted(key for key, _ in self.store.list_records(self._workers_kind))
+        wanted = {shard for shard in range(self.shards) if owner_of(shard, self.workers) == self.worker_id}
+        with self._lock:
+            held = set(self._held)
+
+        mine = {'owner': self.worker_id}
+        until = started + self.lease_seconds - self.margin_seconds
+        lost = set()
+        for shard in held & wanted:
+            if self.store.swap_record(self._leases_kind, str(shard), mine, mine, expires_at):
+                with self._lock:
+                    self._held[shard] = until
+            else:
+                lost.add(shard)
+        if lost:
+            logger.warning("Shard leases lost", extra={'group': self.group, 'shards': sorted(lost)})
+            self._forget(lost)
+        self._release(held - wanted)
+
+        acquired, released_at = set(), {}
+        for shard in wanted - held:
+            # a handed-over lease has no owner; an expired one reads as missing
+            lease = self.store.get_record(self._leases_kind, str(shard))
+            if lease is not None and lease['owner'] is not None:
+                continue
+            if self.store.swap_record(self._leases_kind, str(shard), lease, mine, expires_at):
+                acquired.add(shard)
+                if lease is not None:
+                    released_at[shard] = lease['released_at']
+        if acquired:
+            with self._lock:
+                self._held.update((shard, until) for shard in acquired)
+            LEASE_CHANGES.inc(len(acquired), group=self.group, change='acquired')
+            logger.info("Shard leases acquired", extra={'group': self.group, 'shards': sorted(acquired),
+                                                        'recovered': sorted(acquired - set(released_at)),
+                                                        'workers': len(self.workers)})
+            self.on_acquired(acquired, released_at)
+
+    def _forget(self, shards: set[int]):
+        with self._lock:
+            for shard in shards:
+                self._held.pop(shard, None)
+        LEASE_CHANGES.inc(len(shards), group=self.group, change='lost')
+        self.on_released(shards)
+
+    def _release(self, shards: set[int], released_at: float | None = None):
+        if not shards:
+            return
+        # work stops before the leases are handed over, so the next owner never overlaps with us
+        released = {'owner': None, 'released_at': time.time() if released_at is None else released_at}
+        with self._lock:
+            for shard in shards:
+                self._held.pop(shard, None)
+        self.on_released(shards)
+        mine = {'owner': self.worker_id}
+        for shard in shards:
+            self.store.swap_record(self._leases_kind, str(shard), mine, released)
+        LEASE_CHANGES.inc(len(shards), group=self.group, change='released')
+        logger.info("Shard leases released", extra={'group': self.group, 'shards': sorted(shards)})
+
+
+class StreamShards:
+    """Picks the stream events of this worker's shards when every worker reads the whole stream.
+
+    Events are kept for `replay_seconds`. A shard taken over is caught up on
+    the events its previous owner did not accept: those since the lease was
+    handed over, or the whole window when it was recovered from a worker that
+    died, in which case those the dead worker handled after its last renewal
+    come round again, see dedup.Deduplicator. A worker that stops reading hands its shards
+    over as of `read_at`, since it never saw the events after that.
+    """
+
+    def __init__(self, leases: ShardLeases, key: Callable[[dict], str], submit: Callable[[dict], None],
+                 replay_seconds: float = 60, max_events: int = 10000):
+        self.leases = leases
+        self.key = key
+        self.submit = submit
+        self.replay_seconds = replay_seconds
+        self.skipped = 0
+        self.replayed = 0
+        self.read_at = None  # wall time of the latest event
+        self._recent = deque(maxlen=max_events)  # (wall time, shard, event, accepted)
+        self._lock = threading.Lock()
+
+    def accept(self, event: dict) -> bool:
+        shard = self.leases.shard_of(self.key(event))
+        with self._lock:
+            accepted = self.leases.holds(shard)
+            self.read_at = time.time()
+            self._recent.append((self.read_at, shard, event, accepted))
+        if not accepted:
+            self.skipped += 1
+        return accepted
+
+    def on_acquired(self, shards: set[int], released_at: dict[int, float]):
+        oldest = time.time() - self.replay_seconds
+        with self._lock:
+            events = [event for at, shard, event, accepted in self._recent
+                      if shard in shards and not accepted and at >= max(oldest, released_at.get(shard, oldest))]
+        self.replayed += len(events)
+        for event in events:
+            self.submit(event)
@@ -0,0 +1,260 @@
+from dataclasses import dataclass
+from datetime import datetime
+
+import numpy as np
+
+from xlearn.storage import Store
+
+AGAIN, HARD, GOOD, EASY = 1, 2, 3, 4
+
+# material fields that hold scheduling state, copied into digest items and the like
+STATE_FIELDS = ('review_interval_hours', 'ease', 'stability', 'difficulty', 'repetitions', 'last_posted_at',
+                'next_review_time')
+
+
+def _column(materials: list[dict], name: str, dtype=float) -> np.ndarray:
+    values = []
+    for material in materials:
+        value = material.get(name)
+        if isinstance(value, datetime):
+            value = value.timestamp()
+        values.append(np.nan if value is None else value)
+    return np.array(values, dtype=dtype)
+
+
+@dataclass
+class Cards:
+    """Scheduling state of many materials as parallel arrays, one slot per material.
+
+    Times are epoch seconds and missing values are NaN, so a material that an
+    algorithm has never seen can be recognized and initialized in bulk.
+    """
+
+    ids: list[str]
+    interval_hours: np.ndarray
+    ease: np.ndarray  # SM-2 easiness factor
+    stability: np.ndarray  # FSRS, days
+    difficulty: np.ndarray  # FSRS, 1..10
+    repetitions: np.ndarray  # successful reviews in a row
+    last_review: np.ndarray
+    due: np.ndarray
+
+    @classmethod
+    def from_materials(cls, materials: list[tuple[str, dict]]) -> 'Cards':
+        data = [material for _, material in materials]
+        return cls(
+            ids=[material_id for material_id, _ in materials],
+            interval_hours=_column(data, 'review_interval_hours'),
+            ease=_column(data, 'ease'),
+            stability=_column(data, 'stability'),
+            difficulty=_column(data, 'difficulty'),
+            repetitions=_column(data, 'repetitions'),
+            last_review=_column(data, 'last_posted_at'),
+            due=_column(data, 'next_review_time'),
+        )
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def fields(self, i: int, names: tuple[str, ...], tz=None) -> dict:
+        """Stored fields of card `i`: next_review_time, review_interval_hours and `names`."""
+        fields = {
+            'next_review_time': datetime.fromtimestamp(float(self.due[i]), tz=tz),
+            'review_interval_hours': float(self.interval_hours[i]),
+        }
+        for name in names:
+            value = getattr(self, name)[i]
+            if not np.isnan(value):
+                fields[name] = int(value) if name == 'repetitions' else float(value)
+        return fields
+
+
+class Algorithm:
+    """Updates the state of many cards at once.
+
+    A wrong answer (AGAIN) makes a card due `relearn_hours` later, immediately by
+    default, and lowers what the following successful review will schedule.
+    """
+
+    name = None
+    state_fields = ()  # algorithm-specific material fields
+
+    def __init__(self, relearn_hours: float = 0):
+        self.relearn_hours = relearn_hours
+
+    def prepare(self, cards: Cards):
+        """Fill in state this algorithm needs but the cards do not have yet."""
+
+    def review(self, cards: Cards, idx: np.ndarray, grades: np.ndarray, now: float):
+        raise NotImplementedError
+
+    def planned_interval_hours(self, cards: Cards) -> np.ndarray | None:
+        """Interval implied by the current state, for re-planning; None keeps the stored due times."""
+        return None
+
+
+class Doubling(Algorithm):
+    """The original schedule: wait the stored interval and double it; a lapse resets it."""
+
+    name = 'doubling'
+
+    def __init__(self, initial_hours: float = 3, factor: float = 2, relearn_hours: float = 0):
+        super().__init__(relearn_hours)
+        self.initial_hours = initial_hours
+        self.factor = factor
+
+    def prepare(self, cards):
+        cards.interval_hours[np.isnan(cards.interval_hours)] = self.initial_hours
+
+    def review(self, cards, idx, grades, now):
+        interval = cards.interval_hours[idx]
+        failed = grades == AGAIN
+        cards.due[idx] = now + np.where(failed, self.relearn_hours, interval) * 3600
+        cards.interval_hours[idx] = np.where(failed, self.initial_hours, interval * self.factor)
+
+
+class SM2(Algorithm):
+    name = 'sm2'
+    state_fields = ('ease', 'repetitions')
+
+    # SM-2 response quality per grade; below 3 is a lapse
+    QUALITY = np.array([0, 2, 3, 4, 5])
+
+    def __init__(self, initial_ease: float = 2.5, minimum_ease: float = 1.3, first_days: float = 1,
+                 second_days: float = 6, relearn_hours: float = 0):
+        super().__init__(relearn_hours)
+        self.initial_ease = initial_ease
+        self.minimum_ease = minimum_ease
+        self.first_days = first_days
+        self.second_days = second_days
+
+    def prepare(self, cards):
+        cards.ease[np.isnan(cards.ease)] = self.initial_ease
+        # cards coming from another algorithm keep growing from their current interval
+        unknown = np.isnan(cards.repetitions)
+        cards.repetitions[unknown] = np.where(np.isnan(cards.last_review[unknown]), 0, 2)
+        cards.interval_hours[np.isnan(cards.interval_hours)] = self.first_days * 24
+
+    def review(self, cards, idx, grades, now):
+        quality = self.QUALITY[grades]
+        failed = quality < 3
+        ease = cards.ease[idx] + 0.1 - (5 - quality) * (0.08 + (5 - quality) * 0.02)
+        ease = np.maximum(ease, self.minimum_ease)
+        repetitions = cards.repetitions[idx]
+        days = np.where(repetitions == 0, self.first_days,
+                        np.where(repetitions == 1, self.second_days, cards.interval_hours[idx] / 24 * ease))
+        cards.ease[idx] = ease
+        cards.repetitions[idx] = np.where(failed, 0, repetitions + 1)
+        cards.interval_hours[idx] = np.where(failed, self.first_days, days) * 24
+        cards.due[idx] = now + np.where(failed, self.relearn_hours, cards.interval_hours[idx]) * 3600
+
+
+class FSRS(Algorithm):
+    """Free Spaced Repetition Scheduler (FSRS-4.5 formulas and default weights)."""
+
+    name = 'fsrs'
+    state_fields = ('stability', 'difficulty', 'repetitions')
+
+    DEFAULT_WEIGHTS = (0.4872, 1.4003, 3.7145, 13.8206, 5.1618, 1.2298, 0.8975, 0.031, 1.6474, 0.1367, 1.0461,
+                       2.1072, 0.0793, 0.3246, 1.587, 0.2272, 2.8755)
+    DECAY = -0.5
+    FACTOR = 19 / 81  # retrievability is 0.9 when elapsed == stability
+
+    def __init__(self, weights: tuple[float, ...] = DEFAULT_WEIGHTS, desired_retention: float = 0.9,
+                 maximum_interval_days: float = 36500, relearn_hours: float = 0):
+        super().__init__(relearn_hours)
+        self.w = np.array(weights)
+        self.desired_retention = desired_retention
+        self.maximum_interval_days = maximum_interval_days
+
+    def _initial_difficulty(self, grades) -> np.ndarray:
+        return np.clip(self.w[4] - (grades - 3) * self.w[5], 1, 10)
+
+    def prepare(self, cards):
+        # at the default retention the interval equals the stability, so other algorithms' intervals carry over
+        known = np.isnan(cards.stability) & ~np.isnan(cards.interval_hours) & ~np.isnan(cards.last_review)
+        cards.stability[known] = np.maximum(cards.interval_hours[known] / 24, self.w[0])
+        cards.difficulty[np.isnan(cards.difficulty) & known] = self._initial_difficulty(np.array(GOOD))
+        cards.repetitions[np.isnan(cards.repetitions)] = np.where(known[np.isnan(cards.repetitions)], 1, 0)
+
+    def _interval_days(self, stability) -> np.ndarray:
+        days = stability / self.FACTOR * (self.desired_retention ** (1 / self.DECAY) - 1)
+        return np.clip(days, 1, self.maximum_interval_days)
+
+    def review(self, cards, idx, grades, now):
+        w = self.w
+        stability = cards.stability[idx]
+        difficulty = cards.difficulty[idx]
+        first = np.isnan(stability)
+        elapsed = np.nan_to_num((now - cards.last_review[idx]) / 86400, nan=0.0).clip(0)
+        safe_stability = np.where(first, 1.0, stability)
+        retrievability = (1 + self.FACTOR * elapsed / safe_stability) ** self.DECAY
+        safe_difficulty = np.where(first, self._initial_difficulty(grades), difficulty)
+
+        new_difficulty = w[7] * self._initial_difficulty(np.array(EASY)) + (1 - w[7]) * (safe_difficulty - w[6] * (grades - 3))
+        recalled = safe_stability * (
+            np.exp(w[8]) * (11 - safe_difficulty) * safe_stability ** -w[9] * (np.exp(w[10] * (1 - retrievability)) - 1)
+            * np.where(grades == HARD, w[15], 1) * np.where(grades == EASY, w[16], 1) + 1
+        )
+        forgotten = np.minimum(
+            w[11] * safe_difficulty ** -w[12] * ((safe_stability + 1) ** w[13] - 1) * np.exp(w[14] * (1 - retrievability)),
+            safe_stability,
+        )
+        failed = grades == AGAIN
+        cards.stability[idx] = np.where(first, w[grades - 1], np.where(failed, forgotten, recalled))
+        cards.difficulty[idx] = np.where(first, safe_difficulty, np.clip(new_difficulty, 1, 10))
+        cards.repetitions[idx] = np.where(failed, 0, np.nan_to_num(cards.repetitions[idx]) + 1)
+        cards.interval_hours[idx] = self._interval_days(cards.stability[idx]) * 24
+        cards.due[idx] = now + np.where(failed, self.relearn_hours, cards.interval_hours[idx]) * 3600
+
+    def planned_interval_hours(self, cards):
+        return self._interval_days(cards.stability) * 24
+
+
+ALGORITHMS = {algorithm.name: algorithm for algorithm in (Doubling, SM2, FSRS)}
+
+
+def get_algorithm(name: str, **params) -> Algorithm:
+    if name not in ALGORITHMS:
+        raise ValueError(f"Unknown scheduling algorithm: {name}")
+    return ALGORITHMS[name](**params)
+
+
+def review_updates(algorithm: Algorithm, materials: list[tuple[str, dict]], grades, now: datetime) -> dict[str, dict]:
+    """Fields to store for each reviewed material, computed for all of them in one pass."""
+    cards = Cards.from_materials(materials)
+    algorithm.prepare(cards)
+    grades = np.broadcast_to(np.asarray(grades, dtype=int), (len(cards),))
+    algorithm.review(cards, np.arange(len(cards)), grades, now.timestamp())
+    return {material_id: cards.fields(i, algorithm.state_fields, now.tzinfo) for i, material_id in enumerate(cards.ids)}
+
+
+def replan(algorithm: Algorithm, cards: Cards) -> np.ndarray:
+    """Move due times to what `algorithm` would plan from each card's state; returns the indices that changed."""
+    before = cards.due.copy()
+    algorithm.prepare(cards)
+    interval_hours = algorithm.planned_interval_hours(cards)
+    if interval_hours is not None:
+        reviewed = ~np.isnan(cards.last_review) & ~np.isnan(interval_hours)
+        cards.interval_hours[reviewed] = interval_hours[reviewed]
+        cards.due[reviewed] = cards.last_review[reviewed] + interval_hours[reviewed] * 3600
+    return np.flatnonzero(cards.due != before)  # NaN never compares equal, but NaN due times are never set here
+
+
+def replan_user(store: Store, algorithm: Algorithm, user_id: str, tz=None) -> dict[str, dict]:
+    """Re-plan every material of a user in one pass and write the changes in one batch."""
+    cards = Cards.from_materials(store.list_materials(user_id))
+    changed = replan(algorithm, cards)
+    updates = {cards.ids[i]: cards.fields(i, algorithm.state_fields, tz) for i in changed}
+    with store.batch():
+        for material_id, fields in updates.items():
+            store.update_material(user_id, material_id, fields)
+    return updates
+
+
+def forecast(due: np.ndarray, now: float, hours: float, bucket_hours: float = 1) -> np.ndarray:
+    """Number of cards falling due in each `bucket_hours` slot of the next `hours`; overdue cards count in the first."""
+    buckets = int(np.ceil(hours / bucket_hours))
+    offsets = (np.asarray(due, dtype=float) - now) / 3600
+    offsets = offsets[~np.isnan(offsets) & (offsets < buckets * bucket_hours)]
+    return np.bincount((np.maximum(offsets, 0) // bucket_hours).astype(int), minlength=buckets)[:buckets]
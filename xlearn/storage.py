@@ -0,0 +1,896 @@
+import bisect
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Callable, Iterator
+
+from xlearn import metrics
+
+
+STORE_LATENCY = metrics.histogram('xlearn_store_operation_seconds', "Latency of store reads and commits",
+                                  ('backend', 'operation', 'outcome'))
+
+# timed on every store instance; iter_due_materials is a generator, so wall time would include the consumer
+_TIMED_OPERATIONS = ('_commit', 'get_user', 'list_user_ids', 'get_material', 'list_materials', 'query_materials',
+                     'count_materials', 'count_due', 'reconcile_counters', 'put_record', 'get_record',
+                     'delete_record', 'list_records', 'purge_expired_records', 'swap_record')
+
+
+class Increment:
+    """Field value that adds to the stored number instead of replacing it."""
+
+    def __init__(self, value: int | float = 1):
+        self.value = value
+
+
+class Store:
+    """Users and their materials.
+
+    Writes made inside `with store.batch():` are collected and committed together
+    when the block exits; outside a batch every write is committed on its own.
+    Reads never see writes that are still pending in a batch.
+
+    Every commit that touches materials also updates the owners' `materials_*`
+    counters and bumps `materials_version` on their user documents, atomically
+    with the material writes, so stats and cached listings never need a scan.
+
+    Reads and commits are timed into `xlearn_store_operation_seconds`.
+    """
+
+    backend = None
+
+    def __init__(self):
+        self._local = threading.local()
+        for name in _TIMED_OPERATIONS:
+            timer = metrics.timed(STORE_LATENCY, backend=self.backend, operation=name.lstrip('_'))
+            setattr(self, name, timer(getattr(self, name)))
+
+    @contextmanager
+    def batch(self):
+        ops = getattr(self._local, 'ops', None)
+        if ops is not None:  # nested batches join the outer one
+            yield
+            return
+        self._local.ops = []
+        try:
+            yield
+            ops = self._local.ops
+        finally:
+            self._local.ops = None
+        if ops:
+            self._commit(ops)
+
+    def _write(self, op: tuple):
+        ops = getattr(self._local, 'ops', None)
+        if ops is None:
+            self._commit([op])
+        else:
+            ops.append(op)
+
+    def set_user(self, user_id: str, data: dict):
+        self._write(('set_user', user_id, None, data))
+
+    def update_user(self, user_id: str, fields: dict):
+        self._write(('update_user', user_id, None, fields))
+
+    def add_material(self, user_id: str, data: dict) -> str:
+        # set_material is only ever used with fresh ids
+        material_id = self._new_material_id(user_id)
+        self._write(('set_material', user_id, material_id, data))
+        return material_id
+
+    def update_material(self, user_id: str, material_id: str, fields: dict):
+        self._write(('update_material', user_id, material_id, fields))
+
+    def delete_material(self, user_id: str, material_id: str):
+        self._write(('delete_material', user_id, material_id, None))
+
+    def materials_version(self, user_id: str) -> int:
+        user = self.get_user(user_id)
+        return (user or {}).get('materials_version', 0)
+
+    def material_stats(self, user_id: str, now: datetime) -> dict:
+        """Counters from the user document plus the number of materials due at `now`."""
+        user = self.get_user(user_id) or {}
+        return {
+            'total': user.get('materials_total', 0),
+            'by_type': {
+                key[len(_TYPE_COUNTER):]: value for key, value in user.items()
+                if key.startswith(_TYPE_COUNTER) and value
+            },
+            'reviewed': user.get('materials_reviewed', 0),
+            'lapsed': user.get('materials_lapsed', 0),
+            'due_now': self.count_due(user_id, now),
+            'version': user.get('materials_version', 0),
+        }
+
+    def count_materials(self, user_id: str) -> int:
+        return len(self.list_materials(user_id))
+
+    def count_due(self, user_id: str, now: datetime) -> int:
+        raise NotImplementedError
+
+    def reconcile_counters(self, user_id: str) -> dict:
+        """Recount the user's materials and overwrite drifted counters; returns the corrected values."""
+        raise NotImplementedError
+
+    def _with_counters(self, ops: list[tuple], load: Callable[[str, str], dict | None]) -> list[tuple]:
+        """`ops` followed by the user writes that keep the owners' counters in step with them.
+
+        `load(user_id, material_id)` returns a material as stored before this commit.
+        """
+        deltas = {}
+        current = {}
+        for kind, user_id, material_id, data in ops:
+            if not kind.endswith('_material'):
+                continue
+            delta = deltas.setdefault(user_id, {'materials_version': 1})
+            if kind == 'update_material' and not _COUNTED_FIELDS.intersection(data):
+                continue
+            key = (user_id, material_id)
+            old = current[key] if key in current else load(user_id, material_id)
+            if kind == 'set_material':
+                new = dict(data)
+            elif kind == 'delete_material' or old is None:  # updating a missing material fails the commit
+                new = None
+            else:
+                new = dict(old)
+                _apply_fields(new, data)
+            current[key] = new
+            for name, value in material_counters(new).items():
+                delta[name] = delta.get(name, 0) + value
+            for name, value in material_counters(old).items():
+                delta[name] = delta.get(name, 0) - value
+        # merged rather than updated so that it never fails on a missing user document
+        return ops + [
+            ('merge_user', user_id, None, {name: Increment(value) for name, value in delta.items() if value})
+            for user_id, delta in deltas.items()
+        ]
+
+    @staticmethod
+    def _corrections(user: dict | None, materials: list[dict]) -> dict:
+        counts = {}
+        for material in materials:
+            for name, value in material_counters(material).items():
+                counts[name] = counts.get(name, 0) + value
+        stored = {key: value for key, value in (user or {}).items() if key in _COUNTERS or key.startswith(_TYPE_COUNTER)}
+        names = set(stored) | set(counts)
+        return {name: counts.get(name, 0) for name in names if stored.get(name, 0) != counts.get(name, 0)}
+
+    def _new_material_id(self, user_id: str) -> str:
+        return uuid.uuid4().hex[:20]
+
+    def _commit(self, ops: list[tuple]):
+        raise NotImplementedError
+
+    def get_user(self, user_id: str) -> dict | None:
+        raise NotImplementedError
+
+    def list_user_ids(self) -> list[str]:
+        raise NotImplementedError
+
+    def get_material(self, user_id: str, material_id: str) -> dict | None:
+        raise NotImplementedError
+
+    def list_materials(self, user_id: str) -> list[tuple[str, dict]]:
+        raise NotImplementedError
+
+    def query_materials(self, user_id: str, limit: int = 100, after: tuple[float, str] | None = None,
+                        type: str | None = None, due_before: datetime | None = None, source: str | None = None,
+                        fields: list[str] | None = None) -> list[tuple[str, dict]]:
+        """One page of a user's materials ordered by (next_review_time, id).
+
+        `after` is the (next_review_time timestamp, id) of the last item of the
+        previous page. `fields` limits the returned fields (next_review_time is
+        always included so the next cursor can be built).
+        """
+        raise NotImplementedError
+
+    def iter_due_materials(self, end: datetime, start: datetime | None = None,
+                           page_size: int = 500) -> Iterator[tuple[str, str, datetime]]:
+        """Yield (user_id, material_id, next_review_time) for every material with
+        start < next_review_time <= end across all users, oldest first."""
+        raise NotImplementedError
+
+    # Records are small documents outside the user tree (reply routes, ...), grouped
+    # by kind and optionally expiring. Expired records read as missing.
+
+    def put_record(self, kind: str, key: str, data: dict, expires_at: datetime | None = None):
+        raise NotImplementedError
+
+    def get_record(self, kind: str, key: str) -> dict | None:
+        raise NotImplementedError
+
+    def delete_record(self, kind: str, key: str):
+        raise NotImplementedError
+
+    def list_records(self, kind: str) -> list[tuple[str, dict]]:
+        """Every unexpired record of a kind; meant for small kinds such as queues."""
+        raise NotImplementedError
+
+    def purge_expired_records(self, kind: str, now: datetime) -> int:
+        raise NotImplementedError
+
+    def swap_record(self, kind: str, key: str, expected: dict | None, data: dict,
+                    expires_at: datetime | None = None) -> bool:
+        """Write the record only if it currently reads as `expected` (None: missing or expired), atomically.
+
+        Returns whether it was written; leases are built on this.
+        """
+        raise NotImplementedError
+
+
+_COUNTERS = ('materials_total', 'materials_reviewed', 'materials_lapsed')
+_TYPE_COUNTER = 'materials_type_'
+_COUNTED_FIELDS = {'type', 'last_posted_at', 'lapses'}
+
+
+def material_counters(data: dict | None) -> dict:
+    """What one material adds to its owner's materials_* counters."""
+    if data is None:
+        return {}
+    counters = {'materials_total': 1, f"{_TYPE_COUNTER}{data.get('type')}": 1}
+    if data.get('last_posted_at') is not None:
+        counters['materials_reviewed'] = 1
+    if data.get('lapses'):
+        counters['materials_lapsed'] = 1
+    return counters
+
+
+def _apply_fields(data: dict, fields: dict):
+    for key, value in fields.items():
+        if isinstance(value, Increment):
+            data[key] = (data.get(key) or 0) + value.value
+        else:
+            data[key] = value
+
+
+def _timestamp(value) -> float | None:
+    return value.timestamp() if isinstance(value, datetime) else None
+
+
+def _project(data: dict, fields: list[str] | None) -> dict:
+    if fields is None:
+        return dict(data)
+    return {key: value for key, value in data.items() if key in fields or key == 'next_review_time'}
+
+
+class FirestoreStore(Store):
+
+    backend = 'firestore'
+    MAX_BATCH_SIZE = 500
+
+    def __init__(self, db=None):
+        super().__init__()
+        self._db = db
+        self._db_lock = threading.Lock()
+
+    @property
+    def _firestore(self):
+        from firebase_admin import firestore
+        return firestore
+
+    @property
+    def db(self):
+        """The Firestore client, created on first use so importing and constructing the store stay cheap."""
+        if self._db is None:
+            with self._db_lock:
+                if self._db is None:
+                    _initialize_firebase()
+                    self._db = self._firestore.client()
+        return self._db
+
+    def _user(self, user_id: str):
+        return self.db.collection('users').document(user_id)
+
+    def _material(self, user_id: str, material_id: str):
+        return self._user(user_id).collection('materials').document(material_id)
+
+    def _new_material_id(self, user_id: str) -> str:
+        return self._user(user_id).collection('materials').document().id
+
+    def _convert(self, fields: dict) -> dict:
+        return {
+            key: self._firestore.Increment(value.value) if isinstance(value, Increment) else value
+            for key, value in fields.items()
+        }
+
+    def _commit(self, ops: list[tuple]):
+        if any(kind.endswith('_material') for kind, *_ in ops):
+            # every material write may add a counter write for its owner
+            commit = self._firestore.transactional(self._commit_counted)
+            for i in range(0, len(ops), self.MAX_BATCH_SIZE // 2):
+                commit(self.db.transaction(), ops[i:i + self.MAX_BATCH_SIZE // 2])
+            return
+        if len(ops) == 1:
+            self._apply(None, ops[0])
+            return
+        for i in range(0, len(ops), self.MAX_BATCH_SIZE):
+            batch = self.db.batch()
+            for op in ops[i:i + self.MAX_BATCH_SIZE]:
+                self._apply(batch, op)
+            batch.commit()
+
+    def _commit_counted(self, transaction, ops: list[tuple]):
+        refs = [
+            self._material(user_id, material_id) for kind, user_id, material_id, data in ops
+            if kind == 'delete_material' or (kind == 'update_material' and _COUNTED_FIELDS.intersection(data))
+        ]
+        snapshots = {}
+        if refs:
+            snapshots = {doc.reference.path: doc.to_dict() for doc in self.db.get_all(refs, transaction=transaction)}
+        for op in self._with_counters(ops, lambda user_id, material_id: snapshots.get(self._material(user_id, material_id).path)):
+            self._apply(transaction, op)
+
+    def _apply(self, batch, op: tuple):
+        kind, user_id, material_id, data = op
+        target = self._user(user_id) if material_id is None else self._material(user_id, material_id)
+        if kind == 'delete_material':
+            batch.delete(target) if batch else target.delete()
+        elif kind == 'merge_user':
+            batch.set(target, self._convert(data), merge=True) if batch else target.set(self._convert(data), merge=True)
+        elif kind.startswith('set_'):
+            batch.set(target, self._convert(data)) if batch else target.set(self._convert(data))
+        else:
+            batch.update(target, self._convert(data)) if batch else target.update(self._convert(data))
+
+    def get_user(self, user_id: str) -> dict | None:
+        return self._user(user_id).get().to_dict()
+
+    def list_user_ids(self) -> list[str]:
+        return [user.id for user in self.db.collection('users').select([]).stream()]
+
+    def get_material(self, user_id: str, material_id: str) -> dict | None:
+        return self._material(user_id, material_id).get().to_dict()
+
+    def list_materials(self, user_id: str) -> list[tuple[str, dict]]:
+        return [(doc.id, doc.to_dict()) for doc in self._user(user_id).collection('materials').stream()]
+
+    def count_materials(self, user_id: str) -> int:
+        result = self._user(user_id).collection('materials').count().get()
+        return int(result[0][0].value)
+
+    def count_due(self, user_id: str, now: datetime) -> int:
+        FieldFilter = self._firestore.FieldFilter
+        query = self._user(user_id).collection('materials').where(filter=FieldFilter('next_review_time', '<=', now))
+        return int(query.count().get()[0][0].value)
+
+    def reconcile_counters(self, user_id: str) -> dict:
+        materials = self._user(user_id).collection('materials').select(sorted(_COUNTED_FIELDS))
+
+        @self._firestore.transactional
+        def reconcile(transaction):
+            user = self._user(user_id).get(transaction=transaction).to_dict()
+            corrections = self._corrections(user, [doc.to_dict() for doc in materials.stream(transaction=transaction)])
+            if corrections:
+                transaction.set(self._user(user_id), corrections, merge=True)
+            return corrections
+
+        return reconcile(self.db.transaction())
+
+    def query_materials(self, user_id, limit=100, after=None, type=None, due_before=None, source=None, fields=None):
+        # equality filters combined with the ordering need composite indexes
+        FieldFilter = self._firestore.FieldFilter
+        query = self._user(user_id).collection('materials')
+        if type is not None:
+            query = query.where(filter=FieldFilter('type', '==', type))
+        if source is not None:
+            query = query.where(filter=FieldFilter('source', '==', source))
+        if due_before is not None:
+            query = query.where(filter=FieldFilter('next_review_time', '<=', due_before))
+        query = query.order_by('next_review_time').order_by(self._firestore.FieldPath.document_id())
+        if fields is not None:
+            query = query.select(sorted(set(fields) | {'next_review_time'}))
+        if after is not None:
+            query = query.start_after({
+                'next_review_time': datetime.fromtimestamp(after[0], tz=timezone.utc),
+                '__name__': self._material(user_id, after[1]),
+            })
+        return [(doc.id, doc.to_dict()) for doc in query.limit(limit).stream()]
+
+    def iter_due_materials(self, end, start=None, page_size=500):
+        # needs a collection-group index on materials.next_review_time
+        FieldFilter = self._firestore.FieldFilter
+        query = self.db.collection_group('materials').where(filter=FieldFilter('next_review_time', '<=', end))
+        if start is not None:
+            query = query.where(filter=FieldFilter('next_review_time', '>', start))
+        query = query.order_by('next_review_time').select(['next_review_time']).limit(page_size)
+        last = None
+        while True:
+            page = list((query.start_after(last) if last is not None else query).stream())
+            for doc in page:
+                yield doc.reference.parent.parent.id, doc.id, doc.get('next_review_time')
+            if len(page) < page_size:
+                return
+            last = page[-1]
+
+    # records live in a top-level collection per kind; a Firestore TTL policy on
+    # expires_at can take over purging
+
+    def put_record(self, kind, key, data, expires_at=None):
+        self.db.collection(kind).document(key).set({**data, 'expires_at': expires_at})
+
+    def get_record(self, kind, key):
+        record = self.db.collection(kind).document(key).get().to_dict()
+        if record is None:
+            return None
+        expires_at = record.pop('expires_at', None)
+        if expires_at is not None and expires_at <= datetime.now(timezone.utc):
+            return None
+        return record
+
+    def delete_record(self, kind, key):
+        self.db.collection(kind).document(key).delete()
+
+    def list_records(self, kind):
+        now = datetime.now(timezone.utc)
+        records = []
+        for doc in self.db.collection(kind).stream():
+            record = doc.to_dict()
+            expires_at = record.pop('expires_at', None)
+            if expires_at is None or expires_at > now:
+                records.append((doc.id, record))
+        return records
+
+    def swap_record(self, kind, key, expected, data, expires_at=None):
+        ref = self.db.collection(kind).document(key)
+
+        @self._firestore.transactional
+        def swap(transaction):
+            record = ref.get(transaction=transaction).to_dict()
+            if record is not None:
+                record_expires_at = record.pop('expires_at', None)
+                if record_expires_at is not None and record_expires_at <= datetime.now(timezone.utc):
+                    record = None
+            if record != expected:
+                return False
+            transaction.set(ref, {**data, 'expires_at': expires_at})
+            return True
+
+        return swap(self.db.transaction())
+
+    def purge_expired_records(self, kind, now):
+        FieldFilter = self._firestore.FieldFilter
+        expired = self.db.collection(kind).where(filter=FieldFilter('expires_at', '<=', now)).select([]).stream()
+        count = 0
+        batch = self.db.batch()
+        for doc in expired:
+            batch.delete(doc.reference)
+            count += 1
+            if count % self.MAX_BATCH_SIZE == 0:
+                batch.commit()
+                batch = self.db.batch()
+        batch.commit()
+        return count
+
+
+def _initialize_firebase():
+    import firebase_admin
+    from firebase_admin import credentials
+
+    if firebase_admin._apps:
+        return
+    # check if there is firebase_admin.json file in the root directory
+    if os.path.isfile("firebase_admin.json"):
+        cred = credentials.Certificate("firebase_admin.json")
+        firebase_admin.initialize_app(cred)
+    else:
+        firebase_admin.initialize_app(
+            credential=credentials.Certificate({
+                "type": "service_account",
+                "project_id": os.environ.get('FIREBASE_PROJECT_ID'),
+                "private_key_id": os.environ.get('PRIVATE_KEY_ID'),
+                "private_key": os.environ.get('FIREBASE_PRIVATE_KEY').replace('\\n', '\n'),
+                "client_email": os.environ.get('FIREBASE_CLIENT_EMAIL'),
+                "client_id": os.environ.get('CLIENT_ID_FIREBASE'),
+                "auth_uri": os.environ.get('AUTH_URI'),
+                "token_uri": os.environ.get('TOKEN_URI'),
+                "auth_provider_x509_cert_url": os.environ.get('AUTH_PROVIDER_X509_CERT_URL'),
+                "client_x509_cert_url": os.environ.get('CLIENT_X509_CERT_URL'),
+            }),
+        )
+
+
+_MAX_KEY = '\U0010ffff'  # sorts after every id, for bisecting on the timestamp alone
+
+
+class MemoryStore(Store):
+    """Process-local store, with a (next_review_time, user_id, material_id) index."""
+
+    backend = 'memory'
+
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.RLock()
+        self._users = {}
+        self._materials = {}  # user_id -> {material_id: data}
+        self._due = []  # sorted (next_review_time ts, user_id, material_id)
+        self._user_due = {}  # user_id -> sorted (next_review_time ts, material_id)
+        self._records = {}  # (kind, key) -> (data, expires_at ts or None)
+
+    def _index_remove(self, user_id: str, material_id: str, data: dict):
+        ts = _timestamp(data.get('next_review_time'))
+        if ts is None:
+            return
+        i = bisect.bisect_left(self._due, (ts, user_id, material_id))
+        if i < len(self._due) and self._due[i] == (ts, user_id, material_id):
+            del self._due[i]
+        user_due = self._user_due.get(user_id, [])
+        i = bisect.bisect_left(user_due, (ts, material_id))
+        if i < len(user_due) and user_due[i] == (ts, material_id):
+            del user_due[i]
+
+    def _index_add(self, user_id: str, material_id: str, data: dict):
+        ts = _timestamp(data.get('next_review_time'))
+        if ts is not None:
+            bisect.insort(self._due, (ts, user_id, material_id))
+            bisect.insort(self._user_due.setdefault(user_id, []), (ts, material_id))
+
+    def _commit(self, ops: list[tuple]):
+        with self._lock:
+            ops = self._with_counters(ops, lambda user_id, material_id: self._materials.get(user_id, {}).get(material_id))
+            for kind, user_id, material_id, data in ops:
+                if kind == 'set_user':
+                    self._users[user_id] = dict(data)
+                elif kind == 'update_user':
+                    if user_id not in self._users:
+                        raise KeyError(f"No user {user_id}")
+                    _apply_fields(self._users[user_id], data)
+                elif kind == 'merge_user':
+                    _apply_fields(self._users.setdefault(user_id, {}), data)
+                else:
+                    materials = self._materials.setdefault(user_id, {})
+                    old = materials.get(material_id)
+                    if old is not None:
+                        self._index_remove(user_id, material_id, old)
+                    if kind == 'delete_material':
+                        materials.pop(material_id, None)
+                        continue
+                    if kind == 'set_material':
+                        new = dict(data)
+                    else:
+                        if old is None:
+                            raise KeyError(f"No material {user_id}/{material_id}")
+                        new = dict(old)
+                        _apply_fields(new, data)
+                    materials[material_id] = new
+                    self._index_add(user_id, material_id, new)
+
+    def get_user(self, user_id):
+        with self._lock:
+            user = self._users.get(user_id)
+            return dict(user) if user is not None else None
+
+    def list_user_ids(self):
+        with self._lock:
+            return list(self._users)
+
+    def get_material(self, user_id, material_id):
+        with self._lock:
+            material = self._materials.get(user_id, {}).get(material_id)
+            return dict(material) if material is not None else None
+
+    def list_materials(self, user_id):
+        with self._lock:
+            return [(material_id, dict(data)) for material_id, data in self._materials.get(user_id, {}).items()]
+
+    def count_materials(self, user_id):
+        with self._lock:
+            return len(self._materials.get(user_id, {}))
+
+    def count_due(self, user_id, now):
+        with self._lock:
+            return bisect.bisect_right(self._user_due.get(user_id, []), (now.timestamp(), _MAX_KEY))
+
+    def reconcile_counters(self, user_id):
+        with self._lock:
+            corrections = self._corrections(self._users.get(user_id), list(self._materials.get(user_id, {}).values()))
+            if corrections:
+                self._users.setdefault(user_id, {}).update(corrections)
+            return corrections
+
+    def query_materials(self, user_id, limit=100, after=None, type=None, due_before=None, source=None, fields=None):
+        with self._lock:
+            user_due = self._user_due.get(user_id, [])
+            materials = self._materials.get(user_id, {})
+            i = 0 if after is None else bisect.bisect_right(user_due, tuple(after))
+            end_ts = None if due_before is None else due_before.timestamp()
+            page = []
+            while i < len(user_due) and len(page) < limit:
+                ts, material_id = user_due[i]
+                i += 1
+                if end_ts is not None and ts > end_ts:
+                    break
+                data = materials[material_id]
+                if (type is None or data.get('type') == type) and (source is None or data.get('source') == source):
+                    page.append((material_id, _project(data, fields)))
+            return page
+
+    def iter_due_materials(self, end, start=None, page_size=500):
+        with self._lock:
+            lo = 0 if start is None else bisect.bisect_right(self._due, (start.timestamp(), _MAX_KEY))
+            hi = bisect.bisect_right(self._due, (end.timestamp(), _MAX_KEY))
+            entries = self._due[lo:hi]
+        for ts, user_id, material_id in entries:
+            yield user_id, material_id, datetime.fromtimestamp(ts, tz=timezone.utc)
+
+    def put_record(self, kind, key, data, expires_at=None):
+        with self._lock:
+            self._records[(kind, key)] = (dict(data), _timestamp(expires_at))
+
+    def get_record(self, kind, key):
+        with self._lock:
+            record = self._records.get((kind, key))
+        if record is None or (record[1] is not None and record[1] <= time.time()):
+            return None
+        return dict(record[0])
+
+    def delete_record(self, kind, key):
+        with self._lock:
+            self._records.pop((kind, key), None)
+
+    def list_records(self, kind):
+        now = time.time()
+        with self._lock:
+            return [(k[1], dict(data)) for k, (data, expires_at) in self._records.items()
+                    if k[0] == kind and (expires_at is None or expires_at > now)]
+
+    def purge_expired_records(self, kind, now):
+        now_ts = now.timestamp()
+        with self._lock:
+            expired = [k for k, (_, expires_at) in self._records.items()
+                       if k[0] == kind and expires_at is not None and expires_at <= now_ts]
+            for k in expired:
+                del self._records[k]
+        return len(expired)
+
+    def swap_record(self, kind, key, expected, data, expires_at=None):
+        with self._lock:
+            record = self._records.get((kind, key))
+            current = None if record is None or (record[1] is not None and record[1] <= time.time()) else record[0]
+            if current != expected:
+                return False
+            self._records[(kind, key)] = (dict(data), _timestamp(expires_at))
+            return True
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return {'__datetime__': value.timestamp()}
+    raise TypeError(f"Cannot store {type(value).__name__}")
+
+
+def _decode(obj: dict):
+    if '__datetime__' in obj:
+        return datetime.fromtimestamp(obj['__datetime__'], tz=timezone.utc)
+    return obj
+
+
+def _dumps(data: dict) -> str:
+    return json.dumps(data, default=_encode)
+
+
+def _loads(text: str) -> dict:
+    return json.loads(text, object_hook=_decode)
+
+
+class SQLiteStore(Store):
+    """Single-file store for running the service and its load tests on one machine."""
+
+    backend = 'sqlite'
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS users (
+        id TEXT PRIMARY KEY,
+        data TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS materials (
+        user_id TEXT NOT NULL,
+        id TEXT NOT NULL,
+        next_review_time REAL,
+        data TEXT NOT NULL,
+        PRIMARY KEY (user_id, id)
+    );
+    CREATE INDEX IF NOT EXISTS materials_user_due ON materials (user_id, next_review_time);
+    CREATE INDEX IF NOT EXISTS materials_due ON materials (next_review_time);
+    CREATE TABLE IF NOT EXISTS records (
+        kind TEXT NOT NULL,
+        key TEXT NOT NULL,
+        data TEXT NOT NULL,
+        expires_at REAL,
+        PRIMARY KEY (kind, key)
+    );
+    CREATE INDEX IF NOT EXISTS records_expiry ON records (kind, expires_at);
+    """
+
+    def __init__(self, path: str = "xlearn.db"):
+        super().__init__()
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.executescript(self.SCHEMA)
+
+    def _commit(self, ops: list[tuple]):
+        with self._lock:
+            conn = self._conn
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for kind, user_id, material_id, data in self._with_counters(ops, self._load_material):
+                    self._apply(conn, kind, user_id, material_id, data)
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def _load_material(self, user_id: str, material_id: str) -> dict | None:
+        row = self._conn.execute("SELECT data FROM materials WHERE user_id = ? AND id = ?",
+                                 (user_id, material_id)).fetchone()
+        return _loads(row[0]) if row else None
+
+    def _apply(self, conn, kind, user_id, material_id, data):
+        if kind == 'set_user':
+            conn.execute("INSERT OR REPLACE INTO users (id, data) VALUES (?, ?)", (user_id, _dumps(data)))
+        elif kind in ('update_user', 'merge_user'):
+            row = conn.execute("SELECT data FROM users WHERE id = ?", (user_id,)).fetchone()
+            if row is None and kind == 'update_user':
+                raise KeyError(f"No user {user_id}")
+            user = _loads(row[0]) if row is not None else {}
+            _apply_fields(user, data)
+            conn.execute("INSERT OR REPLACE INTO users (id, data) VALUES (?, ?)", (user_id, _dumps(user)))
+        elif kind == 'delete_material':
+            conn.execute("DELETE FROM materials WHERE user_id = ? AND id = ?", (user_id, material_id))
+        else:
+            if kind == 'update_material':
+                row = conn.execute("SELECT data FROM materials WHERE user_id = ? AND id = ?",
+                                   (user_id, material_id)).fetchone()
+                if row is None:
+                    raise KeyError(f"No material {user_id}/{material_id}")
+                material = _loads(row[0])
+                _apply_fields(material, data)
+            else:
+                material = data
+            conn.execute(
+                "INSERT OR REPLACE INTO materials (user_id, id, next_review_time, data) VALUES (?, ?, ?, ?)",
+                (user_id, material_id, _timestamp(material.get('next_review_time')), _dumps(material)),
+            )
+
+    def _query(self, sql: str, params: tuple = ()) -> list:
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def get_user(self, user_id):
+        rows = self._query("SELECT data FROM users WHERE id = ?", (user_id,))
+        return _loads(rows[0][0]) if rows else None
+
+    def list_user_ids(self):
+        return [row[0] for row in self._query("SELECT id FROM users")]
+
+    def get_material(self, user_id, material_id):
+        rows = self._query("SELECT data FROM materials WHERE user_id = ? AND id = ?", (user_id, material_id))
+        return _loads(rows[0][0]) if rows else None
+
+    def list_materials(self, user_id):
+        rows = self._query("SELECT id, data FROM materials WHERE user_id = ?", (user_id,))
+        return [(material_id, _loads(data)) for material_id, data in rows]
+
+    def count_materials(self, user_id):
+        return self._query("SELECT COUNT(*) FROM materials WHERE user_id = ?", (user_id,))[0][0]
+
+    def count_due(self, user_id, now):
+        return self._query("SELECT COUNT(*) FROM materials WHERE user_id = ? AND next_review_time <= ?",
+                           (user_id, now.timestamp()))[0][0]
+
+    def reconcile_counters(self, user_id):
+        with self._lock:
+            conn = self._conn
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                user = self.get_user(user_id)
+                corrections = self._corrections(user, [material for _, material in self.list_materials(user_id)])
+                if corrections:
+                    self._apply(conn, 'merge_user', user_id, None, corrections)
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+            return corrections
+
+    def query_materials(self, user_id, limit=100, after=None, type=None, due_before=None, source=None, fields=None):
+        sql = "SELECT id, data FROM materials WHERE user_id = ?"
+        params = [user_id]
+        if after is not None:
+            sql += " AND (next_review_time, id) > (?, ?)"
+            params += list(after)
+        if due_before is not None:
+            sql += " AND next_review_time <= ?"
+            params.append(due_before.timestamp())
+        if type is not None:
+            sql += " AND json_extract(data, '$.type') = ?"
+            params.append(type)
+        if source is not None:
+            sql += " AND json_extract(data, '$.source') = ?"
+            params.append(source)
+        sql += " ORDER BY next_review_time, id LIMIT ?"
+        params.append(limit)
+        return [(material_id, _project(_loads(data), fields)) for material_id, data in self._query(sql, tuple(params))]
+
+    def iter_due_materials(self, end, start=None, page_size=500):
+        start_ts = float('-inf') if start is None else start.timestamp()
+        end_ts = end.timestamp()
+        cursor = (start_ts, '', '')
+        while True:
+            rows = self._query(
+                "SELECT next_review_time, user_id, id FROM materials"
+                " WHERE next_review_time > ? AND next_review_time <= ?"
+                " AND (next_review_time, user_id, id) > (?, ?, ?)"
+                " ORDER BY next_review_time, user_id, id LIMIT ?",
+                (start_ts, end_ts, *cursor, page_size),
+            )
+            for ts, user_id, material_id in rows:
+                yield user_id, material_id, datetime.fromtimestamp(ts, tz=timezone.utc)
+            if len(rows) < page_size:
+                return
+            cursor = rows[-1]
+
+    def put_record(self, kind, key, data, expires_at=None):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO records (kind, key, data, expires_at) VALUES (?, ?, ?, ?)",
+                               (kind, key, _dumps(data), _timestamp(expires_at)))
+
+    def get_record(self, kind, key):
+        rows = self._query("SELECT data FROM records WHERE kind = ? AND key = ? AND (expires_at IS NULL OR expires_at > ?)",
+                           (kind, key, time.time()))
+        return _loads(rows[0][0]) if rows else None
+
+    def delete_record(self, kind, key):
+        with self._lock:
+            self._conn.execute("DELETE FROM records WHERE kind = ? AND key = ?", (kind, key))
+
+    def list_records(self, kind):
+        rows = self._query("SELECT key, data FROM records WHERE kind = ? AND (expires_at IS NULL OR expires_at > ?)",
+                           (kind, time.time()))
+        return [(key, _loads(data)) for key, data in rows]
+
+    def purge_expired_records(self, kind, now):
+        with self._lock:
+            return self._conn.execute("DELETE FROM records WHERE kind = ? AND expires_at <= ?",
+                                      (kind, now.timestamp())).rowcount
+
+    def swap_record(self, kind, key, expected, data, expires_at=None):
+        with self._lock:
+            conn = self._conn
+            # IMMEDIATE takes the write lock up front, so other processes on the same file cannot interleave
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    "SELECT data FROM records WHERE kind = ? AND key = ? AND (expires_at IS NULL OR expires_at > ?)",
+                    (kind, key, time.time()),
+                ).fetchone()
+                swapped = (_loads(row[0]) if row else None) == expected
+                if swapped:
+                    conn.execute("INSERT OR REPLACE INTO records (kind, key, data, expires_at) VALUES (?, ?, ?, ?)",
+                                 (kind, key, _dumps(data), _timestamp(expires_at)))
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+            return swapped
+
+
+def get_store() -> Store:
+    """Backend picked by XLEARN_STORAGE: firestore (default), sqlite or memory."""
+    backend = os.getenv('XLEARN_STORAGE', 'firestore')
+    if backend == 'firestore':
+        return FirestoreStore()
+    if backend == 'sqlite':
+        return SQLiteStore(os.getenv('XLEARN_SQLITE_PATH', 'xlearn.db'))
+    if backend == 'memory':
+        return MemoryStore()
+    raise ValueError(f"Unknown storage backend: {backend}")
@@ -0,0 +1,169 @@
+import json
+import logging
+import queue
+import random
+import threading
+import time
+from typing import Callable
+
+from xlearn import metrics
+from xlearn import x_streaming
+
+logger = logging.getLogger(__name__)
+
+HANDLE_LATENCY = metrics.histogram('xlearn_stream_event_seconds', "Time spent handling one stream event",
+                                   ('outcome',))
+
+
+class StreamPipeline:
+    """Reads the filtered stream on one thread and hands events to a pool of handlers.
+
+    The reader only parses and enqueues. Events are partitioned by `key` (the
+    user), so each user's events are handled in arrival order by the same
+    worker while different users proceed in parallel. When a worker queue is
+    full the reader blocks, and the time spent blocked is recorded. Dropped
+    connections are retried with exponential backoff and jitter. Events for
+    which `accept(event)` is false are not handled, see sharding.StreamShards.
+    """
+
+    def __init__(self, handler: Callable[[dict], None], key: Callable[[dict], str], num_workers: int = 4,
+                 queue_size: int = 1000, connect: Callable = x_streaming.connect_stream,
+                 initial_backoff: float = 1.0, max_backoff: float = 320.0):
+        self.handler = handler
+        self.key = key
+        self.num_workers = num_workers
+        self.connect = connect
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self._queues = [queue.Queue(maxsize=max(1, queue_size // num_workers)) for _ in range(num_workers)]
+        self._workers = []
+        self._stopped = threading.Event()
+        self._response = None
+        self.accept = None
+        self.received = 0
+        self.keep_alives = 0
+        self.malformed = 0
+        self.handled = 0
+        self.failed = 0
+        self.blocked_puts = 0
+        self.blocked_seconds = 0.0
+        self.reconnects = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(q.qsize() for q in self._queues)
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue_depth,
+            "queue_capacity": sum(q.maxsize for q in self._queues),
+            "received": self.received,
+            "keep_alives": self.keep_alives,
+            "malformed": self.malformed,
+            "handled": self.handled,
+            "failed": self.failed,
+            "blocked_puts": self.blocked_puts,
+            "blocked_seconds": self.blocked_seconds,
+            "reconnects": self.reconnects,
+        }
+
+    def run(self):
+        """Connect and read until stop() is called, reconnecting whenever the stream drops."""
+        self._start_workers()
+        backoff = self.initial_backoff
+        while not self._stopped.is_set():
+            try:
+                self._response = self.connect()
+                for line in self._response.iter_lines():
+                    if self._stopped.is_set():
+                        return
+                    # anything read means the connection is healthy again
+                    backoff = self.initial_backoff
+                    self.feed(line)
+            except Exception as e:
+                if self._stopped.is_set():
+                    return
+                logger.warning("Stream disconnected", extra={'error': repr(e)})
+            self.reconnects += 1
+            delay = backoff * random.uniform(0.5, 1.0)
+            logger.info("Reconnecting to stream", extra={'delay_seconds': round(delay, 1)})
+            if self._stopped.wait(delay):
+                return
+            backoff = min(backoff * 2, self.max_backoff)
+
+    def feed(self, line: bytes):
+        if not line or not line.strip():
+            # X sends a blank line every ~20 seconds to keep the connection open
+            self.keep_alives += 1
+            return
+        try:
+            event = json.loads(line)
+        except json.JSONDecodeError:
+            self.malformed += 1
+            return
+        if 'data' not in event:
+            logger.warning("Stream message without data", extra={'event': event})
+            return
+        self.received += 1
+        if self.accept is None or self.accept(event):
+            self.submit(event)
+
+    def submit(self, event: dict):
+        """Queue an event for its user's worker, blocking while that queue is full."""
+        q = self._queues[hash(self.key(event)) % self.num_workers]
+        try:
+            q.put_nowait(event)
+        except queue.Full:
+            self.blocked_puts += 1
+            started = time.monotonic()
+            q.put(event)
+            self.blocked_seconds += time.monotonic() - started
+
+    def drain(self, timeout: float = 30) -> bool:
+        """Wait until every event queued so far has been handled; false if `timeout` ran out first."""
+        deadline = time.monotonic() + timeout
+        if self._stopped.is_set():
+            # the workers finish what is queued before the stop marker, then exit
+            for worker in self._workers:
+                worker.join(max(0.0, deadline - time.monotonic()))
+            return not any(worker.is_alive() for worker in self._workers)
+        markers = []
+        for q in self._queues[:len(self._workers)]:
+            marker = threading.Event()
+            try:
+                q.put(marker, timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Full:
+                return False
+            markers.append(marker)
+        return all(marker.wait(max(0.0, deadline - time.monotonic())) for marker in markers)
+
+    def stop(self):
+        self._stopped.set()
+        if self._response is not None:
+            self._response.close()
+        for q in self._queues:
+            q.put(None)
+
+    def _start_workers(self):
+        if self._workers:
+            return
+        for i, q in enumerate(self._queues):
+            worker = threading.Thread(target=self._work, args=(q,), name=f"stream-handler-{i}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def _work(self, q: queue.Queue):
+        while True:
+            event = q.get()
+            if event is None:
+                return
+            if isinstance(event, threading.Event):
+                event.set()  # see drain
+                continue
+            try:
+                with metrics.timed(HANDLE_LATENCY):
+                    self.handler(event)
+                self.handled += 1
+            except Exception:
+                self.failed += 1
+                logger.exception("Failed to handle stream event", extra={'tweet_id': event['data'].get('id')})
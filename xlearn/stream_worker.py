@@ -0,0 +1,34 @@
+"""Reads the filtered stream and answers replies: `python -m xlearn.stream_worker`.
+
+Loads neither the web framework nor the review window. Several can run side
+by side when SHARD_COUNT is set and the X app allows redundant stream
+connections (STREAM_REDUNDANT_CONNECTIONS=1); otherwise a second one refuses
+to start. Set METRICS_PORT to serve /metrics.
+"""
+import logging
+import os
+import signal
+
+from xlearn import metrics
+from xlearn import service
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    if os.getenv('METRICS_PORT'):
+        metrics.serve(int(os.getenv('METRICS_PORT')))
+    # reviews are posted by the review worker, which records its tweets for us to skip
+    service.reply_index.share_own = True
+    # not stopped from the handler itself, which could run while the reader holds a handler queue's lock
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        service.start_stream()
+    except KeyboardInterrupt:
+        service.stop_stream()
+    except Exception:
+        logger.exception("Stream listener stopped")
+
+
+if __name__ == "__main__":
+    main()
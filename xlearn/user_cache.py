@@ -0,0 +1,75 @@
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable
+
+import tweepy
+
+from xlearn.storage import Store
+
+
+@dataclass
+class CachedUser:
+    user_id: str
+    access_token: str
+    username: str
+    client: tweepy.Client
+    expires_at: float
+    digest_window_minutes: float | None = None
+    scheduling_algorithm: str | None = None
+
+
+class UserCache:
+    """Read-through cache of user records, keyed by user_id, with TTL and LRU eviction.
+
+    Each entry keeps a ready tweepy.Client so its connection pool is reused
+    across tweets. Call invalidate() whenever the stored access token changes.
+    """
+
+    def __init__(self, store: Store, ttl_seconds: float = 600, max_size: int = 10000,
+                 client_factory: Callable[[str], tweepy.Client] = tweepy.Client):
+        self.store = store
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        self.client_factory = client_factory
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id: str) -> CachedUser:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry.expires_at > now:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        user = self.store.get_user(user_id)
+        if user is None:
+            raise KeyError(f"Unknown user {user_id}")
+        entry = CachedUser(
+            user_id=user_id,
+            access_token=user['access_token'],
+            username=user.get('username'),
+            client=self.client_factory(user['access_token']),
+            expires_at=now + self.ttl_seconds,
+            digest_window_minutes=user.get('digest_window_minutes'),
+            scheduling_algorithm=user.get('scheduling_algorithm'),
+        )
+        with self._lock:
+            self._entries[user_id] = entry
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return entry
+
+    def invalidate(self, user_id: str):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def stats(self) -> dict:
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
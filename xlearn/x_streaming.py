@@ -1,11 +1,73 @@
 import requests
+from requests.adapters import HTTPAdapter
 import os
+import re
 import json
+import logging
+import time
+from urllib import parse
 import tweepy
 
+from xlearn import metrics
+
+logger = logging.getLogger(__name__)
+
 bearer_token = os.environ.get("BEARER_TOKEN")
 
+# limits of the filtered stream rules endpoint; the rule length depends on the access level
+MAX_RULE_LENGTH = int(os.environ.get("X_MAX_RULE_LENGTH", 512))
+MAX_RULES_PER_REQUEST = int(os.environ.get("X_MAX_RULES_PER_REQUEST", 100))
+
+HTTP_POOL_SIZE = int(os.environ.get("X_HTTP_POOL_SIZE", 10))
+HTTP_TIMEOUT = (float(os.environ.get("X_HTTP_CONNECT_TIMEOUT", 10)), float(os.environ.get("X_HTTP_READ_TIMEOUT", 30)))
+# X sends a keep-alive every 20 seconds, so a longer silence means the stream stalled
+STREAM_TIMEOUT = (HTTP_TIMEOUT[0], float(os.environ.get("X_STREAM_READ_TIMEOUT", 90)))
+
+
+X_API_LATENCY = metrics.histogram('xlearn_x_api_request_seconds', "X API latency until the response headers",
+                                  ('endpoint', 'status'))
+_ID_SEGMENT = re.compile(r"/\d+(?=/|$)")
+
+
+def _endpoint(url):
+    return _ID_SEGMENT.sub("/:id", parse.urlsplit(url).path)
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """Adapter that applies a default timeout, which requests itself lacks, and times every request."""
+
+    def __init__(self, timeout=HTTP_TIMEOUT, **kwargs):
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(self, request, timeout=None, **kwargs):
+        start = time.perf_counter()
+        status = 'error'
+        try:
+            response = super().send(request, timeout=timeout or self.timeout, **kwargs)
+            status = response.status_code
+            return response
+        finally:
+            X_API_LATENCY.observe(time.perf_counter() - start, endpoint=_endpoint(request.url), status=status)
+
 
+def pooled_session(pool_size=HTTP_POOL_SIZE, timeout=HTTP_TIMEOUT):
+    session = requests.Session()
+    adapter = TimeoutHTTPAdapter(timeout=timeout, pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def create_client(access_token, pool_size=HTTP_POOL_SIZE):
+    """tweepy.Client whose session keeps connections alive with a default timeout."""
+    client = tweepy.Client(access_token)
+    client.session = pooled_session(pool_size)
+    return client
+
+
+# shared by every bearer-token call in this module
+session = pooled_session()
 
 
 def bearer_oauth(r):
@@ -19,21 +81,21 @@ def bearer_oauth(r):
 
 
 def get_rules():
-    response = requests.get(
+    response = session.get(
         "https://api.twitter.com/2/tweets/search/stream/rules", auth=bearer_oauth
     )
     if response.status_code != 200:
         raise Exception(
             "Cannot get rules (HTTP {}): {}".format(response.status_code, response.text)
         )
-    print(json.dumps(response.json()))
+    logger.debug("Stream rules", extra={'response': response.json()})
     return response.json()
 
 def set_rules(rules):
     try:
         # You can adjust the rules if needed
         payload = {"add": rules}
-        response = requests.post(
+        response = session.post(
             "https://api.twitter.com/2/tweets/search/stream/rules",
             auth=bearer_oauth,
             json=payload,
@@ -42,9 +104,71 @@ def set_rules(rules):
             raise Exception(
                 "Cannot add rules (HTTP {}): {}".format(response.status_code, response.text)
             )
-        print(json.dumps(response.json()))
-    except Exception as e:
-        print(e)
+        logger.info("Added stream rules", extra={'response': response.json()})
+    except Exception:
+        logger.exception("Failed to add stream rules")
+
+
+def _post_rules(payload, expected_status):
+    response = session.post(
+        "https://api.twitter.com/2/tweets/search/stream/rules",
+        auth=bearer_oauth,
+        json=payload,
+    )
+    if response.status_code != expected_status:
+        raise Exception(
+            "Cannot update rules (HTTP {}): {}".format(response.status_code, response.text)
+        )
+    if "errors" in response.json():
+        logger.warning("Stream rule errors", extra={'errors': response.json()["errors"]})
+    return response.json()
+
+
+def pack_rules(clauses, tag_prefix, max_length=MAX_RULE_LENGTH):
+    """OR clauses together into as few rules as fit in max_length.
+
+    Packing is greedy in the given order, so a stable order keeps the packed
+    rules (and their tags) stable between runs.
+    """
+    rules = []
+    current = []
+    for clause in clauses:
+        if current and len(" OR ".join(current + [clause])) > max_length:
+            rules.append(current)
+            current = []
+        current.append(clause)
+    if current:
+        rules.append(current)
+    return [
+        {"value": " OR ".join(rule), "tag": f"{tag_prefix}_{i}"}
+        for i, rule in enumerate(rules)
+    ]
+
+
+def sync_rules(desired):
+    """Make the stream rules match `desired`, comparing rules by value and tag.
+
+    Missing rules are added before stale ones are deleted so the stream is never
+    left without rules. Rules whose value is kept but whose tag changes have to
+    be deleted first, because X rejects duplicate values.
+    """
+    current = get_rules().get("data", [])
+    current_ids = {(rule["value"], rule.get("tag")): rule["id"] for rule in current}
+    desired_keys = {(rule["value"], rule.get("tag")) for rule in desired}
+    desired_values = {rule["value"] for rule in desired}
+
+    to_add = [rule for rule in desired if (rule["value"], rule.get("tag")) not in current_ids]
+    stale = [(key, rule_id) for key, rule_id in current_ids.items() if key not in desired_keys]
+    retagged = [rule_id for key, rule_id in stale if key[0] in desired_values]
+    to_delete = [rule_id for key, rule_id in stale if key[0] not in desired_values]
+
+    if retagged:
+        _post_rules({"delete": {"ids": retagged}}, 200)
+    for i in range(0, len(to_add), MAX_RULES_PER_REQUEST):
+        _post_rules({"add": to_add[i:i + MAX_RULES_PER_REQUEST]}, 201)
+    if to_delete:
+        _post_rules({"delete": {"ids": to_delete}}, 200)
+    return {"added": len(to_add), "deleted": len(retagged) + len(to_delete), "unchanged": len(current) - len(stale)}
 
 
 def delete_all_rules(rules):
@@ -53,7 +177,7 @@ def delete_all_rules(rules):
 
     ids = list(map(lambda rule: rule["id"], rules["data"]))
     payload = {"delete": {"ids": ids}}
-    response = requests.post(
+    response = session.post(
         "https://api.twitter.com/2/tweets/search/stream/rules",
         auth=bearer_oauth,
         json=payload
@@ -64,14 +188,31 @@ def delete_all_rules(rules):
                 response.status_code, response.text
             )
         )
-    print(json.dumps(response.json()))
+    logger.info("Deleted stream rules", extra={'response': response.json()})
+
+
+STREAM_FIELDS = {'tweet.fields': 'author_id,conversation_id,referenced_tweets'}
+
+
+def connect_stream(params=STREAM_FIELDS):
+    response = session.get(
+        "https://api.twitter.com/2/tweets/search/stream", auth=bearer_oauth, stream=True, params=params,
+        timeout=STREAM_TIMEOUT,
+    )
+    if response.status_code != 200:
+        raise Exception(
+            "Cannot get stream (HTTP {}): {}".format(
+                response.status_code, response.text
+            )
+        )
+    return response
 
 
 def get_stream():
-    response = requests.get(
-        "https://api.twitter.com/2/tweets/search/stream", auth=bearer_oauth, stream=True,
+    response = session.get(
+        "https://api.twitter.com/2/tweets/search/stream", auth=bearer_oauth, stream=True, timeout=STREAM_TIMEOUT,
     )
-    print(response.status_code)
+    logger.info("Stream connected", extra={'status': response.status_code})
     if response.status_code != 200:
         raise Exception(
             "Cannot get stream (HTTP {}): {}".format(
@@ -81,6 +222,6 @@ def get_stream():
     for response_line in response.iter_lines():
         if response_line:
             json_response = json.loads(response_line)
-            print(json.dumps(json_response, indent=4, sort_keys=True))
+            logger.info("Stream event", extra={'event': json_response})
             
     
\ No newline at end of file